@@ -0,0 +1,118 @@
+"""
+Semantic answer cache
+
+WHAT: Stores (question embedding, question type, answer, corpus generation)
+      in the answer_cache table and serves a stored answer when a new
+      standalone question is close enough to a cached one.
+WHY:  Most traffic is paraphrases of the same few dozen policy questions;
+      a hit skips classification, retrieval and generation entirely.
+
+Knowledge answers are tied to the corpus generation, a Postgres sequence
+bumped whenever documents are uploaded or deleted (api/rag.corpus_changed).
+A request records the generation it started under, so an answer computed
+against the old corpus is never served after the bump. Conversational
+answers don't depend on the documents and only expire by TTL. Database
+answers are not cached: they come from live tables, and paraphrases that
+embed closely ("survivors in 1st class" vs "in 3rd class") have different
+answers. Neither are empty-retrieval replies (NO_RESULTS_ANSWER): the
+passages may only have been missing for a moment. Expired rows are purged
+every PURGE_EVERY stores and on every invalidation. Lookups walk an HNSW
+index on the question embeddings (migration 0010).
+"""
+
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import connection
+from django.db.models import F
+from django.utils import timezone
+
+from api.models import AnswerCacheEntry
+from api.vector_db import to_db_vector, vector_cursor
+
+CACHEABLE_TYPES = ("knowledge", "conversational")
+CORPUS_BOUND_TYPES = ("knowledge",)
+PURGE_EVERY = 100
+NO_RESULTS_ANSWER = "No relevant information found."
+
+stats = {"hits": 0, "misses": 0, "stores": 0, "purged": 0}
+
+
+def lookup(question_embedding):
+    """
+    Returns (corpus_generation, hit). hit is None or a dict with answer,
+    question_type and distance. One round trip.
+    """
+    with vector_cursor() as cursor:
+        cursor.execute("""
+            -- A fresh sequence reports last_value 1 before its first nextval;
+            -- read it as 0 so the first invalidate() (nextval = 1) moves on
+            WITH g AS (
+                SELECT CASE WHEN is_called THEN last_value ELSE 0 END AS generation
+                FROM corpus_generation
+            )
+            SELECT g.generation, a.id, a.answer, a.question_type, a.distance
+            FROM g
+            LEFT JOIN LATERAL (
+                -- Walks answer_cache_embedding_hnsw nearest first instead of
+                -- scoring every row; the filters are applied to the walk
+                SELECT id, answer, question_type, (embedding <=> %(embedding)s::vector) AS distance
+                FROM answer_cache
+                WHERE question_type = ANY(%(cacheable)s)
+                  AND (corpus_generation = g.generation OR question_type <> ALL(%(corpus_bound)s))
+                  AND created_at > now() - make_interval(secs => %(ttl)s)
+                ORDER BY embedding <=> %(embedding)s::vector
+                LIMIT 1
+            ) a ON TRUE
+        """, {
+            "embedding": to_db_vector(question_embedding),
+            "cacheable": list(CACHEABLE_TYPES),
+            "corpus_bound": list(CORPUS_BOUND_TYPES),
+            "ttl": settings.RAG_ANSWER_CACHE_TTL,
+        })
+        generation, entry_id, answer, question_type, distance = cursor.fetchone()
+
+    if entry_id is None or distance > 1 - settings.RAG_ANSWER_CACHE_THRESHOLD:
+        stats["misses"] += 1
+        return generation, None
+
+    stats["hits"] += 1
+    AnswerCacheEntry.objects.filter(id=entry_id).update(hits=F("hits") + 1)
+    return generation, {"answer": answer, "question_type": question_type, "distance": distance}
+
+
+def cacheable(question_type, answer):
+    return question_type in CACHEABLE_TYPES and answer != NO_RESULTS_ANSWER
+
+
+def store(question, question_embedding, question_type, answer, generation):
+    AnswerCacheEntry.objects.create(
+        question=question,
+        embedding=to_db_vector(question_embedding),
+        question_type=question_type,
+        answer=answer,
+        corpus_generation=generation,
+    )
+    stats["stores"] += 1
+    if stats["stores"] % PURGE_EVERY == 0:
+        purge_expired()
+
+
+def purge_expired():
+    """Deletes entries older than RAG_ANSWER_CACHE_TTL; returns how many."""
+    expired_before = timezone.now() - timedelta(seconds=settings.RAG_ANSWER_CACHE_TTL)
+    deleted, _ = AnswerCacheEntry.objects.filter(created_at__lte=expired_before).delete()
+    stats["purged"] += deleted
+    return deleted
+
+
+def invalidate():
+    """Starts a new corpus generation and drops knowledge answers of older ones."""
+    with connection.cursor() as cursor:
+        cursor.execute("SELECT nextval('corpus_generation')")
+        generation = cursor.fetchone()[0]
+    AnswerCacheEntry.objects.filter(
+        question_type__in=CORPUS_BOUND_TYPES, corpus_generation__lt=generation
+    ).delete()
+    purge_expired()
+    return generation
@@ -1,5 +1,10 @@
 from django.apps import AppConfig
+from django.db.backends.signals import connection_created
 
 
 class ApiConfig(AppConfig):
     name = 'api'
+
+    def ready(self):
+        from .vector_db import configure_connection
+        connection_created.connect(configure_connection, dispatch_uid='api.configure_vector_connection')
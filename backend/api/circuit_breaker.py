@@ -0,0 +1,256 @@
+"""
+Circuit breakers around Ollama
+
+WHAT: One breaker per generation task ("rewrite", "classify", "sql",
+      "answer", "chitchat", see api/model_registry.py) plus one for
+      embeddings keeps a rolling window of recent calls (latency and whether
+      Ollama failed). When too many of them failed, or too many were slow,
+      the breaker opens: calls are rejected immediately with CircuitOpen for
+      open_seconds, then a single trial call is let through (half-open) and
+      its outcome closes or re-opens the breaker.
+WHY:  When Ollama is down or drowning, every chat otherwise waits for its own
+      timeout and the workers pile up. Failing fast lets rag.py fall back to
+      a degraded answer (retrieved passages, no rewrite) right away.
+
+Per-task breakers keep slow answer generation (often a bigger model) from
+blocking the short rewrite and classification calls. Latency means time to
+first token: streams mark their first chunk, and non-streamed generations
+subtract the decoding time Ollama reports (eval_duration), so a long answer
+is not a slow call.
+
+Only backend failures count (connection errors, timeouts, 5xx, no healthy
+host); local rejections such as a full scheduler queue do not. A read
+timeout that the request deadline shortened is the request running out of
+time, not Ollama failing: it counts as a slow call at most. Breakers are
+per process.
+"""
+
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
+import httpx
+import requests
+from django.conf import settings
+
+from api.ollama_router import NoHealthyHost, is_host_failure
+from api.ollama_scheduler import OllamaOverloaded
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+
+class OllamaUnavailable(OllamaOverloaded):
+    """Ollama failed (or is being skipped); callers may degrade instead of erroring."""
+
+
+class CircuitOpen(OllamaUnavailable):
+    pass
+
+
+def is_backend_failure(error):
+    return isinstance(error, NoHealthyHost) or is_host_failure(error)
+
+
+def is_read_timeout(error):
+    return isinstance(error, (requests.exceptions.ReadTimeout, httpx.ReadTimeout))
+
+
+class CircuitBreaker:
+    def __init__(self, name, window, min_calls, error_rate, slow_seconds, slow_rate, open_seconds):
+        self.name = name
+        self.window = window
+        self.min_calls = min_calls
+        self.error_rate = error_rate
+        # None: latency never trips this breaker
+        self.slow_seconds = slow_seconds
+        self.slow_rate = slow_rate
+        self.open_seconds = open_seconds
+        self._lock = threading.Lock()
+        self._calls = deque()  # (finished_at, seconds, failed)
+        self.state = CLOSED
+        self._opened_at = 0.0
+        self._trial_running = False
+        self._stats = {"trips": 0, "rejected": 0}
+
+    def _prune(self, now):
+        while self._calls and self._calls[0][0] < now - self.window:
+            self._calls.popleft()
+
+    def _retry_after(self, now):
+        return max(1, int(self._opened_at + self.open_seconds - now + 0.999))
+
+    def _reject(self, now, reason):
+        self._stats["rejected"] += 1
+        raise CircuitOpen(f"Ollama {self.name} circuit {reason}", retry_after=self._retry_after(now))
+
+    def available(self):
+        """False while open (a half-open breaker counts as available)."""
+        with self._lock:
+            return self.state != OPEN or time.monotonic() >= self._opened_at + self.open_seconds
+
+    def check(self):
+        """Raises CircuitOpen while the breaker is open (before queueing for a slot)."""
+        with self._lock:
+            now = time.monotonic()
+            if self.state == OPEN and now < self._opened_at + self.open_seconds:
+                self._reject(now, "open")
+
+    def _enter(self):
+        with self._lock:
+            now = time.monotonic()
+            if self.state == OPEN:
+                if now < self._opened_at + self.open_seconds:
+                    self._reject(now, "open")
+                self.state = HALF_OPEN
+                self._trial_running = False
+                print(f"Ollama {self.name} circuit half-open: sending a trial call")
+            if self.state == HALF_OPEN:
+                if self._trial_running:
+                    self._reject(now, "half-open, trial call in flight")
+                self._trial_running = True
+
+    def _trip(self, now, reason):
+        self.state = OPEN
+        self._opened_at = now
+        self._trial_running = False
+        self._calls.clear()
+        self._stats["trips"] += 1
+        print(f"Ollama {self.name} circuit opened for {self.open_seconds}s: {reason}")
+
+    def _record(self, seconds, failed):
+        with self._lock:
+            now = time.monotonic()
+            slow = self.slow_seconds is not None and seconds >= self.slow_seconds
+            if self.state == HALF_OPEN:
+                if failed or slow:
+                    self._trip(now, "trial call " + ("failed" if failed else f"took {seconds:.1f}s"))
+                else:
+                    self.state = CLOSED
+                    self._trial_running = False
+                    self._calls.clear()
+                    print(f"Ollama {self.name} circuit closed")
+                return
+
+            self._calls.append((now, seconds, failed))
+            self._prune(now)
+            calls = len(self._calls)
+            if calls < self.min_calls:
+                return
+            errors = sum(1 for _, _, call_failed in self._calls if call_failed)
+            if errors / calls >= self.error_rate:
+                self._trip(now, f"{errors}/{calls} calls failed in {self.window}s")
+                return
+            if self.slow_seconds is not None:
+                slow_calls = sum(1 for _, call_seconds, _ in self._calls if call_seconds >= self.slow_seconds)
+                if slow_calls / calls >= self.slow_rate:
+                    self._trip(now, f"{slow_calls}/{calls} calls slower than {self.slow_seconds}s")
+
+    def _abandon(self):
+        # Call ended without telling us anything about Ollama (e.g. rejected locally)
+        with self._lock:
+            if self.state == HALF_OPEN:
+                self._trial_running = False
+
+    def _record_deadline_timeout(self, seconds):
+        # The request ran out of time: only evidence that Ollama is slow
+        if self.slow_seconds is not None and seconds >= self.slow_seconds:
+            self._record(seconds, failed=False)
+        else:
+            self._abandon()
+
+    @contextmanager
+    def call(self, deadline_capped=False):
+        """
+        Wraps one Ollama call: rejects it while open, and records its latency
+        and outcome. Use mark_first_byte() inside streams and
+        exclude_decoding(body) after non-streamed generations so the breaker
+        judges time to first token rather than the length of the answer.
+        deadline_capped says the read timeout was shortened by the request
+        deadline (api/deadline.py).
+        """
+        self._enter()
+        timer = _CallTimer()
+        try:
+            yield timer
+        except BaseException as e:
+            if isinstance(e, Exception) and is_backend_failure(e):
+                if deadline_capped and is_read_timeout(e):
+                    self._record_deadline_timeout(timer.seconds())
+                else:
+                    self._record(timer.seconds(), failed=True)
+            else:
+                self._abandon()
+            raise
+        self._record(timer.seconds(), failed=False)
+
+    def stats(self):
+        with self._lock:
+            now = time.monotonic()
+            self._prune(now)
+            durations = sorted(seconds for _, seconds, _ in self._calls)
+            stats = dict(self._stats)
+            stats.update({
+                "state": self.state,
+                "window_calls": len(self._calls),
+                "window_errors": sum(1 for _, _, failed in self._calls if failed),
+                "window_p50_seconds": round(durations[len(durations) // 2], 3) if durations else None,
+                "window_p95_seconds": round(durations[min(len(durations) - 1, int(len(durations) * 0.95))], 3) if durations else None,
+            })
+            if self.state == OPEN:
+                stats["retry_after"] = self._retry_after(now)
+        return stats
+
+
+class _CallTimer:
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.first_byte = None
+        self.decoding_seconds = 0.0
+
+    def mark_first_byte(self):
+        if self.first_byte is None:
+            self.first_byte = time.perf_counter()
+
+    def exclude_decoding(self, body):
+        """Discounts the token generation time Ollama reports in a final response body."""
+        self.decoding_seconds = body.get("eval_duration", 0) / 1e9
+
+    def seconds(self):
+        return max((self.first_byte or time.perf_counter()) - self.started - self.decoding_seconds, 0.0)
+
+
+EMBEDDINGS = "embeddings"
+
+_breakers = {}
+_breakers_lock = threading.Lock()
+
+
+def get_breaker(name):
+    """The worker's breaker for a generation task or "embeddings"."""
+    breaker = _breakers.get(name)
+    if breaker is None:
+        with _breakers_lock:
+            breaker = _breakers.get(name)
+            if breaker is None:
+                breaker = _breakers[name] = CircuitBreaker(
+                    name,
+                    window=settings.OLLAMA_BREAKER_WINDOW,
+                    min_calls=settings.OLLAMA_BREAKER_MIN_CALLS,
+                    error_rate=settings.OLLAMA_BREAKER_ERROR_RATE,
+                    # Embeddings are judged on errors only
+                    slow_seconds=settings.OLLAMA_BREAKER_SLOW_SECONDS if name != EMBEDDINGS else None,
+                    slow_rate=settings.OLLAMA_BREAKER_SLOW_RATE,
+                    open_seconds=settings.OLLAMA_BREAKER_OPEN_SECONDS,
+                )
+    return breaker
+
+
+def generation_available(task):
+    return get_breaker(task).available()
+
+
+def stats():
+    return {name: breaker.stats() for name, breaker in list(_breakers.items())}
@@ -0,0 +1,60 @@
+"""
+Per-request deadlines for the RAG pipeline
+
+WHAT: A chat request gets a time budget (settings.RAG_REQUEST_DEADLINE)
+      when the view starts it. The deadline lives in a context variable, so
+      every stage below the view sees it without extra arguments: Ollama
+      calls shorten their queue wait and read timeout to the time left, and
+      rag.py skips optional stages (the rewrite) when too little is left.
+WHY:  Without it each stage used its own fixed timeout, so a slow Ollama
+      let one request run for several read timeouts in a row.
+
+Context variables follow asyncio tasks and sync_to_async calls;
+stage_executor copies the context into its worker threads.
+"""
+
+import contextvars
+import time
+from contextlib import contextmanager
+
+from api.ollama_scheduler import OllamaOverloaded
+
+_deadline = contextvars.ContextVar("rag_deadline", default=None)
+
+
+class DeadlineExceeded(OllamaOverloaded):
+    pass
+
+
+@contextmanager
+def budget(seconds):
+    """Runs the block with a deadline `seconds` from now (no deadline if falsy)."""
+    token = _deadline.set(time.monotonic() + seconds if seconds else None)
+    try:
+        yield
+    finally:
+        _deadline.reset(token)
+
+
+def remaining():
+    """Seconds left, or None without a deadline."""
+    deadline = _deadline.get()
+    return None if deadline is None else deadline - time.monotonic()
+
+
+def has_budget(seconds):
+    left = remaining()
+    return left is None or left >= seconds
+
+
+def check(stage):
+    left = remaining()
+    if left is not None and left <= 0:
+        raise DeadlineExceeded(f"Request deadline exceeded before {stage}")
+
+
+def timeout(default, stage="Ollama call"):
+    """default capped to the time left; raises DeadlineExceeded when none is left."""
+    check(stage)
+    left = remaining()
+    return default if left is None else min(default, left)
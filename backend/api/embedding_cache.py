@@ -0,0 +1,199 @@
+"""
+Embedding cache shared by queries and ingestion
+
+WHAT: Maps (model, hash of normalized text) -> embedding, with a bounded
+      in-memory LRU in front of an optional SQLite file.
+WHY:  Popular questions ("leave policy", "how many survived") and re-ingested
+      unchanged chunks would otherwise each cost an HTTP round trip to Ollama.
+
+Embeddings are stored L2-normalized. Ollama's /api/embed returns unit
+vectors and the older /api/embeddings doesn't; normalizing on the way in
+lets both endpoints share one entry per (model, text), and retrieval only
+compares directions (cosine) anyway.
+
+The memory tier is per process. The SQLite tier (settings.RAG_EMBEDDING_CACHE_PATH)
+is shared by every worker and survives restarts; it runs in WAL mode so
+readers don't block the writer. It keeps at most
+settings.RAG_EMBEDDING_CACHE_DISK_SIZE rows: every PRUNE_EVERY stores the
+least recently used rows past the cap are deleted.
+"""
+
+import hashlib
+import re
+import sqlite3
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+
+import numpy as np
+from django.conf import settings
+
+PRUNE_EVERY = 500
+
+
+def normalize_text(text):
+    """Whitespace/Unicode normalization so trivially different inputs share an entry."""
+    return re.sub(r"\s+", " ", unicodedata.normalize("NFC", text)).strip()
+
+
+def cache_key(model, text):
+    digest = hashlib.sha256(normalize_text(text).encode("utf-8")).hexdigest()
+    return f"{model}:{digest}"
+
+
+def unit_vector(embedding):
+    vector = np.asarray(embedding, dtype=np.float32)
+    norm = np.linalg.norm(vector)
+    return vector / norm if norm else vector
+
+
+class EmbeddingCache:
+    def __init__(self, max_entries, path=None, max_disk_entries=None):
+        self.max_entries = max_entries
+        self.path = path
+        self.max_disk_entries = max_disk_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self._disk_puts = 0
+
+    # -------------------------
+    # Persistent tier
+    # -------------------------
+    def _db(self):
+        db = getattr(self._local, "db", None)
+        if db is None:
+            db = sqlite3.connect(self.path, timeout=5)
+            db.execute("PRAGMA journal_mode=WAL")
+            # Rows of the unnormalized, never-evicted layout
+            db.execute("DROP TABLE IF EXISTS embeddings")
+            db.execute(
+                "CREATE TABLE IF NOT EXISTS vectors (key TEXT PRIMARY KEY, vector BLOB NOT NULL, used_at REAL NOT NULL)"
+            )
+            db.execute("CREATE INDEX IF NOT EXISTS vectors_used_at ON vectors (used_at)")
+            self._local.db = db
+        return db
+
+    def _disk_get(self, key):
+        try:
+            with self._db() as db:
+                row = db.execute("SELECT vector FROM vectors WHERE key = ?", (key,)).fetchone()
+                if row:
+                    db.execute("UPDATE vectors SET used_at = ? WHERE key = ?", (time.time(), key))
+        except sqlite3.Error as e:
+            print(f"Embedding cache read failed: {str(e)}")
+            return None
+        return np.frombuffer(row[0], dtype=np.float32) if row else None
+
+    def _disk_put(self, key, vector):
+        try:
+            with self._db() as db:
+                db.execute(
+                    "INSERT OR REPLACE INTO vectors (key, vector, used_at) VALUES (?, ?, ?)",
+                    (key, vector.tobytes(), time.time()),
+                )
+        except sqlite3.Error as e:
+            print(f"Embedding cache write failed: {str(e)}")
+            return
+        with self._lock:
+            self._disk_puts += 1
+            due = self._disk_puts % PRUNE_EVERY == 0
+        if due:
+            self.prune()
+
+    def prune(self):
+        """Deletes the least recently used rows past max_disk_entries; returns how many."""
+        if not self.path or not self.max_disk_entries:
+            return 0
+        try:
+            with self._db() as db:
+                excess = db.execute("SELECT COUNT(*) FROM vectors").fetchone()[0] - self.max_disk_entries
+                if excess <= 0:
+                    return 0
+                db.execute(
+                    "DELETE FROM vectors WHERE key IN (SELECT key FROM vectors ORDER BY used_at LIMIT ?)", (excess,)
+                )
+        except sqlite3.Error as e:
+            print(f"Embedding cache prune failed: {str(e)}")
+            return 0
+        return excess
+
+    # -------------------------
+    # Public API
+    # -------------------------
+    def get(self, model, text):
+        """Returns the cached embedding as a list, or None."""
+        key = cache_key(model, text)
+        with self._lock:
+            vector = self._entries.get(key)
+            if vector is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return vector.tolist()
+
+        vector = self._disk_get(key) if self.path else None
+        with self._lock:
+            if vector is None:
+                self.misses += 1
+                return None
+            self.disk_hits += 1
+            self._remember(key, vector)
+        return vector.tolist()
+
+    def put(self, model, text, embedding):
+        """Stores the embedding normalized to unit length and returns it as stored."""
+        key = cache_key(model, text)
+        vector = unit_vector(embedding)
+        with self._lock:
+            self._remember(key, vector)
+        if self.path:
+            self._disk_put(key, vector)
+        return vector.tolist()
+
+    def _remember(self, key, vector):
+        self._entries[key] = vector
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def disk_entries(self):
+        if not self.path:
+            return 0
+        return self._db().execute("SELECT COUNT(*) FROM vectors").fetchone()[0]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+        if self.path:
+            with self._db() as db:
+                db.execute("DELETE FROM vectors")
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.disk_hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "max_entries": self.max_entries,
+                "hits": self.hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "hit_rate": round((self.hits + self.disk_hits) / lookups, 3) if lookups else 0.0,
+            }
+
+
+_cache = None
+
+
+def get_cache():
+    global _cache
+    if _cache is None:
+        _cache = EmbeddingCache(
+            settings.RAG_EMBEDDING_CACHE_SIZE,
+            settings.RAG_EMBEDDING_CACHE_PATH or None,
+            settings.RAG_EMBEDDING_CACHE_DISK_SIZE,
+        )
+    return _cache
@@ -1,24 +1,32 @@
-import requests
+from api import ollama_service
 
-OLLAMA_URL = "http://localhost:11434/api/embeddings"
-MODEL = "llama3.2:1b"
 
 def generate_embedding(text):
     """
     Convert text to 768-dimensional vector using Ollama
-    
+
+    Uses the retrieval model (ollama_service.EMBEDDING_MODEL), so stored
+    vectors and query vectors share one space.
+
     Args:
         text (str): Text to convert to embedding
-        
+
     Returns:
         list: 768-dimensional vector
     """
-    response = requests.post(
-        OLLAMA_URL,
-        json={
-            "model": "gemma3:1b",
-            "prompt": text
-        }
-    )
-    response.raise_for_status()
-    return response.json()["embedding"]
+    return ollama_service.generate_embedding(text)
+
+
+def generate_embeddings(texts, batch_size=None):
+    """
+    Batch version of generate_embedding: one request per batch via Ollama's
+    multi-input /api/embed endpoint (see ollama_service.generate_embeddings)
+
+    Args:
+        texts (list): Texts to convert to embeddings
+        batch_size (int): Max texts per request (default: settings.RAG_EMBED_BATCH_SIZE)
+
+    Returns:
+        list: One vector per text, in the same order
+    """
+    return ollama_service.generate_embeddings(texts, batch_size=batch_size)
@@ -0,0 +1,111 @@
+"""
+Extractive answers for lookup-style knowledge questions
+
+WHAT: Splits the top retrieved chunks into sentences, scores each sentence
+      by cosine similarity between its embedding and the question's, and
+      returns the best sentence (plus adjacent sentences that score almost
+      as well) as the answer when retrieval and the match are both
+      confident:
+        - the best chunk's vector distance <= RAG_EXTRACTIVE_MAX_DISTANCE
+        - the best sentence's similarity >= RAG_EXTRACTIVE_MIN_SIMILARITY
+        - it beats every non-adjacent sentence by RAG_EXTRACTIVE_MIN_MARGIN
+      Otherwise rag.py generates the answer as before.
+WHY:  Many policy questions are answered by a single sentence of one chunk;
+      generating over five concatenated chunks for them costs seconds,
+      while sentence embeddings come from the embedding cache after the
+      first time a chunk is seen.
+
+Off unless settings.RAG_EXTRACTIVE_ANSWERS is set.
+"""
+
+import re
+
+import numpy as np
+from django.conf import settings
+
+from api.ollama_scheduler import SHORT
+from api.ollama_service import generate_embedding, generate_embeddings
+
+# Sentence boundary, or a line break (bullet lists, headings)
+SENTENCE_SPLIT = re.compile(r"(?<=[.!?])\s+(?=[A-Z0-9\"'(])|\n+")
+MIN_SENTENCE_WORDS = 4
+MAX_SENTENCE_CHARS = 600
+
+stats = {"attempts": 0, "answered": 0, "low_confidence": 0, "far_chunks": 0, "errors": 0}
+
+
+def split_sentences(text):
+    sentences = (sentence.strip(" -•*\t") for sentence in SENTENCE_SPLIT.split(text))
+    return [
+        sentence for sentence in sentences
+        if len(sentence.split()) >= MIN_SENTENCE_WORDS and len(sentence) <= MAX_SENTENCE_CHARS
+    ]
+
+
+def _normalize(matrix):
+    matrix = np.asarray(matrix, dtype=np.float32)
+    norms = np.linalg.norm(matrix, axis=-1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return matrix / norms
+
+
+def extract_answer(search_query, docs):
+    """
+    Returns the answer span from docs (similarity_search results, best first),
+    or None when generation should answer instead.
+    """
+    if not settings.RAG_EXTRACTIVE_ANSWERS or not docs:
+        return None
+    stats["attempts"] += 1
+
+    candidates = [doc for doc in docs[:settings.RAG_EXTRACTIVE_CHUNKS] if doc.get("distance") is not None]
+    candidates = [doc for doc in candidates if doc["distance"] <= settings.RAG_EXTRACTIVE_MAX_DISTANCE]
+    if not candidates:
+        stats["far_chunks"] += 1
+        return None
+
+    chunks = [split_sentences(doc["content"]) for doc in candidates]
+    sentences = [sentence for chunk in chunks for sentence in chunk]
+    if not sentences:
+        stats["low_confidence"] += 1
+        return None
+
+    try:
+        query = _normalize(generate_embedding(search_query))
+        scores = _normalize(generate_embeddings(sentences, lane=SHORT)) @ query
+    except Exception as e:
+        stats["errors"] += 1
+        print(f"DEBUG: Extractive scoring failed ({str(e)}), generating instead")
+        return None
+
+    best = int(np.argmax(scores))
+    best_score = float(scores[best])
+    margin = settings.RAG_EXTRACTIVE_MIN_MARGIN
+
+    # The runner-up is the best sentence that is not next to the best one
+    # (a neighbour may simply continue the answer)
+    distant = [score for i, score in enumerate(scores) if abs(i - best) > 1]
+    runner_up = float(max(distant)) if distant else -1.0
+
+    if best_score < settings.RAG_EXTRACTIVE_MIN_SIMILARITY or best_score - runner_up < margin:
+        stats["low_confidence"] += 1
+        print(f"DEBUG: Extractive answer rejected (similarity {best_score:.3f}, margin {best_score - runner_up:.3f})")
+        return None
+
+    # Extend the span over neighbouring sentences of the same chunk that
+    # score nearly as well (answers that run over two sentences)
+    chunk_start = 0
+    for chunk in chunks:
+        if best < chunk_start + len(chunk):
+            break
+        chunk_start += len(chunk)
+    chunk_end = chunk_start + len(chunk) - 1
+    first = last = best
+    if first > chunk_start and scores[first - 1] >= best_score - margin:
+        first -= 1
+    if last < chunk_end and scores[last + 1] >= best_score - margin:
+        last += 1
+
+    stats["answered"] += 1
+    print(f"DEBUG: Extractive answer (similarity {best_score:.3f}, margin {best_score - runner_up:.3f})")
+    return " ".join(sentences[first:last + 1])
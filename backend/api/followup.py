@@ -0,0 +1,158 @@
+"""
+Follow-up detection: does a question need the history rewrite?
+
+WHAT: Decides, before the rewrite LLM call, whether a question with chat
+      history refers back to it. Cheap cues come first:
+        - pronouns ("how many of them survived?")
+        - ellipsis ("and in first class?", "what about women?", "why?")
+        - very short questions
+      Everything else is searched as typed, including near repeats of the
+      previous question: restating it in full makes a question standalone.
+WHY:  The frontend sends the history with every question, so every turn of
+      a long chat paid for a rewrite, even "how many passengers survived?".
+
+When settings.RAG_FOLLOWUP_LOG_PATH is set, every decision is appended to
+it (JSON lines; off by default, rotated at RAG_FOLLOWUP_LOG_MAX_BYTES). A
+sample of the skipped rewrites (RAG_FOLLOWUP_AUDIT_RATE) is rewritten
+anyway on the background pool and scheduler lane, after the request has
+answered. The log records whether that rewrite added words the question
+didn't have, so `python manage.py followup_report` can estimate the
+false-negative rate. It is an upper bound: some added words are harmless
+rephrasing.
+"""
+
+import json
+import os
+import random
+import re
+import threading
+import time
+
+from django.conf import settings
+
+from api import deadline, stage_executor
+from api.ollama_scheduler import BACKGROUND
+
+PRONOUNS = {"it", "its", "they", "them", "their", "theirs", "he", "him", "his", "she", "her", "hers"}
+# Referring only at the edges of a question ("is that true?", "those in first class")
+DEMONSTRATIVES = {"this", "that", "these", "those", "there"}
+ELLIPSIS_STARTS = (
+    "and", "but", "or", "also", "so", "same", "why", "how come", "what about", "how about",
+    "what else", "anything else", "more", "then", "ok", "okay",
+)
+ELLIPSIS_WORDS = {"too", "instead", "else", "either", "rest", "same", "previous", "above", "former", "latter"}
+MIN_WORDS = 4
+
+# Words whose appearance in a rewrite says nothing about missing context
+STOPWORDS = {
+    "the", "a", "an", "of", "in", "on", "at", "to", "for", "is", "are", "was", "were", "be", "do", "does",
+    "did", "what", "how", "who", "which", "many", "much", "and", "or", "with", "by", "from", "as",
+}
+
+stats = {"rewrite": 0, "skipped": 0, "audited": 0, "audit_changed": 0}
+_log_lock = threading.Lock()
+
+
+def _words(text):
+    return re.findall(r"[a-z0-9']+", text.lower())
+
+
+def cues(question):
+    """Reasons the question looks like a follow-up (empty list: none)."""
+    words = _words(question)
+    phrase = " ".join(words)
+    found = []
+    if len(words) < MIN_WORDS:
+        found.append("short")
+    if PRONOUNS & set(words):
+        found.append("pronoun")
+    if words and (words[0] in DEMONSTRATIVES or words[-1] in DEMONSTRATIVES):
+        found.append("demonstrative")
+    if any(phrase == start or phrase.startswith(start + " ") for start in ELLIPSIS_STARTS) or ELLIPSIS_WORDS & set(words):
+        found.append("ellipsis")
+    return found
+
+
+def previous_user_turn(chat_history):
+    for message in reversed(chat_history):
+        if message.get("role") == "user" and message.get("content"):
+            return message["content"]
+    return chat_history[-1].get("content", "") if chat_history else ""
+
+
+def needs_rewrite(question, chat_history):
+    """
+    True when the question should go through the history rewrite. Returns
+    True without further checks when RAG_FOLLOWUP_DETECTION is off. Cheap
+    enough for the async path: no Ollama call.
+    """
+    if not settings.RAG_FOLLOWUP_DETECTION:
+        return True
+
+    previous = previous_user_turn(chat_history)
+    reasons = cues(question)
+    rewrite = bool(reasons)
+    stats["rewrite" if rewrite else "skipped"] += 1
+    print(
+        f"DEBUG: Follow-up detector: {'rewrite' if rewrite else 'standalone'} '{question}' "
+        f"({', '.join(reasons) or 'no cues'})"
+    )
+    entry = {
+        "time": time.time(),
+        "question": question,
+        "previous": previous,
+        "decision": "rewrite" if rewrite else "standalone",
+        "reasons": reasons,
+    }
+    audit = not rewrite and random.random() < settings.RAG_FOLLOWUP_AUDIT_RATE
+    if not audit or stage_executor.submit_background(_audit, entry, chat_history) is None:
+        _log(entry)
+    return rewrite
+
+
+def _audit(entry, chat_history):
+    """Shadow rewrite of a skipped question: did it need the history after all?"""
+    # Imported here: rag.py imports this module
+    from api.rag import clean_rewrite, rewrite_prompt
+    from api.ollama_service import generate_response
+
+    try:
+        # Runs after the request has answered: not bound by its deadline
+        with deadline.budget(None):
+            rewritten = clean_rewrite(generate_response(
+                rewrite_prompt(entry["question"], chat_history), task="rewrite", lane=BACKGROUND
+            ))
+    except Exception as e:
+        print(f"DEBUG: Follow-up audit rewrite failed ({str(e)})")
+        _log(entry)
+        return
+    added = sorted(set(_words(rewritten)) - set(_words(entry["question"])) - STOPWORDS)
+    stats["audited"] += 1
+    if added:
+        stats["audit_changed"] += 1
+    entry.update({"audit_rewrite": rewritten, "audit_added_words": added})
+    _log(entry)
+
+
+def _log(entry):
+    path = settings.RAG_FOLLOWUP_LOG_PATH
+    if not path:
+        return
+    line = json.dumps(entry)
+    with _log_lock:
+        try:
+            if os.path.exists(path) and os.path.getsize(path) >= settings.RAG_FOLLOWUP_LOG_MAX_BYTES:
+                # Keep one previous file; followup_report reads the current one
+                os.replace(path, path + ".1")
+            with open(path, "a", encoding="utf-8") as log:
+                log.write(line + "\n")
+        except OSError as e:
+            print(f"Follow-up decision log unavailable: {str(e)}")
+
+
+def snapshot():
+    data = dict(stats)
+    data["audit_false_negative_rate"] = (
+        round(stats["audit_changed"] / stats["audited"], 3) if stats["audited"] else None
+    )
+    return data
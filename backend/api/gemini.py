@@ -2,6 +2,7 @@ import os
 import json
 import google.generativeai as genai
 from django.db import connection
+from api.model_registry import gemini_generation_config
 
 genai.configure(api_key=os.getenv("GEMINI_API_KEY"))
 
@@ -92,10 +93,7 @@ def process_user_query(user_question):
         model = genai.GenerativeModel("models/gemini-2.5-flash")
         response = model.generate_content(
             prompt,
-            generation_config=genai.types.GenerationConfig(
-                temperature=0.1,
-                max_output_tokens=200
-            )
+            generation_config=genai.types.GenerationConfig(**gemini_generation_config("sql"))
         )
         
         if not response.text:
@@ -160,10 +158,7 @@ def format_response_with_gemini(question, columns, results):
         model = genai.GenerativeModel("models/gemini-2.5-flash")
         response = model.generate_content(
             prompt,
-            generation_config=genai.types.GenerationConfig(
-                temperature=0.3,
-                max_output_tokens=1000
-            )
+            generation_config=genai.types.GenerationConfig(**gemini_generation_config("answer"))
         )
         
         if response.text:
@@ -0,0 +1,293 @@
+"""
+Embedding-centroid intent classifier
+
+WHAT: Classifies a standalone question as database / knowledge /
+      conversational / irrelevant by cosine similarity between its embedding
+      and one centroid per category, averaged from labelled seed questions.
+WHY:  The query embedding is computed anyway for the answer cache and
+      retrieval, so most questions no longer need the LLM classification
+      prompt. Only low-margin questions fall back to the LLM.
+
+Greetings, thanks and farewells are recognised before any model call
+(pleasantry_kind) and answered with a fixed reply for their kind, so they
+cost no LLM or embedding call at all.
+
+Centroids are saved to settings.RAG_INTENT_CENTROIDS_PATH. Build them with
+`python manage.py intent_centroids build` at deploy time and after editing
+SEED_QUESTIONS or changing the embedding model. A worker that finds no
+up-to-date file builds it in the background (api/stage_executor.py) and
+leaves classification to the LLM meanwhile; requests never wait on it.
+"""
+
+import os
+import re
+import threading
+import time
+
+import numpy as np
+from django.conf import settings
+
+from api import stage_executor
+from api.ollama_service import EMBEDDING_MODEL, generate_embeddings
+
+SEED_QUESTIONS = {
+    "database": [
+        "How many passengers survived?",
+        "What is the total count of passengers?",
+        "How many passengers were in first class?",
+        "Count of male and female passengers",
+        "Show me details of women between 20 and 50",
+        "What was the average fare?",
+        "How many children were on board?",
+        "List passengers who embarked at Southampton",
+        "What is the survival rate of third class passengers?",
+        "How many men did not survive?",
+        "Who paid the highest fare?",
+        "How many passengers travelled with siblings or spouses?",
+    ],
+    "knowledge": [
+        "What is the leave policy?",
+        "How many days of annual leave do employees get?",
+        "What is the travel reimbursement policy?",
+        "What are the office working hours?",
+        "Can I work from home?",
+        "What is the notice period for resignation?",
+        "How do I apply for sick leave?",
+        "What is the dress code in the office?",
+        "What does the employment contract say about probation?",
+        "Who approves business travel?",
+        "What is the maternity leave policy?",
+        "What are the rules for using company equipment?",
+    ],
+    "conversational": [
+        "Hello",
+        "Hi there",
+        "Good morning",
+        "How are you?",
+        "Thank you",
+        "Thanks a lot",
+        "Nice to meet you",
+        "Goodbye",
+        "See you later",
+        "Have a nice day",
+    ],
+    "irrelevant": [
+        "What is the weather today?",
+        "Who won the football match yesterday?",
+        "Write me a poem about the sea",
+        "What is the capital of France?",
+        "How do I cook pasta?",
+        "Recommend a good movie",
+        "What is the price of bitcoin?",
+        "Tell me a joke",
+        "How far is the moon?",
+        "Translate hello into Spanish",
+    ],
+}
+
+# Short messages answered with a fixed reply, by kind
+PLEASANTRIES = {
+    "greeting": {
+        "hi", "hello", "hey", "hiya", "good morning", "good afternoon", "good evening", "how are you",
+    },
+    "thanks": {"thanks", "thank you", "cheers"},
+    "farewell": {"bye", "goodbye", "see you", "good night"},
+}
+GREETING_REPLY = (
+    "Hello! I can answer questions about the Titanic passenger data and about "
+    "company policy documents. What would you like to know?"
+)
+PLEASANTRY_REPLIES = {
+    "greeting": GREETING_REPLY,
+    "thanks": "You're welcome! Let me know if you have another question.",
+    "farewell": "Goodbye! Come back any time you have a question.",
+}
+
+stats = {"centroid": 0, "llm_fallback": 0, "greetings": 0}
+
+
+def pleasantry_kind(text):
+    """
+    "greeting", "thanks" or "farewell" for short messages that are only a
+    pleasantry, e.g. "Hi!", "hello there", "thanks a lot"; otherwise None.
+    Whole-phrase matching, so "hiring policy" or "history of the titanic"
+    are not greetings.
+    """
+    words = re.sub(r"[^a-z\s]", " ", text.lower()).split()
+    if not words or len(words) > 4:
+        return None
+    phrase = " ".join(words)
+    for kind, phrases in PLEASANTRIES.items():
+        if phrase in phrases:
+            return kind
+    # "hello there", "hi team", "thanks a lot"
+    if len(words) <= 3:
+        for kind, phrases in PLEASANTRIES.items():
+            if any(phrase.startswith(start + " ") for start in phrases):
+                return kind
+    return None
+
+
+def is_greeting(text):
+    return pleasantry_kind(text) is not None
+
+
+def greeting_reply(text):
+    """Fixed reply for a greeting, thanks or farewell (counted in stats), or None."""
+    if not settings.RAG_INTENT_CLASSIFIER:
+        return None
+    kind = pleasantry_kind(text)
+    if kind is None:
+        return None
+    stats["greetings"] += 1
+    return PLEASANTRY_REPLIES[kind]
+
+
+def _normalize(matrix):
+    matrix = np.asarray(matrix, dtype=np.float32)
+    norms = np.linalg.norm(matrix, axis=-1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return matrix / norms
+
+
+class CentroidClassifier:
+    def __init__(self, categories, centroids, model):
+        self.categories = list(categories)
+        self.centroids = _normalize(centroids)
+        self.model = model
+
+    @classmethod
+    def build(cls, seeds=None):
+        """Embeds the seed questions (one batched request) and averages them per category."""
+        seeds = seeds or SEED_QUESTIONS
+        categories = list(seeds)
+        texts = [question for category in categories for question in seeds[category]]
+        embeddings = _normalize(generate_embeddings(texts))
+
+        centroids, start = [], 0
+        for category in categories:
+            count = len(seeds[category])
+            centroids.append(embeddings[start:start + count].mean(axis=0))
+            start += count
+        return cls(categories, np.vstack(centroids), EMBEDDING_MODEL)
+
+    def save(self, path):
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        # np.savez appends .npz unless the name already ends with it
+        tmp = path + ".tmp.npz"
+        np.savez(tmp, categories=np.array(self.categories), centroids=self.centroids, model=np.array(self.model))
+        os.replace(tmp, path)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path, allow_pickle=False) as data:
+            return cls(data["categories"].tolist(), data["centroids"], str(data["model"]))
+
+    def scores(self, embedding):
+        """Cosine similarity of the embedding to each category centroid."""
+        return dict(zip(self.categories, (self.centroids @ _normalize(embedding)).tolist()))
+
+    def classify(self, embedding, min_margin=None, min_similarity=None):
+        """
+        Returns (category, similarity, margin). category is None when the
+        best centroid is not similar enough or not clearly ahead of the
+        runner-up, i.e. the caller should ask the LLM.
+        """
+        min_margin = settings.RAG_INTENT_MIN_MARGIN if min_margin is None else min_margin
+        min_similarity = settings.RAG_INTENT_MIN_SIMILARITY if min_similarity is None else min_similarity
+
+        ranked = sorted(self.scores(embedding).items(), key=lambda item: item[1], reverse=True)
+        (best, similarity), (_, runner_up) = ranked[0], ranked[1]
+        margin = similarity - runner_up
+        if similarity < min_similarity or margin < min_margin:
+            return None, similarity, margin
+        return best, similarity, margin
+
+
+_classifier = None
+_lock = threading.Lock()
+_building = False
+_failed_at = None
+
+
+def get_classifier(build=True):
+    """
+    Per-process classifier loaded from RAG_INTENT_CENTROIDS_PATH, or None.
+    Never calls Ollama itself: without an up-to-date centroid file it starts
+    one background build from SEED_QUESTIONS (build=True) and returns None
+    until the build has saved the file. A failed build is retried after
+    RAG_INTENT_BUILD_BACKOFF seconds, not on every request.
+    """
+    global _classifier, _building
+    if _classifier is not None:
+        return _classifier
+
+    with _lock:
+        if _classifier is not None or _building:
+            return _classifier
+        if _failed_at is not None and time.monotonic() - _failed_at < settings.RAG_INTENT_BUILD_BACKOFF:
+            return None
+        path = settings.RAG_INTENT_CENTROIDS_PATH
+        if os.path.exists(path):
+            classifier = CentroidClassifier.load(path)
+            if classifier.model == EMBEDDING_MODEL:
+                _classifier = classifier
+                return classifier
+        if not build:
+            return None
+        _building = True
+
+    if stage_executor.submit_background(_build, path) is None:
+        with _lock:
+            _building = False
+    return None
+
+
+def _build(path):
+    global _classifier, _building, _failed_at
+    try:
+        classifier = CentroidClassifier.build()
+        classifier.save(path)
+    except Exception as e:
+        print(f"Intent centroids could not be built ({str(e)}), retrying in {settings.RAG_INTENT_BUILD_BACKOFF}s")
+        with _lock:
+            _failed_at = time.monotonic()
+            _building = False
+        return
+    print(f"Intent centroids built and saved to {path}")
+    with _lock:
+        _classifier = classifier
+        _failed_at = None
+        _building = False
+
+
+def reset():
+    """Drops the loaded centroids so the next call reloads them from disk."""
+    global _classifier, _failed_at
+    with _lock:
+        _classifier = None
+        _failed_at = None
+
+
+def classify(embedding):
+    """
+    Category for a question embedding, or None when the LLM should decide.
+    Never raises: a missing/unbuildable centroid file also means None.
+    """
+    if not settings.RAG_INTENT_CLASSIFIER:
+        return None
+    try:
+        classifier = get_classifier()
+        if classifier is None:
+            category, similarity, margin = None, 0.0, 0.0
+        else:
+            category, similarity, margin = classifier.classify(embedding)
+    except Exception as e:
+        print(f"Intent classifier unavailable: {str(e)}")
+        category, similarity, margin = None, 0.0, 0.0
+
+    stats["centroid" if category else "llm_fallback"] += 1
+    print(f"DEBUG: Intent centroid -> {category or 'LLM fallback'} (similarity {similarity:.3f}, margin {margin:.3f})")
+    return category
@@ -0,0 +1,34 @@
+from django.core.management.base import BaseCommand
+from django.db import connection
+
+
+class Command(BaseCommand):
+    help = "Fill document_chunks.search_vector for rows created before the tsvector trigger existed"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000)
+        parser.add_argument('--all', action='store_true', help='Recompute every row, not only NULLs')
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+        where = "TRUE" if options['all'] else "search_vector IS NULL"
+
+        with connection.cursor() as cursor:
+            cursor.execute(f"SELECT COALESCE(MIN(id), 0), COALESCE(MAX(id), -1) FROM document_chunks WHERE {where}")
+            low, high = cursor.fetchone()
+
+        # Walk the primary key in ranges so each UPDATE is a short transaction
+        updated = 0
+        start = low
+        while start <= high:
+            with connection.cursor() as cursor:
+                cursor.execute(f"""
+                    UPDATE document_chunks
+                    SET search_vector = to_tsvector('english', content)
+                    WHERE id >= %s AND id < %s AND {where}
+                """, [start, start + batch_size])
+                updated += cursor.rowcount
+            start += batch_size
+            self.stdout.write(f"Processed ids < {min(start, high + 1)} ({updated} rows updated)...")
+
+        self.stdout.write(self.style.SUCCESS(f"Backfilled search_vector for {updated} chunks"))
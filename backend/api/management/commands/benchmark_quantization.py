@@ -0,0 +1,92 @@
+import re
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from api.rag import postgres_vector_leg_sql
+from api.vector_index import INDEX_NAME, METHODS, QUANTIZATIONS, build_named_index, drop_named_index, index_size
+
+INDEX_SCAN = re.compile(r"Index Scan using (\S+)")
+
+
+class Command(BaseCommand):
+    help = (
+        "Compare full-precision, halfvec and binary ANN indexes with exact search: index size, "
+        "build time, latency and recall@k. Builds one index per mode (blocks writes while building)."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--queries', type=int, default=50, help='Number of stored chunks used as sample queries')
+        parser.add_argument('--k', type=int, default=5)
+        parser.add_argument('--modes', default='none,halfvec,binary')
+        parser.add_argument('--method', choices=METHODS, default=settings.RAG_VECTOR_INDEX_METHOD)
+        parser.add_argument('--keep-indexes', action='store_true', help='Keep the per-mode indexes afterwards')
+
+    def handle(self, *args, **options):
+        k = options['k']
+        modes = [m for m in options['modes'].split(',') if m]
+        unknown = [m for m in modes if m not in QUANTIZATIONS]
+        if unknown:
+            raise CommandError(f"Unknown mode(s): {', '.join(unknown)}. Use: {', '.join(QUANTIZATIONS)}")
+
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT embedding::text FROM document_chunks ORDER BY random() LIMIT %s", [options['queries']])
+            queries = [row[0] for row in cursor.fetchall()]
+        if not queries:
+            self.stdout.write(self.style.WARNING("document_chunks is empty."))
+            return
+
+        exact, exact_seconds = self._run(queries, k, exact=True)
+        self.stdout.write(f"exact: {exact_seconds * 1000 / len(queries):.1f} ms/query (sequential scan)\n")
+
+        for mode in modes:
+            # Each mode gets an index on its own expression; without one the
+            # quantized ORDER BY would fall back to a sequential scan
+            name = f"{INDEX_NAME}_bench_{mode}"
+            build_seconds = build_named_index(name, options['method'], quantization=mode)
+            try:
+                used = self._index_used(queries[0], k, mode)
+                results, seconds = self._run(queries, k, quantization=mode)
+                size = index_size(name)
+            finally:
+                if not options['keep_indexes']:
+                    drop_named_index(name)
+
+            hits = sum(len(set(got) & set(want)) for got, want in zip(results, exact))
+            recall = hits / sum(len(want) for want in exact)
+            self.stdout.write(
+                f"{mode}: {options['method']} index {size / 1024 / 1024:.2f} MB, built in {build_seconds:.1f}s | "
+                f"recall@{k} {recall:.3f} | {seconds * 1000 / len(queries):.1f} ms/query"
+            )
+            if used is None:
+                self.stdout.write(self.style.WARNING(
+                    f"  the planner did not use an index for {mode} (table too small?): latency is a sequential scan"
+                ))
+            elif used != name:
+                self.stdout.write(f"  (planner used {used}, an equivalent index)")
+
+    def _query(self, embedding, k, quantization):
+        params = {"embedding": embedding, "pool": k}
+        sql = postgres_vector_leg_sql(params, quantization=quantization)
+        return f"SELECT id FROM ({sql}) v ORDER BY rnk", params
+
+    def _index_used(self, embedding, k, quantization):
+        sql, params = self._query(embedding, k, quantization)
+        with connection.cursor() as cursor:
+            cursor.execute(f"EXPLAIN {sql}", params)
+            plan = "\n".join(row[0] for row in cursor.fetchall())
+        match = INDEX_SCAN.search(plan)
+        return match.group(1) if match else None
+
+    def _run(self, queries, k, exact=False, quantization='none'):
+        results = []
+        started = time.perf_counter()
+        for embedding in queries:
+            sql, params = self._query(embedding, k, quantization)
+            with transaction.atomic(), connection.cursor() as cursor:
+                if exact:
+                    cursor.execute("SET LOCAL enable_indexscan = off")
+                cursor.execute(sql, params)
+                results.append([row[0] for row in cursor.fetchall()])
+        return results, time.perf_counter() - started
@@ -0,0 +1,51 @@
+import time
+
+import numpy as np
+from django.core.management.base import BaseCommand
+from django.db.backends.postgresql.psycopg_any import is_psycopg3
+
+from api.vector_db import vector_cursor
+
+
+class Command(BaseCommand):
+    help = "Micro-benchmark: query vector sent as a text-cast Python list vs. a binary NumPy array"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--iterations', type=int, default=200)
+        parser.add_argument('--dimensions', type=int, default=768)
+
+    def handle(self, *args, **options):
+        iterations = options['iterations']
+        embedding = np.random.default_rng(0).normal(size=options['dimensions']).astype(np.float32)
+        as_list = [float(v) for v in embedding]  # what ollama_service returns
+        as_text = f"[{','.join(str(v) for v in as_list)}]"  # how a list reaches `%s::vector`
+
+        if not is_psycopg3:
+            self.stdout.write(self.style.WARNING("psycopg2 in use: both variants are sent as text, expect no difference."))
+
+        text_payload = len(as_text)
+        binary_payload = 4 + 4 * len(embedding)
+        self.stdout.write(f"Payload per vector: text {text_payload} bytes, binary {binary_payload} bytes")
+
+        probes = [
+            ("parse only", "SELECT %s::vector IS NOT NULL"),
+            ("top-5 search", "SELECT id FROM document_chunks ORDER BY embedding <=> %s::vector LIMIT 5"),
+        ]
+        for label, sql in probes:
+            text_ms = self._time(sql, as_text, iterations)
+            binary_ms = self._time(sql, embedding, iterations)
+            self.stdout.write(
+                f"{label}: text {text_ms:.3f} ms/query | binary {binary_ms:.3f} ms/query "
+                f"| saved {text_ms - binary_ms:.3f} ms ({(1 - binary_ms / text_ms) * 100:.0f}%)"
+            )
+
+    def _time(self, sql, param, iterations):
+        # The cursor vector queries use (server-side binding under psycopg 3)
+        with vector_cursor() as cursor:
+            cursor.execute(sql, [param])  # warm up (plan cache, type lookup)
+            cursor.fetchall()
+            started = time.perf_counter()
+            for _ in range(iterations):
+                cursor.execute(sql, [param])
+                cursor.fetchall()
+        return (time.perf_counter() - started) * 1000 / iterations
@@ -0,0 +1,20 @@
+from django.core.management.base import BaseCommand
+from api.embedding_cache import get_cache
+
+
+class Command(BaseCommand):
+    help = "Show or clear the embedding cache"
+
+    def add_arguments(self, parser):
+        parser.add_argument('action', choices=['info', 'clear'])
+
+    def handle(self, *args, **options):
+        cache = get_cache()
+        if options['action'] == 'clear':
+            cache.clear()
+            self.stdout.write(self.style.SUCCESS("Embedding cache cleared"))
+            return
+
+        self.stdout.write(f"Persistent tier: {cache.path or 'disabled'}")
+        if cache.path:
+            self.stdout.write(f"Stored embeddings: {cache.disk_entries()} (cap {cache.max_disk_entries or 'none'})")
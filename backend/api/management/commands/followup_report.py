@@ -0,0 +1,50 @@
+import json
+from collections import Counter
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+
+class Command(BaseCommand):
+    help = "Summarize the follow-up detector's decision log and its estimated false-negative rate"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--path', help="Decision log (default: RAG_FOLLOWUP_LOG_PATH)")
+        parser.add_argument('--examples', type=int, default=10, help="Audited misses to print")
+
+    def handle(self, *args, **options):
+        path = options['path'] or settings.RAG_FOLLOWUP_LOG_PATH
+        if not path:
+            raise CommandError("No decision log: set RAG_FOLLOWUP_LOG_PATH or pass --path")
+        try:
+            with open(path, encoding="utf-8") as log:
+                entries = [json.loads(line) for line in log if line.strip()]
+        except FileNotFoundError:
+            raise CommandError(f"{path} does not exist yet")
+        if not entries:
+            self.stdout.write(self.style.WARNING("The decision log is empty."))
+            return
+
+        decisions = Counter(entry["decision"] for entry in entries)
+        reasons = Counter(reason for entry in entries for reason in entry["reasons"])
+        total = len(entries)
+        self.stdout.write(f"{total} questions with chat history ({path})")
+        for decision, count in decisions.most_common():
+            self.stdout.write(f"  {decision:<12} {count:6d} ({count * 100 / total:.1f}%)")
+        self.stdout.write("Rewrite reasons:")
+        for reason, count in reasons.most_common():
+            self.stdout.write(f"  {reason:<22} {count:6d}")
+
+        audited = [entry for entry in entries if "audit_rewrite" in entry]
+        missed = [entry for entry in audited if entry["audit_added_words"]]
+        if not audited:
+            self.stdout.write("No audited standalone decisions yet (RAG_FOLLOWUP_AUDIT_RATE).")
+            return
+        self.stdout.write(
+            f"Audited standalone decisions: {len(audited)}, rewrite added words to {len(missed)} "
+            f"-> estimated false-negative rate <= {len(missed) / len(audited):.1%}"
+        )
+        for entry in missed[:options['examples']]:
+            self.stdout.write(
+                f"  '{entry['question']}' -> '{entry['audit_rewrite']}' (added: {', '.join(entry['audit_added_words'])})"
+            )
@@ -0,0 +1,85 @@
+import json
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from api import intent_classifier
+from api.intent_classifier import CentroidClassifier, SEED_QUESTIONS
+from api.ollama_service import generate_embedding, generate_embeddings
+
+
+class Command(BaseCommand):
+    help = "Build, inspect or evaluate the embedding-centroid intent classifier"
+
+    def add_arguments(self, parser):
+        parser.add_argument('action', choices=['build', 'info', 'evaluate', 'classify'])
+        parser.add_argument('--seeds', help="JSON file {category: [questions]} replacing the built-in seed questions")
+        parser.add_argument('--question', help="Question to score (classify)")
+
+    def handle(self, *args, **options):
+        path = settings.RAG_INTENT_CENTROIDS_PATH
+        action = options['action']
+
+        if action == 'build':
+            seeds = self._seeds(options['seeds'])
+            classifier = CentroidClassifier.build(seeds)
+            classifier.save(path)
+            intent_classifier.reset()
+            counts = ", ".join(f"{category}: {len(questions)}" for category, questions in seeds.items())
+            self.stdout.write(self.style.SUCCESS(f"Centroids saved to {path} ({counts})"))
+            return
+
+        classifier = intent_classifier.get_classifier(build=False)
+        if classifier is None:
+            raise CommandError(f"No centroids for the current embedding model at {path}: run `intent_centroids build`")
+
+        if action == 'info':
+            self.stdout.write(f"Centroids: {path}")
+            self.stdout.write(f"Embedding model: {classifier.model}")
+            self.stdout.write(f"Categories: {', '.join(classifier.categories)}")
+            self.stdout.write(
+                f"Thresholds: similarity >= {settings.RAG_INTENT_MIN_SIMILARITY}, margin >= {settings.RAG_INTENT_MIN_MARGIN}"
+            )
+
+        elif action == 'classify':
+            if not options['question']:
+                raise CommandError("classify needs --question")
+            embedding = generate_embedding(options['question'])
+            scores = classifier.scores(embedding)
+            for category, score in sorted(scores.items(), key=lambda item: item[1], reverse=True):
+                self.stdout.write(f"  {category:<15} {score:.4f}")
+            category, similarity, margin = classifier.classify(embedding)
+            self.stdout.write(f"Decision: {category or 'LLM fallback'} (similarity {similarity:.4f}, margin {margin:.4f})")
+
+        elif action == 'evaluate':
+            # How the current thresholds treat labelled questions: decided correctly,
+            # decided wrongly, or sent to the LLM
+            seeds = self._seeds(options['seeds'])
+            labelled = [(category, question) for category, questions in seeds.items() for question in questions]
+            embeddings = generate_embeddings([question for _, question in labelled])
+
+            correct = wrong = fallback = 0
+            for (expected, question), embedding in zip(labelled, embeddings):
+                category, similarity, margin = classifier.classify(embedding)
+                if category is None:
+                    fallback += 1
+                elif category == expected:
+                    correct += 1
+                else:
+                    wrong += 1
+                    self.stdout.write(f"  wrong: '{question}' -> {category} (expected {expected}, margin {margin:.4f})")
+
+            total = len(labelled)
+            self.stdout.write(
+                f"{total} questions: {correct} correct, {wrong} wrong, {fallback} LLM fallback "
+                f"({(correct + wrong) / total:.0%} decided without the LLM)"
+            )
+
+    def _seeds(self, seeds_path):
+        if not seeds_path:
+            return SEED_QUESTIONS
+        with open(seeds_path) as f:
+            seeds = json.load(f)
+        if len(seeds) < 2 or not all(isinstance(questions, list) and questions for questions in seeds.values()):
+            raise CommandError("Seeds file must map at least two categories to non-empty question lists")
+        return seeds
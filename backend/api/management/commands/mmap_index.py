@@ -0,0 +1,29 @@
+from django.core.management.base import BaseCommand
+from api.mmap_index import get_index
+
+
+class Command(BaseCommand):
+    help = "Build, sync or inspect the memory-mapped vector index (RAG_RETRIEVAL_BACKEND=mmap)"
+
+    def add_arguments(self, parser):
+        parser.add_argument('action', choices=['build', 'sync', 'info'])
+
+    def handle(self, *args, **options):
+        index = get_index()
+        action = options['action']
+
+        if action == 'build':
+            count = index.build()
+            self.stdout.write(self.style.SUCCESS(f"Built vector index with {count} chunks"))
+        elif action == 'sync':
+            added, removed = index.sync()
+            self.stdout.write(self.style.SUCCESS(f"Synced vector index: {added} added, {removed} removed"))
+
+        info = index.info()
+        if info is None:
+            self.stdout.write(self.style.WARNING(f"No vector index at {index.path}. Run: python manage.py mmap_index build"))
+            return
+        self.stdout.write(
+            f"{index.path}: generation {info['generation']}, {info['count'] - info['deleted']} live rows "
+            f"({info['deleted']} deleted), {info['size_bytes'] / 1024 / 1024:.1f} MB"
+        )
@@ -0,0 +1,149 @@
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from api import model_registry
+from api.intent_classifier import SEED_QUESTIONS
+from api.ollama_router import get_router
+from api.rag import (
+    CATEGORY_DESCRIPTIONS, PROMPT_PREFIXES, classification_prompt, history_text, rewrite_and_classify_prompt,
+    rewrite_prompt, sql_prompt,
+)
+
+SAMPLE_HISTORY = [
+    {"role": "user", "content": "How many passengers survived?"},
+    {"role": "assistant", "content": "The answer is 342."},
+]
+
+# Routing prompts whose per-request part is just the question
+PROMPT_BUILDERS = {
+    "rewrite": lambda question: rewrite_prompt(question, SAMPLE_HISTORY),
+    "classify": classification_prompt,
+    "sql": sql_prompt,
+}
+
+
+
+def previous_rewrite_and_classify_prompt(question, chat_history):
+    # Layout before the JSON format moved into the static prefix (kept for `layout`)
+    return f"""
+Given the following conversation history and a follow-up question:
+1. Rephrase the follow-up question to be a standalone question that can be understood without the history.
+2. Classify the standalone question into ONE of the following categories:
+{CATEGORY_DESCRIPTIONS}
+
+Chat History:
+{history_text(chat_history)}
+
+Follow-up Question: {question}
+
+Respond with a JSON object only:
+{{"standalone_question": "<the rephrased question>", "category": "<one category>"}}
+"""
+
+
+class Command(BaseCommand):
+    help = (
+        "Warm Ollama's prompt cache with the static prompt prefixes, measure how much prefill "
+        "is reused when tasks run grouped vs interleaved, or compare the fused rewrite/classify "
+        "prompt layout with the previous one"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('action', choices=['warm', 'benchmark', 'layout'])
+        parser.add_argument('--tasks', default='rewrite,classify,sql')
+        parser.add_argument('--questions', type=int, default=10, help='Sample questions per task (benchmark)')
+
+    def handle(self, *args, **options):
+        tasks = [task for task in options['tasks'].split(',') if task]
+        unknown = [task for task in tasks if task not in PROMPT_PREFIXES]
+        if unknown:
+            raise CommandError(f"Unknown task(s): {', '.join(unknown)}. Use: {', '.join(PROMPT_PREFIXES)}")
+
+        if options['action'] == 'warm':
+            for task in tasks:
+                body, seconds = self._generate(PROMPT_PREFIXES[task], task, num_predict=1)
+                self.stdout.write(
+                    f"{task}: {body.get('prompt_eval_count', 0)} prefix tokens prefilled on "
+                    f"{model_registry.model_for(task)} in {seconds * 1000:.0f} ms"
+                )
+            return
+
+        if options['action'] == 'layout':
+            self._compare_layouts(options['questions'])
+            return
+
+        # Both passes use the prompts as rag.py builds them. Ollama only
+        # evaluates the tokens it could not reuse from its cache, so "tokens
+        # evaluated" shows how much of each prompt's prefix was reused.
+        questions = [question for seeds in SEED_QUESTIONS.values() for question in seeds][:options['questions']]
+        runnable = []
+        for task in tasks:
+            if task in PROMPT_BUILDERS:
+                runnable.append(task)
+            else:
+                self.stdout.write(self.style.WARNING(f"{task}: no sample prompt, skipped"))
+
+        # Grouped: one task's prompts back to back (best case for reuse)
+        grouped = {
+            task: [self._generate(PROMPT_BUILDERS[task](question), task) for question in questions]
+            for task in runnable
+        }
+        # Interleaved: every question goes through the tasks in turn, as in live traffic
+        interleaved = {task: [] for task in runnable}
+        for question in questions:
+            for task in runnable:
+                interleaved[task].append(self._generate(PROMPT_BUILDERS[task](question), task))
+
+        for task in runnable:
+            self.stdout.write(f"\n{task} ({model_registry.model_for(task)}, {len(questions)} questions)")
+            self._report("grouped", grouped[task])
+            self._report("interleaved", interleaved[task])
+
+    def _compare_layouts(self, count):
+        """
+        Runs the same follow-ups through the previous and the current fused
+        prompt, each layout back to back so the cache holds its own prefix.
+        Each follow-up has a different history, as in live traffic.
+        """
+        questions = [question for seeds in SEED_QUESTIONS.values() for question in seeds][:count + 1]
+        if len(questions) < 3:
+            raise CommandError("--questions must be at least 2 for layout")
+        followups = [
+            (question, [{"role": "user", "content": previous}, {"role": "assistant", "content": "The answer is 342."}])
+            for previous, question in zip(questions, questions[1:])
+        ]
+
+        self.stdout.write(f"rewrite+classify ({model_registry.model_for('rewrite')}, {len(followups)} follow-ups)")
+        for label, build in (("before", previous_rewrite_and_classify_prompt), ("after", rewrite_and_classify_prompt)):
+            runs = [self._generate(build(question, history), "rewrite", format="json") for question, history in followups]
+            # The first call primes the cache with this layout's prefix
+            self._report(label, runs[1:])
+
+    def _generate(self, prompt, task, num_predict=None, format=None):
+        options = model_registry.profile(task)
+        payload = {
+            "model": model_registry.model_for(task),
+            "prompt": prompt,
+            "stream": False,
+            "keep_alive": options.pop("keep_alive"),
+            "options": options,
+        }
+        if num_predict is not None:
+            options["num_predict"] = num_predict
+        if format:
+            payload["format"] = format
+            options.pop("stop", None)
+        started = time.perf_counter()
+        body = get_router().post("/api/generate", payload)
+        return body, time.perf_counter() - started
+
+    def _report(self, label, runs):
+        count = len(runs)
+        prompt_tokens = sum(body.get("prompt_eval_count", 0) for body, _ in runs) / count
+        prompt_eval_ms = sum(body.get("prompt_eval_duration", 0) for body, _ in runs) / count / 1e6
+        total_ms = sum(seconds for _, seconds in runs) / count * 1000
+        self.stdout.write(
+            f"  {label:<18} prompt eval {prompt_eval_ms:8.1f} ms ({prompt_tokens:.0f} tokens evaluated) | "
+            f"total {total_ms:8.1f} ms"
+        )
@@ -1,6 +1,5 @@
 from django.core.management.base import BaseCommand
-from api.models import Document
-from django.db import connection
+from api.rag import similarity_search
 
 
 class Command(BaseCommand):
@@ -8,38 +7,22 @@ class Command(BaseCommand):
 
     def add_arguments(self, parser):
         parser.add_argument('query', type=str, help='Search query')
-
-    def get_embedding(self, text):
-        """Create embedding from text"""
-        import hashlib
-        hash_obj = hashlib.sha256(text.encode())
-        hash_bytes = hash_obj.digest()
-        
-        embedding = []
-        for i in range(768):
-            embedding.append(float(hash_bytes[i % len(hash_bytes)]) / 255.0)
-        
-        return embedding
+        parser.add_argument('--source', type=str, default=None, help="Only search chunks with this metadata source (e.g. 'titanic')")
+        parser.add_argument('--document', type=int, action='append', dest='document_ids', help='Only search chunks of this document id (repeatable)')
+        parser.add_argument('--top-k', type=int, default=5)
 
     def handle(self, *args, **kwargs):
         query = kwargs['query']
         self.stdout.write(f"Searching for: {query}\n")
-        
-        query_embedding = self.get_embedding(query)
-        
-        with connection.cursor() as cursor:
-            cursor.execute("""
-                SELECT content, metadata, (embedding <-> %s::vector) as distance
-                FROM documents
-                WHERE metadata->>'source' = 'titanic'
-                ORDER BY distance
-                LIMIT 5
-            """, [query_embedding])
-            
-            results = cursor.fetchall()
-        
+
+        filters = {
+            'source': kwargs['source'],
+            'document_ids': kwargs['document_ids'],
+        }
+        results = similarity_search(query, top_k=kwargs['top_k'], filters={k: v for k, v in filters.items() if v})
+
         self.stdout.write(self.style.SUCCESS(f"Found {len(results)} results:\n"))
-        
-        for idx, (content, metadata, distance) in enumerate(results, 1):
-            self.stdout.write(f"\n{idx}. Distance: {distance:.4f}")
-            self.stdout.write(f"   {content[:100]}...")
+
+        for idx, doc in enumerate(results, 1):
+            self.stdout.write(f"\n{idx}. Distance: {doc['distance']:.4f} | Score: {doc['score']:.4f}")
+            self.stdout.write(f"   {doc['content'][:100]}...")
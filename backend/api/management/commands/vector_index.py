@@ -0,0 +1,67 @@
+from django.core.management.base import BaseCommand, CommandError
+from api import vector_index
+
+
+class Command(BaseCommand):
+    help = "Build, rebuild (concurrently), drop or report the ANN indexes on document_chunks.embedding"
+
+    def add_arguments(self, parser):
+        parser.add_argument('action', choices=['build', 'rebuild', 'drop', 'build-partial', 'drop-partial', 'report'])
+        parser.add_argument('--method', choices=vector_index.METHODS, help='Index type (default: settings.RAG_VECTOR_INDEX_METHOD)')
+        parser.add_argument('--m', type=int, help='HNSW: max connections per layer')
+        parser.add_argument('--ef-construction', type=int, help='HNSW: candidate list size while building')
+        parser.add_argument('--lists', type=int, help='IVFFlat: number of lists (default: derived from row count)')
+        parser.add_argument('--source', help="build-partial / drop-partial: metadata->>'source' value the index covers")
+        parser.add_argument('--quantization', choices=list(vector_index.QUANTIZATIONS), help='Index representation (default: settings.RAG_VECTOR_QUANTIZATION)')
+
+    def handle(self, *args, **options):
+        action = options['action']
+        build_kwargs = {
+            'method': options['method'],
+            'm': options['m'],
+            'ef_construction': options['ef_construction'],
+            'lists': options['lists'],
+            'quantization': options['quantization'],
+        }
+
+        try:
+            if action == 'build':
+                if vector_index.index_exists():
+                    self.stdout.write(self.style.WARNING(f"{vector_index.INDEX_NAME} already exists. Use 'rebuild' to replace it."))
+                else:
+                    seconds = vector_index.build_index(**build_kwargs)
+                    self.stdout.write(self.style.SUCCESS(f"Built {vector_index.INDEX_NAME} in {seconds:.2f}s"))
+            elif action == 'rebuild':
+                self.stdout.write("Rebuilding concurrently (searches keep using the old index)...")
+                seconds = vector_index.rebuild_index(**build_kwargs)
+                self.stdout.write(self.style.SUCCESS(f"Rebuilt {vector_index.INDEX_NAME} in {seconds:.2f}s"))
+            elif action == 'drop':
+                vector_index.drop_index()
+                self.stdout.write(self.style.SUCCESS(f"Dropped {vector_index.INDEX_NAME}"))
+            elif action == 'build-partial':
+                if not options['source']:
+                    raise CommandError("--source is required for build-partial")
+                name, seconds = vector_index.build_partial_index(options['source'], **build_kwargs)
+                self.stdout.write(self.style.SUCCESS(f"Built {name} in {seconds:.2f}s"))
+            elif action == 'drop-partial':
+                if not options['source']:
+                    raise CommandError("--source is required for drop-partial")
+                name = vector_index.drop_partial_index(options['source'])
+                self.stdout.write(self.style.SUCCESS(f"Dropped {name}"))
+        except ValueError as e:
+            raise CommandError(str(e))
+
+        self._report()
+
+    def _report(self):
+        report = vector_index.index_report()
+        if not report:
+            self.stdout.write(self.style.WARNING("No ANN index on document_chunks.embedding (searches will scan the whole table)."))
+            return
+
+        for idx in report:
+            build = f"{idx['build_seconds']:.2f}s" if idx['build_seconds'] is not None else "unknown"
+            self.stdout.write(
+                f"- {idx['name']}: {idx['method']} {idx['params']} | size {idx['size']} "
+                f"| build {build} | scans {idx['scans']}{'' if idx['valid'] else ' | INVALID'}"
+            )
@@ -0,0 +1,58 @@
+# Generated by Django 4.2.7 on 2026-10-18 09:00
+
+import json
+import time
+
+from django.db import migrations
+
+INDEX_NAME = "document_chunks_embedding_ann"
+PARAMS = {"m": 16, "ef_construction": 64, "quantization": "none"}
+
+
+def create_index(apps, schema_editor):
+    connection = schema_editor.connection
+    with connection.cursor() as cursor:
+        cursor.execute(
+            "SELECT i.indisvalid FROM pg_index i JOIN pg_class c ON c.oid = i.indexrelid WHERE c.relname = %s",
+            [INDEX_NAME],
+        )
+        row = cursor.fetchone()
+        if row and row[0]:
+            return
+        if row:
+            # Left invalid by an interrupted concurrent build
+            cursor.execute(f"DROP INDEX CONCURRENTLY IF EXISTS {INDEX_NAME}")
+
+        started = time.perf_counter()
+        cursor.execute(
+            f"CREATE INDEX CONCURRENTLY {INDEX_NAME} ON document_chunks "
+            f"USING hnsw (embedding vector_cosine_ops) "
+            f"WITH (m = {PARAMS['m']}, ef_construction = {PARAMS['ef_construction']})"
+        )
+        build_seconds = time.perf_counter() - started
+        # Same comment as api/vector_index.py writes, for `manage.py vector_index report`
+        comment = json.dumps({"method": "hnsw", "params": PARAMS, "build_seconds": round(build_seconds, 3)})
+        cursor.execute(connection.ops.compose_sql(f"COMMENT ON INDEX {INDEX_NAME} IS %s", [comment]))
+
+
+def drop_index(apps, schema_editor):
+    with schema_editor.connection.cursor() as cursor:
+        cursor.execute(f"DROP INDEX CONCURRENTLY IF EXISTS {INDEX_NAME}")
+
+
+class Migration(migrations.Migration):
+
+    # CREATE INDEX CONCURRENTLY can't run in a transaction; it doesn't block
+    # writes to document_chunks while the graph is built
+    atomic = False
+
+    dependencies = [
+        ('api', '0005_documentchunk'),
+    ]
+
+    # The ANN index is managed outside the model state (see api/vector_index.py
+    # and `manage.py vector_index`) so it can be rebuilt or switched between
+    # hnsw and ivfflat without new migrations.
+    operations = [
+        migrations.RunPython(create_index, drop_index),
+    ]
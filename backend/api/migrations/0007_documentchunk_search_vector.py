@@ -0,0 +1,35 @@
+# Generated by Django 4.2.7 on 2026-10-18 09:30
+
+import django.contrib.postgres.indexes
+import django.contrib.postgres.search
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0006_documentchunk_embedding_ann_index'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='documentchunk',
+            name='search_vector',
+            field=django.contrib.postgres.search.SearchVectorField(editable=False, null=True),
+        ),
+        migrations.AddIndex(
+            model_name='documentchunk',
+            index=django.contrib.postgres.indexes.GinIndex(fields=['search_vector'], name='document_chunks_search_gin'),
+        ),
+        # Keep search_vector in sync with content on every insert/update.
+        # Existing rows are filled by `manage.py backfill_search_vector`.
+        migrations.RunSQL(
+            sql="""
+                CREATE TRIGGER document_chunks_search_vector_update
+                BEFORE INSERT OR UPDATE OF content ON document_chunks
+                FOR EACH ROW EXECUTE FUNCTION
+                tsvector_update_trigger(search_vector, 'pg_catalog.english', content);
+            """,
+            reverse_sql="DROP TRIGGER IF EXISTS document_chunks_search_vector_update ON document_chunks;",
+        ),
+    ]
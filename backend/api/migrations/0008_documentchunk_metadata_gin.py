@@ -0,0 +1,18 @@
+# Generated by Django 4.2.7 on 2026-10-18 10:00
+
+import django.contrib.postgres.indexes
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0007_documentchunk_search_vector'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='documentchunk',
+            index=django.contrib.postgres.indexes.GinIndex(fields=['metadata'], name='document_chunks_metadata_gin', opclasses=['jsonb_path_ops']),
+        ),
+    ]
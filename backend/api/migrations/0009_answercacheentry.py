@@ -0,0 +1,35 @@
+# Generated by Django 4.2.7 on 2026-10-18 10:30
+
+from django.db import migrations, models
+import pgvector.django.vector
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0008_documentchunk_metadata_gin'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='AnswerCacheEntry',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('question', models.TextField()),
+                ('embedding', pgvector.django.vector.VectorField(dimensions=768)),
+                ('question_type', models.CharField(max_length=20)),
+                ('answer', models.TextField()),
+                ('corpus_generation', models.BigIntegerField()),
+                ('hits', models.IntegerField(default=0)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+            ],
+            options={
+                'db_table': 'answer_cache',
+            },
+        ),
+        # Bumped by api.answer_cache.invalidate() whenever documents change
+        migrations.RunSQL(
+            sql="CREATE SEQUENCE IF NOT EXISTS corpus_generation;",
+            reverse_sql="DROP SEQUENCE IF EXISTS corpus_generation;",
+        ),
+    ]
@@ -0,0 +1,22 @@
+# Generated by Django 4.2.7 on 2026-10-18 11:00
+
+from django.contrib.postgres.operations import AddIndexConcurrently
+from django.db import migrations
+import pgvector.django.indexes
+
+
+class Migration(migrations.Migration):
+
+    # Built without blocking answer cache stores
+    atomic = False
+
+    dependencies = [
+        ('api', '0009_answercacheentry'),
+    ]
+
+    operations = [
+        AddIndexConcurrently(
+            model_name='answercacheentry',
+            index=pgvector.django.indexes.HnswIndex(ef_construction=64, fields=['embedding'], m=16, name='answer_cache_embedding_hnsw', opclasses=['vector_cosine_ops']),
+        ),
+    ]
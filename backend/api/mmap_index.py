@@ -0,0 +1,300 @@
+"""
+In-process memory-mapped vector index (RAG_RETRIEVAL_BACKEND = "mmap")
+
+WHAT: Keeps every DocumentChunk embedding in a float32 matrix on disk that each
+      worker maps read-only with np.memmap, and answers top-k with one matmul
+      plus argpartition.
+WHY:  The OS page cache holds a single copy of the vectors for all gunicorn
+      workers, and ranking a query never leaves the process.
+
+Files in settings.RAG_MMAP_INDEX_DIR:
+  vectors-<gen>.f32   count x dim float32, rows L2-normalized
+  ids-<gen>.i64       count chunk ids, -1 marks a deleted row (tombstone)
+  meta.json           {"generation", "count", "dim", "deleted"}, replaced atomically
+
+Writers append rows past `count` and only then publish a new meta.json, so
+readers never see half-written rows. Deletes tombstone the id in place. Once
+tombstones pass COMPACT_RATIO the live rows are rewritten under a new
+generation and readers remap on their next search.
+"""
+
+import json
+import os
+from contextlib import contextmanager
+
+import numpy as np
+from django.conf import settings
+from django.db.models import Q
+
+from api.models import DocumentChunk
+
+try:
+    import fcntl
+except ImportError:  # Windows: single writer (management command / upload view) assumed
+    fcntl = None
+
+DIM = 768
+COMPACT_RATIO = 0.2
+BATCH_SIZE = 2000
+REFRESH_ATTEMPTS = 3
+
+
+def _normalize(matrix):
+    matrix = np.asarray(matrix, dtype=np.float32)
+    norms = np.linalg.norm(matrix, axis=-1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return matrix / norms
+
+
+class MmapVectorIndex:
+    def __init__(self, path):
+        self.path = str(path)
+        self._meta_mtime = None
+        self._meta = None
+        self._vectors = None
+        self._ids = None
+
+    # -------------------------
+    # Files
+    # -------------------------
+    def _file(self, kind, generation):
+        ext = "f32" if kind == "vectors" else "i64"
+        return os.path.join(self.path, f"{kind}-{generation}.{ext}")
+
+    def _meta_path(self):
+        return os.path.join(self.path, "meta.json")
+
+    def _read_meta(self):
+        try:
+            with open(self._meta_path()) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+
+    def _write_meta(self, meta):
+        tmp = self._meta_path() + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump(meta, f)
+        os.replace(tmp, self._meta_path())
+
+    @contextmanager
+    def _write_lock(self):
+        os.makedirs(self.path, exist_ok=True)
+        with open(os.path.join(self.path, "write.lock"), "a+") as fh:
+            if fcntl:
+                fcntl.flock(fh, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                if fcntl:
+                    fcntl.flock(fh, fcntl.LOCK_UN)
+
+    # -------------------------
+    # Reading
+    # -------------------------
+    def _refresh(self):
+        """
+        Remaps the files if another process published a new meta.json.
+
+        A compaction can publish a new generation and remove the one just
+        read from meta.json before it is mapped; meta.json is then read again.
+        If it keeps moving, searches stay on the generation already mapped.
+        """
+        for _ in range(REFRESH_ATTEMPTS):
+            try:
+                stat = os.stat(self._meta_path())
+            except FileNotFoundError:
+                self._meta = self._vectors = self._ids = None
+                return
+            # os.replace() gives every published meta.json a new inode
+            mtime = (stat.st_ino, stat.st_mtime_ns)
+            if mtime == self._meta_mtime:
+                return
+
+            meta = self._read_meta()
+            if meta is None:
+                continue
+            try:
+                self._vectors, self._ids = self._map(meta)
+            except FileNotFoundError:
+                continue
+            self._meta = meta
+            self._meta_mtime = mtime
+            return
+        print(f"DEBUG: Vector index in {self.path} changed while remapping, staying on generation "
+              f"{self._meta['generation'] if self._meta else None}")
+
+    def _map(self, meta):
+        count, dim, generation = meta["count"], meta["dim"], meta["generation"]
+        if not count:
+            return np.empty((0, dim), dtype=np.float32), np.empty((0,), dtype=np.int64)
+        vectors = np.memmap(self._file("vectors", generation), dtype=np.float32, mode="r", shape=(count, dim))
+        ids = np.memmap(self._file("ids", generation), dtype=np.int64, mode="r", shape=(count,))
+        return vectors, ids
+
+    def search(self, query_embedding, top_k):
+        """
+        Returns [(chunk_id, cosine_distance), ...] best first.
+        Raises RuntimeError if the index has not been built yet.
+        """
+        self._refresh()
+        if self._meta is None:
+            raise RuntimeError("Vector index not built. Run: python manage.py mmap_index build")
+        if not len(self._ids):
+            return []
+
+        query = _normalize(query_embedding)
+        scores = self._vectors @ query
+        scores[self._ids < 0] = -np.inf
+
+        k = min(top_k, len(scores))
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+        return [(int(self._ids[i]), float(1.0 - scores[i])) for i in top if self._ids[i] >= 0]
+
+    def info(self):
+        self._refresh()
+        if self._meta is None:
+            return None
+        meta = dict(self._meta)
+        meta["size_bytes"] = meta["count"] * (meta["dim"] * 4 + 8)
+        return meta
+
+    # -------------------------
+    # Writing
+    # -------------------------
+    def _append(self, meta, id_batches):
+        """Appends (ids, embeddings) batches after row `count` and returns rows written."""
+        generation, count, dim = meta["generation"], meta["count"], meta["dim"]
+        written = 0
+        with open(self._file("vectors", generation), "ab") as vf, open(self._file("ids", generation), "ab") as idf:
+            # Drop rows left behind by a writer that died before publishing meta.json
+            vf.truncate(count * dim * 4)
+            idf.truncate(count * 8)
+            for ids, embeddings in id_batches:
+                vf.write(_normalize(embeddings).tobytes())
+                idf.write(np.asarray(ids, dtype=np.int64).tobytes())
+                written += len(ids)
+        return written
+
+    def _db_batches(self, condition):
+        ids, embeddings = [], []
+        rows = DocumentChunk.objects.filter(condition).order_by("id").values_list("id", "embedding")
+        for chunk_id, embedding in rows.iterator(chunk_size=BATCH_SIZE):
+            ids.append(chunk_id)
+            embeddings.append(embedding)
+            if len(ids) == BATCH_SIZE:
+                yield ids, np.vstack(embeddings)
+                ids, embeddings = [], []
+        if ids:
+            yield ids, np.vstack(embeddings)
+
+    def build(self):
+        """Rewrites the whole index from document_chunks under a new generation."""
+        with self._write_lock():
+            old = self._read_meta()
+            meta = {"generation": (old["generation"] + 1) if old else 1, "count": 0, "dim": DIM, "deleted": 0}
+            for kind in ("vectors", "ids"):
+                open(self._file(kind, meta["generation"]), "wb").close()
+            meta["count"] = self._append(meta, self._db_batches(Q()))
+            self._write_meta(meta)
+            if old:
+                self._remove_generation(old["generation"])
+        return meta["count"]
+
+    def add(self, chunk_ids):
+        """Appends the given chunks (ids already in the index are skipped)."""
+        chunk_ids = set(chunk_ids)
+        if not chunk_ids:
+            return 0
+
+        with self._write_lock():
+            meta = self._read_meta()
+            if meta is None:
+                return 0  # nothing to extend; `mmap_index build` picks everything up
+            present = self._current_ids(meta)
+            missing = sorted(chunk_ids - set(present[present >= 0].tolist()))
+            if not missing:
+                return 0
+            added = self._append(meta, self._db_batches(Q(id__in=missing)))
+            meta["count"] += added
+            self._write_meta(meta)
+        return added
+
+    def remove(self, chunk_ids):
+        """Tombstones the given chunks; compacts when too many rows are dead."""
+        chunk_ids = np.asarray(sorted(set(chunk_ids)), dtype=np.int64)
+        if not len(chunk_ids):
+            return 0
+
+        with self._write_lock():
+            meta = self._read_meta()
+            if meta is None or not meta["count"]:
+                return 0
+            ids = np.memmap(self._file("ids", meta["generation"]), dtype=np.int64, mode="r+", shape=(meta["count"],))
+            mask = np.isin(ids, chunk_ids)
+            removed = int(mask.sum())
+            if removed:
+                ids[mask] = -1
+                ids.flush()
+            del ids
+            if removed:
+                meta["deleted"] += removed
+                if meta["deleted"] > meta["count"] * COMPACT_RATIO:
+                    old_generation = meta["generation"]
+                    meta = self._compact(meta)
+                    self._write_meta(meta)
+                    self._remove_generation(old_generation)
+                else:
+                    self._write_meta(meta)
+        return removed
+
+    def sync(self):
+        """Reconciles the index with document_chunks. Returns (added, removed)."""
+        meta = self._read_meta()
+        if meta is None:
+            return self.build(), 0
+
+        db_ids = set(DocumentChunk.objects.values_list("id", flat=True).iterator(chunk_size=BATCH_SIZE))
+        present = self._current_ids(meta)
+        index_ids = set(present[present >= 0].tolist())
+        removed = self.remove(index_ids - db_ids)
+        added = self.add(db_ids - index_ids)
+        return added, removed
+
+    def _current_ids(self, meta):
+        if not meta["count"]:
+            return np.empty((0,), dtype=np.int64)
+        return np.fromfile(self._file("ids", meta["generation"]), dtype=np.int64, count=meta["count"])
+
+    def _compact(self, meta):
+        generation, count, dim = meta["generation"], meta["count"], meta["dim"]
+        vectors = np.memmap(self._file("vectors", generation), dtype=np.float32, mode="r", shape=(count, dim))
+        ids = self._current_ids(meta)
+        live = ids >= 0
+
+        new_meta = {"generation": generation + 1, "count": int(live.sum()), "dim": dim, "deleted": 0}
+        vectors[live].tofile(self._file("vectors", new_meta["generation"]))
+        ids[live].tofile(self._file("ids", new_meta["generation"]))
+        del vectors
+        return new_meta
+
+    def _remove_generation(self, generation):
+        # Readers still mapping the old files keep working on POSIX; on Windows
+        # the unlink fails while mapped and the files are left for the next build.
+        for kind in ("vectors", "ids"):
+            try:
+                os.remove(self._file(kind, generation))
+            except OSError:
+                pass
+
+
+_index = None
+
+
+def get_index():
+    """Per-process index; the underlying pages are shared through the OS cache."""
+    global _index
+    if _index is None:
+        _index = MmapVectorIndex(settings.RAG_MMAP_INDEX_DIR)
+    return _index
@@ -0,0 +1,140 @@
+"""
+Per-task model registry for LLM generations
+
+WHAT: Maps each kind of LLM call (task) to the model and generation profile
+      it runs with, and keeps latency statistics per task. A profile holds
+      the output cap (num_predict), stop sequences, temperature, context
+      size (num_ctx) and keep_alive; settings.RAG_TASK_OPTIONS overrides any
+      of them per task. The Gemini path (api/gemini.py) uses the same
+      profiles through gemini_generation_config().
+WHY:  Rewriting and classification only need a tiny model and a handful of
+      output tokens; only the final answer benefits from a larger model and
+      a long completion. Per-task latency shows where the time goes when
+      trading quality against throughput.
+
+Tasks:
+  rewrite    follow-up -> standalone question (also the fused rewrite+classify)
+  classify   question category
+  sql        text-to-SQL for the titanic table
+  answer     final answer from retrieved passages
+  chitchat   reply to conversational input
+"""
+
+import threading
+from collections import deque
+
+from django.conf import settings
+
+from api.ollama_scheduler import GENERATE, SHORT
+
+TASKS = ("rewrite", "classify", "sql", "answer", "chitchat")
+DEFAULT_TASK = "answer"
+
+# Quick routing calls get the scheduler's priority lane
+TASK_LANES = {"rewrite": SHORT, "classify": SHORT}
+
+# Decode caps and stops per task. Stops are strings a valid output never
+# contains (they cut off a model that keeps talking); JSON-format calls drop
+# them because the grammar already ends the output.
+GENERATION_PROFILES = {
+    "rewrite": {"num_predict": 128, "stop": ["\n\n"], "temperature": 0.0},
+    "classify": {"num_predict": 10, "temperature": 0.0},
+    "sql": {"num_predict": 256, "stop": ["\nUser Question:"], "temperature": 0.0},
+    "answer": {"num_predict": 1024, "stop": ["\n### "], "temperature": 0.3},
+    "chitchat": {"num_predict": 128, "temperature": 0.7},
+}
+
+LATENCY_WINDOW = 500
+
+_lock = threading.Lock()
+_latency = {}
+
+
+def _check(task):
+    if task not in TASKS:
+        raise ValueError(f"Unknown LLM task '{task}'. Use one of: {', '.join(TASKS)}")
+
+
+def model_for(task):
+    _check(task)
+    return settings.RAG_TASK_MODELS.get(task) or settings.RAG_LLM_MODEL
+
+
+def profile(task):
+    """
+    The task's generation profile: Ollama options plus keep_alive.
+    num_ctx defaults to OLLAMA_NUM_CTX for every task because Ollama reloads
+    a model whenever a request asks for a different context size; only give
+    a task its own num_ctx when it also has its own model.
+    """
+    _check(task)
+    return {
+        "num_ctx": settings.OLLAMA_NUM_CTX,
+        "keep_alive": settings.OLLAMA_KEEP_ALIVE,
+        **GENERATION_PROFILES[task],
+        **settings.RAG_TASK_OPTIONS.get(task, {}),
+    }
+
+
+def gemini_generation_config(task):
+    """The task's profile as google.generativeai GenerationConfig arguments."""
+    options = profile(task)
+    config = {
+        "temperature": options["temperature"],
+        "max_output_tokens": options["num_predict"],
+    }
+    if options.get("stop"):
+        config["stop_sequences"] = options["stop"]
+    return config
+
+
+def lane_for(task):
+    return TASK_LANES.get(task, GENERATE)
+
+
+def record(task, model, seconds, body=None, failed=False):
+    """
+    Records one call. body is Ollama's final response object; its
+    prompt_eval / eval durations (ns) split prefill from decoding.
+    """
+    body = body or {}
+    with _lock:
+        entry = _latency.setdefault(task, {
+            "model": model,
+            "calls": 0,
+            "errors": 0,
+            "seconds": deque(maxlen=LATENCY_WINDOW),
+            "prompt_eval_seconds": 0.0,
+            "eval_seconds": 0.0,
+            "eval_tokens": 0,
+        })
+        entry["model"] = model
+        entry["calls"] += 1
+        if failed:
+            entry["errors"] += 1
+            return
+        entry["seconds"].append(seconds)
+        entry["prompt_eval_seconds"] += body.get("prompt_eval_duration", 0) / 1e9
+        entry["eval_seconds"] += body.get("eval_duration", 0) / 1e9
+        entry["eval_tokens"] += body.get("eval_count", 0)
+
+
+def latency_report():
+    """Per-task latency over the last LATENCY_WINDOW calls of this worker."""
+    report = {}
+    with _lock:
+        for task, entry in _latency.items():
+            samples = sorted(entry["seconds"])
+            succeeded = entry["calls"] - entry["errors"]
+            report[task] = {
+                "model": entry["model"],
+                "calls": entry["calls"],
+                "errors": entry["errors"],
+                "avg_seconds": round(sum(samples) / len(samples), 3) if samples else None,
+                "p50_seconds": round(samples[len(samples) // 2], 3) if samples else None,
+                "p95_seconds": round(samples[min(len(samples) - 1, int(len(samples) * 0.95))], 3) if samples else None,
+                "avg_prompt_eval_seconds": round(entry["prompt_eval_seconds"] / succeeded, 3) if succeeded else None,
+                "avg_eval_seconds": round(entry["eval_seconds"] / succeeded, 3) if succeeded else None,
+                "avg_output_tokens": round(entry["eval_tokens"] / succeeded, 1) if succeeded else None,
+            }
+    return report
@@ -1,7 +1,9 @@
 from django.db import models
 from django.contrib.auth.models import AbstractUser
 import uuid
-from pgvector.django import VectorField
+from django.contrib.postgres.indexes import GinIndex
+from django.contrib.postgres.search import SearchVectorField
+from pgvector.django import HnswIndex, VectorField
 
 class User(AbstractUser):
     id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
@@ -78,6 +80,32 @@ class DocumentChunk(models.Model):
     content = models.TextField()
     embedding = VectorField(dimensions=768)
     metadata = models.JSONField(default=dict)
+    # Maintained by a DB trigger (see migration 0007) from `content`
+    search_vector = SearchVectorField(null=True, editable=False)
 
     class Meta:
         db_table = 'document_chunks'
+        indexes = [
+            GinIndex(fields=['search_vector'], name='document_chunks_search_gin'),
+            GinIndex(fields=['metadata'], name='document_chunks_metadata_gin', opclasses=['jsonb_path_ops']),
+        ]
+
+class AnswerCacheEntry(models.Model):
+    question = models.TextField()
+    embedding = VectorField(dimensions=768)
+    question_type = models.CharField(max_length=20)
+    answer = models.TextField()
+    # Value of the corpus_generation sequence when the answer was computed
+    corpus_generation = models.BigIntegerField()
+    hits = models.IntegerField(default=0)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        db_table = 'answer_cache'
+        indexes = [
+            # Nearest cached question without scanning the table (api/answer_cache.lookup)
+            HnswIndex(
+                fields=['embedding'], name='answer_cache_embedding_hnsw', m=16, ef_construction=64,
+                opclasses=['vector_cosine_ops'],
+            ),
+        ]
@@ -0,0 +1,309 @@
+"""
+Shared HTTP client for Ollama
+
+WHAT: One requests.Session per worker with a keep-alive connection pool,
+      connect/read timeouts and bounded retries with jittered backoff.
+WHY:  The module-level requests.post opened a new TCP connection per call and
+      had no timeout, so a stuck Ollama held a Django worker forever.
+
+stats() splits the time spent per call into connection setup (TCP connects
+made by the pool), inference (Ollama's reported total_duration) and the
+rest (queueing, transfer, JSON).
+
+AsyncOllamaClient is the asyncio twin used by the async chat path
+(rag.arag_query): same pool size, timeouts and retry policy on httpx, so one
+ASGI process can keep hundreds of requests waiting on the model.
+
+There is one client per Ollama host; api/ollama_router.py owns them.
+"""
+
+import asyncio
+import json
+import random
+import threading
+import time
+
+import httpx
+import requests
+from django.conf import settings
+from requests.adapters import HTTPAdapter
+from urllib3.connection import HTTPConnection, HTTPSConnection
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+
+RETRY_STATUSES = (500, 502, 503, 504)
+
+_stats_lock = threading.Lock()
+
+
+class _ClientStats:
+    def __init__(self):
+        self._stats = {
+            "requests": 0,
+            "retries": 0,
+            "failures": 0,
+            "connections_opened": 0,
+            "connect_seconds": 0.0,
+            "request_seconds": 0.0,
+            "inference_seconds": 0.0,
+        }
+
+    def _record(self, **values):
+        with _stats_lock:
+            for key, value in values.items():
+                self._stats[key] += value
+
+    def _retry_delay(self, attempt):
+        # Full jitter: spread retries from many workers over the window
+        return random.uniform(0, self.backoff * 2 ** attempt)
+
+    def stats(self):
+        with _stats_lock:
+            stats = dict(self._stats)
+        overhead = stats["request_seconds"] - stats["inference_seconds"] - stats["connect_seconds"]
+        stats["other_seconds"] = round(max(overhead, 0.0), 3)
+        for key in ("connect_seconds", "request_seconds", "inference_seconds"):
+            stats[key] = round(stats[key], 3)
+        return stats
+
+
+class OllamaClient(_ClientStats):
+    def __init__(self, base_url, pool_size, connect_timeout, read_timeout, max_retries, backoff):
+        super().__init__()
+        self.base_url = base_url.rstrip("/")
+        self.timeout = (connect_timeout, read_timeout)
+        self.max_retries = max_retries
+        self.backoff = backoff
+
+        self.session = requests.Session()
+        adapter = _TimedAdapter(self, pool_connections=1, pool_maxsize=pool_size, pool_block=False)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+    def _send(self, path, payload, timeout=None, stream=False):
+        """
+        POSTs JSON and returns the successful response. Retries connection
+        errors and 5xx responses up to max_retries times; raises requests
+        exceptions (HTTPError carries the response) once retries are exhausted.
+        """
+        url = f"{self.base_url}{path}"
+        attempt = 0
+        while True:
+            started = time.perf_counter()
+            try:
+                response = self.session.post(url, json=payload, timeout=timeout or self.timeout, stream=stream)
+                if response.status_code in RETRY_STATUSES and attempt < self.max_retries:
+                    response.close()
+                    raise _Retryable(response)
+                response.raise_for_status()
+                return response, started
+            except (requests.exceptions.ConnectionError, _Retryable):
+                self._record(request_seconds=time.perf_counter() - started)
+                if attempt >= self.max_retries:
+                    self._record(failures=1)
+                    raise
+                attempt += 1
+                self._record(retries=1)
+                time.sleep(self._retry_delay(attempt))
+            except requests.exceptions.RequestException:
+                self._record(failures=1, request_seconds=time.perf_counter() - started)
+                raise
+
+    def get(self, path, timeout=None):
+        """Plain GET without retries (health probes)."""
+        response = self.session.get(f"{self.base_url}{path}", timeout=timeout or self.timeout)
+        response.raise_for_status()
+        return response.json()
+
+    def post(self, path, payload, timeout=None):
+        """POSTs JSON and returns the decoded body (retry policy as in _send)."""
+        response, started = self._send(path, payload, timeout)
+        body = response.json()
+        self._record(
+            requests=1,
+            request_seconds=time.perf_counter() - started,
+            inference_seconds=body.get("total_duration", 0) / 1e9,
+        )
+        return body
+
+    def stream(self, path, payload, timeout=None):
+        """
+        POSTs JSON with "stream": true and yields each decoded NDJSON line.
+        Retries only happen before the response starts; once lines have been
+        yielded, errors propagate to the caller. An {"error": ...} line
+        raises RuntimeError.
+        """
+        response, started = self._send(path, {**payload, "stream": True}, timeout, stream=True)
+        with response:
+            for line in response.iter_lines():
+                if not line:
+                    continue
+                chunk = json.loads(line)
+                if "error" in chunk:
+                    self._record(failures=1, request_seconds=time.perf_counter() - started)
+                    raise RuntimeError(chunk["error"])
+                if chunk.get("done"):
+                    self._record(
+                        requests=1,
+                        request_seconds=time.perf_counter() - started,
+                        inference_seconds=chunk.get("total_duration", 0) / 1e9,
+                    )
+                yield chunk
+
+
+class AsyncOllamaClient(_ClientStats):
+    def __init__(self, base_url, pool_size, connect_timeout, read_timeout, max_retries, backoff):
+        super().__init__()
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.client = httpx.AsyncClient(
+            base_url=base_url.rstrip("/"),
+            timeout=httpx.Timeout(read_timeout, connect=connect_timeout),
+            limits=httpx.Limits(max_connections=None, max_keepalive_connections=pool_size),
+        )
+        self._connect_started = {}
+
+    async def _trace(self, event, info):
+        # httpcore trace hook: time TCP connects the pool had to make
+        if event == "connection.connect_tcp.started":
+            self._connect_started[asyncio.current_task()] = time.perf_counter()
+        elif event == "connection.connect_tcp.complete":
+            started = self._connect_started.pop(asyncio.current_task(), None)
+            if started is not None:
+                self._record(connections_opened=1, connect_seconds=time.perf_counter() - started)
+
+    async def post(self, path, payload, timeout=None):
+        """
+        Async version of OllamaClient.post. Raises httpx exceptions
+        (HTTPStatusError carries the response) once retries are exhausted.
+        """
+        attempt = 0
+        while True:
+            started = time.perf_counter()
+            try:
+                response = await self.client.post(
+                    path, json=payload, timeout=timeout or httpx.USE_CLIENT_DEFAULT,
+                    extensions={"trace": self._trace},
+                )
+                if response.status_code in RETRY_STATUSES and attempt < self.max_retries:
+                    raise _Retryable(response)
+                response.raise_for_status()
+                body = response.json()
+                self._record(
+                    requests=1,
+                    request_seconds=time.perf_counter() - started,
+                    inference_seconds=body.get("total_duration", 0) / 1e9,
+                )
+                return body
+            except (httpx.TransportError, _Retryable) as e:
+                self._record(request_seconds=time.perf_counter() - started)
+                # Read/write timeouts are not retried: the request may still be running on Ollama
+                timed_out = isinstance(e, httpx.TimeoutException) and not isinstance(e, httpx.ConnectTimeout)
+                if timed_out or attempt >= self.max_retries:
+                    self._record(failures=1)
+                    raise
+                attempt += 1
+                self._record(retries=1)
+                await asyncio.sleep(self._retry_delay(attempt))
+            except httpx.HTTPError:
+                self._record(failures=1, request_seconds=time.perf_counter() - started)
+                raise
+
+
+    async def stream(self, path, payload, timeout=None):
+        """
+        Async version of OllamaClient.stream: yields each decoded NDJSON line.
+        Retries only happen before the response starts.
+        """
+        attempt = 0
+        while True:
+            started = time.perf_counter()
+            request = self.client.build_request(
+                "POST", path, json={**payload, "stream": True}, timeout=timeout or httpx.USE_CLIENT_DEFAULT,
+                extensions={"trace": self._trace},
+            )
+            try:
+                response = await self.client.send(request, stream=True)
+                if response.status_code in RETRY_STATUSES and attempt < self.max_retries:
+                    await response.aclose()
+                    raise _Retryable(response)
+                if response.is_error:
+                    # Read the body so the caller can report Ollama's error message
+                    await response.aread()
+                    await response.aclose()
+                    response.raise_for_status()
+                break
+            except (httpx.TransportError, _Retryable) as e:
+                self._record(request_seconds=time.perf_counter() - started)
+                timed_out = isinstance(e, httpx.TimeoutException) and not isinstance(e, httpx.ConnectTimeout)
+                if timed_out or attempt >= self.max_retries:
+                    self._record(failures=1)
+                    raise
+                attempt += 1
+                self._record(retries=1)
+                await asyncio.sleep(self._retry_delay(attempt))
+            except httpx.HTTPError:
+                self._record(failures=1, request_seconds=time.perf_counter() - started)
+                raise
+
+        try:
+            async for line in response.aiter_lines():
+                if not line:
+                    continue
+                chunk = json.loads(line)
+                if "error" in chunk:
+                    self._record(failures=1, request_seconds=time.perf_counter() - started)
+                    raise RuntimeError(chunk["error"])
+                if chunk.get("done"):
+                    self._record(
+                        requests=1,
+                        request_seconds=time.perf_counter() - started,
+                        inference_seconds=chunk.get("total_duration", 0) / 1e9,
+                    )
+                yield chunk
+        finally:
+            await response.aclose()
+
+
+class _Retryable(Exception):
+    def __init__(self, response):
+        super().__init__(f"{response.status_code} from Ollama")
+        self.response = response
+
+
+class _TimedAdapter(HTTPAdapter):
+    """HTTPAdapter whose pools time every new TCP connection."""
+
+    def __init__(self, client, **kwargs):
+        self._client = client
+        super().__init__(**kwargs)
+
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        client = self._client
+
+        def timed(connection_cls):
+            class TimedConnection(connection_cls):
+                def connect(self):
+                    started = time.perf_counter()
+                    super().connect()
+                    client._record(connections_opened=1, connect_seconds=time.perf_counter() - started)
+            return TimedConnection
+
+        class TimedHTTPPool(HTTPConnectionPool):
+            ConnectionCls = timed(HTTPConnection)
+
+        class TimedHTTPSPool(HTTPSConnectionPool):
+            ConnectionCls = timed(HTTPSConnection)
+
+        self.poolmanager.pool_classes_by_scheme = {"http": TimedHTTPPool, "https": TimedHTTPSPool}
+
+
+def client_options():
+    """Pool, timeout and retry settings shared by every client (see api/ollama_router.py)."""
+    return {
+        "pool_size": settings.OLLAMA_POOL_SIZE,
+        "connect_timeout": settings.OLLAMA_CONNECT_TIMEOUT,
+        "read_timeout": settings.OLLAMA_READ_TIMEOUT,
+        "max_retries": settings.OLLAMA_MAX_RETRIES,
+        "backoff": settings.OLLAMA_RETRY_BACKOFF,
+    }
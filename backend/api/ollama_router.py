@@ -0,0 +1,332 @@
+"""
+Multi-host Ollama routing
+
+WHAT: Spreads Ollama calls over the hosts in settings.OLLAMA_HOSTS. Each call
+      goes to a healthy host, chosen by fewest outstanding requests
+      ("least_outstanding") or by latency EWMA weighted by load ("ewma"). A
+      host that already has the model loaded is preferred unless it has more
+      than warm_slack requests outstanding beyond the best cold host (so one
+      warm host doesn't take all the traffic while the others idle). Hosts that keep failing are
+      ejected until a background probe of /api/ps succeeds again; the same
+      probe refreshes which models each host has loaded. Embedding calls are
+      idempotent and are retried on another host when one fails.
+WHY:  A single hard-coded http://localhost:11434 can't scale generation past
+      one box, and one dead box shouldn't fail every chat.
+
+Each host has its own pooled OllamaClient / AsyncOllamaClient
+(api/ollama_client.py), so per-host retries and timeouts still apply before
+the router fails over. With one host configured the router only adds
+bookkeeping. httpx connections belong to the event loop that opened them, so
+every async request runs on one long-lived I/O loop thread per process,
+whichever loop awaits it: async_to_sync opens a new loop per call, and a
+client per loop would leak its connections when the loop closes.
+"""
+
+import asyncio
+import random
+import threading
+import time
+
+import httpx
+import requests
+from django.conf import settings
+
+from api.ollama_client import AsyncOllamaClient, OllamaClient, client_options
+
+# Requests that may be sent to a second host after a failure
+IDEMPOTENT_PATHS = ("/api/embeddings", "/api/embed")
+
+EWMA_ALPHA = 0.3
+PROBE_TIMEOUT = 2.0
+
+
+class NoHealthyHost(Exception):
+    pass
+
+
+def is_host_failure(error):
+    """True for errors that say something about the host (not about the request)."""
+    if isinstance(error, (requests.exceptions.ConnectionError, requests.exceptions.Timeout,
+                          httpx.TransportError)):
+        return True
+    response = getattr(error, "response", None)
+    return response is not None and response.status_code >= 500
+
+
+_io_loop = None
+_io_loop_lock = threading.Lock()
+
+
+def io_loop():
+    """The event loop thread that owns every AsyncOllamaClient connection."""
+    global _io_loop
+    with _io_loop_lock:
+        if _io_loop is None:
+            _io_loop = asyncio.new_event_loop()
+            threading.Thread(target=_io_loop.run_forever, name="ollama-async-io", daemon=True).start()
+    return _io_loop
+
+
+class Host:
+    def __init__(self, url, options):
+        self.url = url.rstrip("/")
+        self.client = OllamaClient(self.url, **options)
+        self.async_client = AsyncOllamaClient(self.url, **options)
+        self.outstanding = 0
+        self.ewma_seconds = None
+        self.consecutive_failures = 0
+        self.ejected = False
+        self.models = set()
+        self.last_probe = None
+
+    async def apost(self, path, payload, timeout=None):
+        # Cancelling the awaiting task cancels the request on the I/O loop too
+        future = asyncio.run_coroutine_threadsafe(self.async_client.post(path, payload, timeout), io_loop())
+        return await asyncio.wrap_future(future)
+
+    async def astream(self, path, payload, timeout=None):
+        """Relays AsyncOllamaClient.stream from the I/O loop to the calling loop."""
+        loop = asyncio.get_running_loop()
+        queue = asyncio.Queue()
+
+        async def pump():
+            try:
+                async for chunk in self.async_client.stream(path, payload, timeout):
+                    loop.call_soon_threadsafe(queue.put_nowait, (chunk, None))
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                loop.call_soon_threadsafe(queue.put_nowait, (None, e))
+                return
+            loop.call_soon_threadsafe(queue.put_nowait, (None, None))
+
+        future = asyncio.run_coroutine_threadsafe(pump(), io_loop())
+        try:
+            while True:
+                chunk, error = await queue.get()
+                if error is not None:
+                    raise error
+                if chunk is None:
+                    return
+                yield chunk
+        finally:
+            # Consumer stopped early: stop reading from Ollama too
+            future.cancel()
+
+    def info(self):
+        return {
+            "url": self.url,
+            "healthy": not self.ejected,
+            "outstanding": self.outstanding,
+            "ewma_ms": round(self.ewma_seconds * 1000, 1) if self.ewma_seconds is not None else None,
+            "consecutive_failures": self.consecutive_failures,
+            "loaded_models": sorted(self.models),
+            "last_probe": self.last_probe,
+            "client": self.client.stats(),
+            "async_client": self.async_client.stats(),
+        }
+
+
+class OllamaRouter:
+    def __init__(self, urls, strategy="least_outstanding", eject_after=3, probe_interval=10.0, warm_slack=2,
+                 options=None):
+        if not urls:
+            raise ValueError("OllamaRouter needs at least one host")
+        options = options or client_options()
+        self.hosts = [Host(url, options) for url in urls]
+        self.strategy = strategy
+        self.eject_after = eject_after
+        self.probe_interval = probe_interval
+        self.warm_slack = warm_slack
+        self._lock = threading.Lock()
+        self._prober = None
+        self.failovers = 0
+
+    # -------------------------
+    # Host selection and bookkeeping
+    # -------------------------
+    def _cost(self, host):
+        if self.strategy == "ewma":
+            # Unmeasured hosts look fast so they get tried
+            return (host.ewma_seconds or 0.0) * (host.outstanding + 1), random.random()
+        return host.outstanding, host.ewma_seconds or 0.0, random.random()
+
+    def pick(self, model=None, exclude=()):
+        with self._lock:
+            candidates = [host for host in self.hosts if host not in exclude]
+            if not candidates:
+                raise NoHealthyHost("All Ollama hosts failed for this request")
+            # If every host is ejected, fail open rather than refuse all traffic
+            healthy = [host for host in candidates if not host.ejected] or candidates
+            warm = [host for host in healthy if model in host.models]
+            cold = [host for host in healthy if model not in host.models]
+            best_warm = min(warm, key=self._cost) if warm else None
+            best_cold = min(cold, key=self._cost) if cold else None
+            if best_warm and (best_cold is None or best_warm.outstanding <= best_cold.outstanding + self.warm_slack):
+                host = best_warm
+            else:
+                host = best_cold
+            host.outstanding += 1
+            return host
+
+    def _finish(self, host, seconds=None, model=None, failed=False):
+        with self._lock:
+            host.outstanding -= 1
+            if failed:
+                host.consecutive_failures += 1
+                if host.consecutive_failures >= self.eject_after and not host.ejected:
+                    host.ejected = True
+                    print(f"Ollama host {host.url} ejected after {host.consecutive_failures} failures")
+                return
+            host.consecutive_failures = 0
+            if seconds is not None:
+                host.ewma_seconds = seconds if host.ewma_seconds is None else (
+                    host.ewma_seconds + EWMA_ALPHA * (seconds - host.ewma_seconds)
+                )
+            if model:
+                # A successful call leaves the model loaded on that host
+                host.models.add(model)
+
+    # -------------------------
+    # Requests (same interface as OllamaClient / AsyncOllamaClient)
+    # -------------------------
+    def post(self, path, payload, timeout=None):
+        model = payload.get("model")
+        tried = []
+        while True:
+            host = self.pick(model, exclude=tried)
+            started = time.perf_counter()
+            try:
+                body = host.client.post(path, payload, timeout)
+            except Exception as e:
+                failed = is_host_failure(e)
+                self._finish(host, failed=failed)
+                tried.append(host)
+                if failed and path in IDEMPOTENT_PATHS and len(tried) < len(self.hosts):
+                    self.failovers += 1
+                    print(f"Ollama host {host.url} failed ({str(e)}), retrying on another host")
+                    continue
+                raise
+            self._finish(host, time.perf_counter() - started, model)
+            return body
+
+    def stream(self, path, payload, timeout=None):
+        model = payload.get("model")
+        host = self.pick(model)
+        started = time.perf_counter()
+        try:
+            yield from host.client.stream(path, payload, timeout)
+        except Exception as e:
+            self._finish(host, failed=is_host_failure(e))
+            raise
+        except GeneratorExit:
+            # Consumer stopped early (client disconnected); not the host's fault
+            self._finish(host)
+            raise
+        self._finish(host, time.perf_counter() - started, model)
+
+    async def apost(self, path, payload, timeout=None):
+        model = payload.get("model")
+        tried = []
+        while True:
+            host = self.pick(model, exclude=tried)
+            started = time.perf_counter()
+            try:
+                body = await host.apost(path, payload, timeout)
+            except Exception as e:
+                failed = is_host_failure(e)
+                self._finish(host, failed=failed)
+                tried.append(host)
+                if failed and path in IDEMPOTENT_PATHS and len(tried) < len(self.hosts):
+                    self.failovers += 1
+                    print(f"Ollama host {host.url} failed ({str(e)}), retrying on another host")
+                    continue
+                raise
+            except asyncio.CancelledError:
+                self._finish(host)
+                raise
+            self._finish(host, time.perf_counter() - started, model)
+            return body
+
+    async def astream(self, path, payload, timeout=None):
+        model = payload.get("model")
+        host = self.pick(model)
+        started = time.perf_counter()
+        try:
+            async for chunk in host.astream(path, payload, timeout):
+                yield chunk
+        except Exception as e:
+            self._finish(host, failed=is_host_failure(e))
+            raise
+        except (GeneratorExit, asyncio.CancelledError):
+            self._finish(host)
+            raise
+        self._finish(host, time.perf_counter() - started, model)
+
+    # -------------------------
+    # Health probes
+    # -------------------------
+    def probe(self):
+        """
+        Polls /api/ps on every host: refreshes loaded models and ejects or
+        restores hosts. Runs every probe_interval seconds in a daemon thread
+        (start_probing) and can be called directly.
+        """
+        for host in self.hosts:
+            try:
+                loaded = host.client.get("/api/ps", timeout=PROBE_TIMEOUT)
+            except Exception as e:
+                with self._lock:
+                    if not host.ejected:
+                        print(f"Ollama host {host.url} ejected: probe failed ({str(e)})")
+                    host.ejected = True
+                continue
+            with self._lock:
+                if host.ejected:
+                    print(f"Ollama host {host.url} healthy again")
+                host.ejected = False
+                host.consecutive_failures = 0
+                host.models = {model.get("name") or model.get("model") for model in loaded.get("models", [])}
+                host.last_probe = time.time()
+
+    def start_probing(self):
+        if self._prober is not None or self.probe_interval <= 0:
+            return
+
+        def run():
+            while True:
+                self.probe()
+                time.sleep(self.probe_interval)
+
+        self._prober = threading.Thread(target=run, name="ollama-probe", daemon=True)
+        self._prober.start()
+
+    def stats(self):
+        with self._lock:
+            return {
+                "strategy": self.strategy,
+                "failovers": self.failovers,
+                "hosts": [host.info() for host in self.hosts],
+            }
+
+
+_router = None
+_router_lock = threading.Lock()
+
+
+def get_router():
+    """The worker's router over settings.OLLAMA_HOSTS (probing starts on first use)."""
+    global _router
+    if _router is None:
+        with _router_lock:
+            if _router is None:
+                router = OllamaRouter(
+                    settings.OLLAMA_HOSTS,
+                    strategy=settings.OLLAMA_ROUTING,
+                    eject_after=settings.OLLAMA_EJECT_FAILURES,
+                    probe_interval=settings.OLLAMA_PROBE_INTERVAL,
+                    warm_slack=settings.OLLAMA_WARM_SLACK,
+                )
+                router.start_probing()
+                _router = router
+    return _router
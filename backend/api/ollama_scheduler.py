@@ -0,0 +1,210 @@
+"""
+Admission control and priority lanes for Ollama calls
+
+WHAT: Every Ollama request takes a slot from a per-process pool of
+      settings.OLLAMA_MAX_CONCURRENCY slots before it is sent. Requests wait
+      in one of three lanes:
+        short       embeddings, rewrite and classification prompts
+        generate    answer / SQL generation and bulk ingestion embeddings
+        background  work no request waits for (follow-up audits)
+      Waiting short calls are always admitted first, and the generate lane
+      may hold at most OLLAMA_GENERATE_CONCURRENCY slots, so a burst of long
+      generations never blocks the quick calls every chat starts with. A
+      background call runs only while nothing else is waiting, one at a
+      time, and always leaves a slot free for requests.
+WHY:  Without a limit every worker fires at Ollama, which queues internally
+      and slows everyone down; a request is better rejected quickly than
+      left to time out.
+
+A request is rejected with OllamaOverloaded when the lane's queue is full
+(HTTP 429), when its estimated wait (queue length x recent call duration)
+already exceeds OLLAMA_QUEUE_TIMEOUT, or when it actually waits that long
+(HTTP 503). Divide the limits by the number of workers: each process
+enforces its own.
+"""
+
+import asyncio
+import threading
+import time
+from contextlib import asynccontextmanager, contextmanager
+
+from django.conf import settings
+
+SHORT = "short"
+GENERATE = "generate"
+BACKGROUND = "background"
+LANES = (SHORT, GENERATE, BACKGROUND)
+
+EWMA_ALPHA = 0.2
+
+
+class OllamaOverloaded(Exception):
+    """Raised instead of queueing a request that would wait too long."""
+
+    def __init__(self, message, status=503, retry_after=1):
+        super().__init__(message)
+        self.status = status
+        self.retry_after = retry_after
+
+
+class Scheduler:
+    def __init__(self, limit, generate_limit, queue_timeout, max_queue):
+        self.limit = limit
+        self.generate_limit = min(generate_limit, limit)
+        self.queue_timeout = queue_timeout
+        self.max_queue = max_queue
+        self._cond = threading.Condition()
+        self._running = {lane: 0 for lane in LANES}
+        self._waiting = {lane: 0 for lane in LANES}
+        # Recent call duration per lane, used to predict queue wait
+        self._ewma_seconds = {SHORT: 0.2, GENERATE: 3.0, BACKGROUND: 3.0}
+        self._stats = {
+            "admitted": 0,
+            "rejected_queue_full": 0,
+            "rejected_deadline": 0,
+            "wait_seconds": 0.0,
+        }
+
+    def _can_run(self, lane):
+        running = sum(self._running.values())
+        if running >= self.limit:
+            return False
+        if lane == SHORT:
+            return True
+        if lane == GENERATE:
+            return self._running[GENERATE] < self.generate_limit and not self._waiting[SHORT]
+        return (
+            not self._running[BACKGROUND] and running + 1 < self.limit
+            and not self._waiting[SHORT] and not self._waiting[GENERATE]
+        )
+
+    def _estimated_wait(self, lane):
+        if lane == SHORT:
+            slots, ahead = self.limit, self._waiting[SHORT]
+        elif lane == GENERATE:
+            slots, ahead = self.generate_limit, self._waiting[GENERATE] + self._waiting[SHORT]
+        else:
+            slots, ahead = 1, sum(self._waiting.values())
+        return ahead / max(slots, 1) * self._ewma_seconds[lane]
+
+    def _check_admission(self, lane):
+        """Fast rejection before queueing. Caller holds the lock."""
+        if self._waiting[lane] >= self.max_queue:
+            self._stats["rejected_queue_full"] += 1
+            raise OllamaOverloaded(f"Too many queued {lane} requests", status=429)
+        estimate = self._estimated_wait(lane)
+        if estimate > self.queue_timeout:
+            self._stats["rejected_deadline"] += 1
+            raise OllamaOverloaded(
+                f"Estimated {lane} queue wait {estimate:.1f}s exceeds {self.queue_timeout}s",
+                retry_after=max(1, int(estimate)),
+            )
+
+    def _admit(self, lane, waited):
+        self._running[lane] += 1
+        self._stats["admitted"] += 1
+        self._stats["wait_seconds"] += waited
+
+    def acquire(self, lane, timeout=None):
+        timeout = self.queue_timeout if timeout is None else timeout
+        started = time.perf_counter()
+        deadline = started + timeout
+        with self._cond:
+            if self._can_run(lane):
+                self._admit(lane, 0.0)
+                return
+            self._check_admission(lane)
+            self._waiting[lane] += 1
+            try:
+                while not self._can_run(lane):
+                    remaining = deadline - time.perf_counter()
+                    if remaining <= 0:
+                        self._stats["rejected_deadline"] += 1
+                        raise OllamaOverloaded(f"Waited {timeout:.1f}s for an Ollama {lane} slot")
+                    self._cond.wait(remaining)
+            finally:
+                self._waiting[lane] -= 1
+                # A short request leaving the queue may unblock the generate lane
+                self._cond.notify_all()
+            self._admit(lane, time.perf_counter() - started)
+
+    def try_acquire(self, lane):
+        with self._cond:
+            if self._can_run(lane):
+                self._admit(lane, 0.0)
+                return True
+            return False
+
+    def release(self, lane, seconds):
+        with self._cond:
+            self._running[lane] -= 1
+            self._ewma_seconds[lane] += EWMA_ALPHA * (seconds - self._ewma_seconds[lane])
+            self._cond.notify_all()
+
+    @contextmanager
+    def slot(self, lane, timeout=None):
+        self.acquire(lane, timeout)
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.release(lane, time.perf_counter() - started)
+
+    @asynccontextmanager
+    async def aslot(self, lane, timeout=None, poll_interval=0.02):
+        """
+        Async slot. Sync and async callers share the same pool; the event loop
+        must not block on the Condition, so async waiters poll try_acquire().
+        """
+        timeout = self.queue_timeout if timeout is None else timeout
+        started = time.perf_counter()
+        if not self.try_acquire(lane):
+            with self._cond:
+                self._check_admission(lane)
+                self._waiting[lane] += 1
+            try:
+                while not self.try_acquire(lane):
+                    if time.perf_counter() - started >= timeout:
+                        with self._cond:
+                            self._stats["rejected_deadline"] += 1
+                        raise OllamaOverloaded(f"Waited {timeout:.1f}s for an Ollama {lane} slot")
+                    await asyncio.sleep(poll_interval)
+            finally:
+                with self._cond:
+                    self._waiting[lane] -= 1
+                    self._cond.notify_all()
+            with self._cond:
+                self._stats["wait_seconds"] += time.perf_counter() - started
+
+        run_started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.release(lane, time.perf_counter() - run_started)
+
+    def stats(self):
+        with self._cond:
+            stats = dict(self._stats)
+            stats["running"] = dict(self._running)
+            stats["waiting"] = dict(self._waiting)
+            stats["recent_call_seconds"] = {lane: round(value, 3) for lane, value in self._ewma_seconds.items()}
+        stats["avg_wait_seconds"] = round(stats.pop("wait_seconds") / stats["admitted"], 3) if stats["admitted"] else 0.0
+        return stats
+
+
+_scheduler = None
+_scheduler_lock = threading.Lock()
+
+
+def get_scheduler():
+    global _scheduler
+    if _scheduler is None:
+        with _scheduler_lock:
+            if _scheduler is None:
+                _scheduler = Scheduler(
+                    limit=settings.OLLAMA_MAX_CONCURRENCY,
+                    generate_limit=settings.OLLAMA_GENERATE_CONCURRENCY,
+                    queue_timeout=settings.OLLAMA_QUEUE_TIMEOUT,
+                    max_queue=settings.OLLAMA_MAX_QUEUE,
+                )
+    return _scheduler
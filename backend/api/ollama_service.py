@@ -1,8 +1,94 @@
 import requests
+import httpx
 import json
+import time
+from django.conf import settings
+from api.embedding_cache import get_cache
+from api import deadline, model_registry, singleflight
+from api.circuit_breaker import EMBEDDINGS, OllamaUnavailable, get_breaker, is_backend_failure, is_read_timeout
+from api.ollama_router import get_router
+from api.ollama_scheduler import GENERATE, SHORT, OllamaOverloaded, get_scheduler
 
-OLLAMA_BASE_URL = "http://localhost:11434" 
-LLM_MODEL = "gemma3:1b"  # MUST match an installed model (check with `ollama list`)
+OLLAMA_HOSTS = settings.OLLAMA_HOSTS  # routed by api/ollama_router.py
+# Default generation model; per-task overrides in settings.RAG_TASK_MODELS.
+# MUST match an installed model (check with `ollama list`)
+LLM_MODEL = settings.RAG_LLM_MODEL
+EMBEDDING_MODEL = "nomic-embed-text"
+
+def _breaker(path, task):
+    return get_breaker(task if path == "/api/generate" else EMBEDDINGS)
+
+def _queue_timeout():
+    return deadline.timeout(settings.OLLAMA_QUEUE_TIMEOUT, "queueing for Ollama")
+
+def _read_timeout():
+    """Read timeout capped by the request deadline (api/deadline.py); None = client default."""
+    if deadline.remaining() is None:
+        return None
+    return deadline.timeout(settings.OLLAMA_READ_TIMEOUT)
+
+def _request_timeout(read_timeout):
+    return (settings.OLLAMA_CONNECT_TIMEOUT, read_timeout) if read_timeout else None
+
+def _deadline_capped(read_timeout):
+    # Timing out then is the request running out of time, not Ollama failing
+    return read_timeout is not None and read_timeout < settings.OLLAMA_READ_TIMEOUT
+
+def _out_of_time(error, read_timeout):
+    """DeadlineExceeded for a read timeout the request deadline shortened, else None."""
+    if _deadline_capped(read_timeout) and is_read_timeout(error):
+        return deadline.DeadlineExceeded(f"Request deadline exceeded waiting for Ollama ({str(error)})")
+    return None
+
+def _post(path, payload, lane, task=None):
+    """
+    Ollama POST through singleflight (identical concurrent requests share one
+    upstream call), the circuit breaker of `task` (fails fast while Ollama is
+    down, see api/circuit_breaker.py) and the scheduler (only the call
+    actually sent takes a slot in `lane`, see api/ollama_scheduler.py). Queue
+    wait and read timeout are capped by the request deadline; a read timeout
+    the deadline shortened is raised as DeadlineExceeded, which singleflight
+    followers with time left don't inherit.
+    """
+    breaker = _breaker(path, task)
+
+    def send():
+        breaker.check()
+        with get_scheduler().slot(lane, _queue_timeout()):
+            read_timeout = _read_timeout()
+            try:
+                with breaker.call(deadline_capped=_deadline_capped(read_timeout)) as call:
+                    body = get_router().post(path, payload, _request_timeout(read_timeout))
+                    call.exclude_decoding(body)
+                    return body
+            except Exception as e:
+                raise _out_of_time(e, read_timeout) or e
+    return singleflight.do(path, payload, send)
+
+async def _apost(path, payload, lane, task=None):
+    breaker = _breaker(path, task)
+
+    async def send():
+        breaker.check()
+        async with get_scheduler().aslot(lane, _queue_timeout()):
+            read_timeout = _read_timeout()
+            timeout = httpx.Timeout(read_timeout, connect=settings.OLLAMA_CONNECT_TIMEOUT) if read_timeout else None
+            try:
+                with breaker.call(deadline_capped=_deadline_capped(read_timeout)) as call:
+                    body = await get_router().apost(path, payload, timeout)
+                    call.exclude_decoding(body)
+                    return body
+            except Exception as e:
+                raise _out_of_time(e, read_timeout) or e
+    return await singleflight.ado(path, payload, send)
+
+def _embedding_error(error, model=EMBEDDING_MODEL):
+    if is_backend_failure(error):
+        return OllamaUnavailable(f"Embedding generation failed: {str(error)}")
+    response = getattr(error, "response", None)
+    if response is not None and response.status_code == 404:
+        return Exception(f"Embedding model '{model}' not found. Please run: ollama pull {model}")
+    return Exception(f"Embedding generation failed: {str(error)}")
 
 def generate_embedding(text):
     """
@@ -11,52 +97,229 @@ def generate_embedding(text):
     
     Embeddings are numerical representations of text where similar meanings
     have similar vector values. This enables semantic search.
+
+    Results are cached (api/embedding_cache.py) for queries and ingestion
+    alike, and returned L2-normalized like generate_embeddings' (/api/embed).
     """
+    cache = get_cache()
+    cached = cache.get(EMBEDDING_MODEL, text)
+    if cached is not None:
+        return cached
+
     try:
-        response = requests.post(
-            f"{OLLAMA_BASE_URL}/api/embeddings",
-            json={
-                "model": "nomic-embed-text",
+        embedding = _post(
+            "/api/embeddings",
+            {
+                "model": EMBEDDING_MODEL,
                 "prompt": text
-            }
+            },
+            SHORT
+        )["embedding"]
+        return cache.put(EMBEDDING_MODEL, text, embedding)
+    except OllamaOverloaded:
+        raise
+    except Exception as e:
+        raise _embedding_error(e)
+
+async def agenerate_embedding(text):
+    """Async version of generate_embedding (same cache, async HTTP client)."""
+    cache = get_cache()
+    cached = cache.get(EMBEDDING_MODEL, text)
+    if cached is not None:
+        return cached
+
+    try:
+        body = await _apost(
+            "/api/embeddings",
+            {
+                "model": EMBEDDING_MODEL,
+                "prompt": text
+            },
+            SHORT
         )
-        response.raise_for_status()
-        return response.json()["embedding"]
-    except requests.exceptions.HTTPError as e:
-        if e.response.status_code == 404:
-            raise Exception("Embedding model 'nomic-embed-text' not found. Please run: ollama pull nomic-embed-text")
-        raise Exception(f"Embedding generation failed: {str(e)}")
+        return cache.put(EMBEDDING_MODEL, text, body["embedding"])
+    except OllamaOverloaded:
+        raise
     except Exception as e:
-        raise Exception(f"Embedding generation failed: {str(e)}")
+        raise _embedding_error(e)
+
+def _estimate_tokens(text):
+    # ~4 characters per token for English text; only used to size batches
+    return len(text) // 4 + 1
 
-def generate_response(prompt):
+def _embedding_batches(texts, batch_size, max_tokens):
+    """Groups texts so each request stays under batch_size items and max_tokens."""
+    batch, batch_tokens = [], 0
+    for text in texts:
+        tokens = _estimate_tokens(text)
+        if batch and (len(batch) >= batch_size or batch_tokens + tokens > max_tokens):
+            yield batch
+            batch, batch_tokens = [], 0
+        batch.append(text)
+        batch_tokens += tokens
+    if batch:
+        yield batch
+
+def generate_embeddings(texts, batch_size=None, max_tokens=None, model=EMBEDDING_MODEL, lane=GENERATE):
+    """
+    WHAT: Embeds many texts with Ollama's multi-input /api/embed endpoint
+    WHY: One HTTP request per batch instead of one per chunk during ingestion
+
+    Returns embeddings in the same order as `texts`. Cached texts are not
+    sent again; batches are split by item count and estimated token budget.
+    Each batch is sent like any other call (_post: breaker, scheduler slot,
+    deadline-capped timeouts). lane defaults to the generate lane so bulk
+    ingestion queues behind interactive calls; chat-time callers pass SHORT.
+    """
+    batch_size = batch_size or settings.RAG_EMBED_BATCH_SIZE
+    max_tokens = max_tokens or settings.RAG_EMBED_BATCH_TOKENS
+    texts = list(texts)
+
+    cache = get_cache()
+    embeddings = [cache.get(model, text) for text in texts]
+    missing = list(dict.fromkeys(text for text, embedding in zip(texts, embeddings) if embedding is None))
+
+    computed = {}
+    for batch in _embedding_batches(missing, batch_size, max_tokens):
+        try:
+            batch_embeddings = _post(
+                "/api/embed",
+                {
+                    "model": model,
+                    "input": batch
+                },
+                lane
+            )["embeddings"]
+        except OllamaOverloaded:
+            raise
+        except Exception as e:
+            raise _embedding_error(e, model)
+
+        for text, embedding in zip(batch, batch_embeddings):
+            computed[text] = cache.put(model, text, embedding)
+
+    return [embedding if embedding is not None else computed[text] for text, embedding in zip(texts, embeddings)]
+
+def _generate_payload(prompt, task, format=None, stream=False):
+    payload = {
+        "model": model_registry.model_for(task),
+        "prompt": prompt,
+        "stream": stream
+    }
+    options = model_registry.profile(task)
+    payload["keep_alive"] = options.pop("keep_alive")
+    if format:
+        # "json" makes Ollama constrain decoding to valid JSON
+        payload["format"] = format
+        options.pop("stop", None)
+    payload["options"] = options
+    return payload
+
+def _generation_error(error, model):
+    """
+    Exception to raise for a failed generation: OllamaUnavailable when Ollama
+    itself failed (rag.py can degrade), a plain Exception otherwise.
+    """
+    if is_backend_failure(error):
+        return OllamaUnavailable(f"LLM generation failed: {str(error)}")
+    if not isinstance(error, (requests.exceptions.HTTPError, httpx.HTTPStatusError)):
+        return Exception(f"LLM generation failed: {str(error)}")
+
+    # Try to get more details from the response body for debugging
+    details = ""
+    try:
+        details = error.response.json()
+    except json.JSONDecodeError:
+        details = error.response.text
+
+    if error.response.status_code == 404:
+        if isinstance(details, dict) and "error" in details and "not found" in details["error"]:
+            return Exception(f"Model '{model}' not found. Please run this command in your terminal: ollama pull {model}")
+
+    return Exception(f"LLM generation failed: {error}. Details: {details}")
+
+def generate_response(prompt, format=None, task=model_registry.DEFAULT_TASK, lane=None):
     """
     WHAT: Sends prompt to local Ollama LLM and gets response
     WHY: This replaces Gemini API with local LLM for answer generation
+
+    task ("rewrite", "classify", "sql", "answer", "chitchat") selects the
+    model and options (api/model_registry.py) and the scheduler lane: quick
+    routing prompts get priority over answer generation. lane overrides the
+    task's lane (BACKGROUND for work no request waits for).
+    format="json" asks Ollama for structured output (see rag.rewrite_and_classify).
     """
+    payload = _generate_payload(prompt, task, format)
+    started = time.perf_counter()
     try:
-        response = requests.post(
-            f"{OLLAMA_BASE_URL}/api/generate",
-            json={
-                "model": LLM_MODEL,
-                "prompt": prompt,
-                "stream": False
-            }
-        )
-        response.raise_for_status()
-        return response.json()["response"]
-    except requests.exceptions.HTTPError as http_err:
-        # Try to get more details from the response body for debugging
-        details = ""
-        try:
-            details = http_err.response.json()
-        except json.JSONDecodeError:
-            details = http_err.response.text
-            
-        if http_err.response.status_code == 404:
-            if isinstance(details, dict) and "error" in details and "not found" in details["error"]:
-                raise Exception(f"Model '{LLM_MODEL}' not found. Please run this command in your terminal: ollama pull {LLM_MODEL}")
-                
-        raise Exception(f"LLM generation failed: {http_err}. Details: {details}")
+        body = _post("/api/generate", payload, lane or model_registry.lane_for(task), task)
+        model_registry.record(task, payload["model"], time.perf_counter() - started, body)
+        return body["response"]
+    except OllamaOverloaded:
+        raise
+    except Exception as e:
+        model_registry.record(task, payload["model"], time.perf_counter() - started, failed=True)
+        raise _generation_error(e, payload["model"])
+
+def generate_response_stream(prompt, task=model_registry.DEFAULT_TASK):
+    """
+    WHAT: Streaming version of generate_response, yields text as Ollama produces it
+    WHY: The first tokens reach the user after prefill instead of after the whole completion
+    """
+    payload = _generate_payload(prompt, task, stream=True)
+    breaker = get_breaker(task)
+    started = time.perf_counter()
+    try:
+        breaker.check()
+        with get_scheduler().slot(model_registry.lane_for(task), _queue_timeout()):
+            read_timeout = _read_timeout()
+            with breaker.call(deadline_capped=_deadline_capped(read_timeout)) as call:
+                for chunk in get_router().stream("/api/generate", payload, _request_timeout(read_timeout)):
+                    # The breaker judges time to first token, not answer length
+                    call.mark_first_byte()
+                    if chunk.get("response"):
+                        yield chunk["response"]
+                    if chunk.get("done"):
+                        model_registry.record(task, payload["model"], time.perf_counter() - started, chunk)
+    except OllamaOverloaded:
+        raise
+    except Exception as e:
+        model_registry.record(task, payload["model"], time.perf_counter() - started, failed=True)
+        raise _generation_error(e, payload["model"])
+
+async def agenerate_response_stream(prompt, task=model_registry.DEFAULT_TASK):
+    """Async version of generate_response_stream for the ASGI streaming view."""
+    payload = _generate_payload(prompt, task, stream=True)
+    breaker = get_breaker(task)
+    started = time.perf_counter()
+    try:
+        breaker.check()
+        async with get_scheduler().aslot(model_registry.lane_for(task), _queue_timeout()):
+            read_timeout = _read_timeout()
+            timeout = httpx.Timeout(read_timeout, connect=settings.OLLAMA_CONNECT_TIMEOUT) if read_timeout else None
+            with breaker.call(deadline_capped=_deadline_capped(read_timeout)) as call:
+                async for chunk in get_router().astream("/api/generate", payload, timeout):
+                    call.mark_first_byte()
+                    if chunk.get("response"):
+                        yield chunk["response"]
+                    if chunk.get("done"):
+                        model_registry.record(task, payload["model"], time.perf_counter() - started, chunk)
+    except OllamaOverloaded:
+        raise
+    except Exception as e:
+        model_registry.record(task, payload["model"], time.perf_counter() - started, failed=True)
+        raise _generation_error(e, payload["model"])
+
+async def agenerate_response(prompt, format=None, task=model_registry.DEFAULT_TASK):
+    """Async version of generate_response for the async chat path (rag.arag_query)."""
+    payload = _generate_payload(prompt, task, format)
+    started = time.perf_counter()
+    try:
+        body = await _apost("/api/generate", payload, model_registry.lane_for(task), task)
+        model_registry.record(task, payload["model"], time.perf_counter() - started, body)
+        return body["response"]
+    except OllamaOverloaded:
+        raise
     except Exception as e:
-        raise Exception(f"LLM generation failed: {str(e)}")
+        model_registry.record(task, payload["model"], time.perf_counter() - started, failed=True)
+        raise _generation_error(e, payload["model"])
@@ -1,107 +1,575 @@
+import asyncio
+import json
 import re
-from django.db import connection
-from api.ollama_service import generate_embedding, generate_response
+from contextlib import nullcontext
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db import connection, transaction
+from api import answer_cache, circuit_breaker, deadline, followup, intent_classifier, mmap_index, stage_executor
+from api.circuit_breaker import OllamaUnavailable
+from api.extractive import extract_answer
+from api.ollama_scheduler import OllamaOverloaded
+from api.ollama_service import (
+    agenerate_embedding, agenerate_response, agenerate_response_stream, generate_embedding, generate_response,
+    generate_response_stream,
+)
+from api.vector_db import to_db_vector, vector_cursor
+from api.vector_index import apply_search_params, order_by_sql
+
+# Vector leg ranked by pgvector (uses the ANN index)
+POSTGRES_VECTOR_LEG_SQL = """
+        SELECT id, distance, ROW_NUMBER() OVER (ORDER BY distance) AS rnk
+        FROM (
+            SELECT id, (embedding <=> %(embedding)s::vector) AS distance
+            FROM document_chunks
+            WHERE {filters}
+            ORDER BY distance
+            LIMIT %(pool)s
+        ) v
+"""
+
+# Vector leg over a quantized (halfvec / binary) index: a wider candidate
+# pool comes from the compact index, then is re-ranked by exact cosine distance
+QUANTIZED_VECTOR_LEG_SQL = """
+        SELECT id, distance, ROW_NUMBER() OVER (ORDER BY distance) AS rnk
+        FROM (
+            SELECT id, (embedding <=> %(embedding)s::vector) AS distance
+            FROM (
+                SELECT id, embedding
+                FROM document_chunks
+                WHERE {filters}
+                ORDER BY {order_by}
+                LIMIT %(rerank_pool)s
+            ) candidates
+            ORDER BY distance
+            LIMIT %(pool)s
+        ) v
+"""
+
+# Vector leg already ranked in-process by the mmap index, passed in as arrays
+MMAP_VECTOR_LEG_SQL = """
+        SELECT v.id, v.distance, v.rnk
+        FROM unnest(%(candidate_ids)s::bigint[], %(candidate_distances)s::float8[])
+             WITH ORDINALITY AS v(id, distance, rnk)
+"""
+
+HYBRID_SEARCH_SQL = """
+    WITH vector_leg AS ({vector_leg}),
+    keyword_leg AS (
+        SELECT id, ROW_NUMBER() OVER (ORDER BY rank DESC) AS rnk
+        FROM (
+            SELECT id, ts_rank_cd(search_vector, q) AS rank
+            FROM document_chunks, plainto_tsquery('english', %(query)s) q
+            WHERE search_vector @@ q AND {filters}
+            ORDER BY rank DESC
+            LIMIT %(pool)s
+        ) k
+    ),
+    fused AS (
+        SELECT COALESCE(v.id, k.id) AS id,
+               v.distance,
+               COALESCE(%(vector_weight)s::float / (%(rrf_k)s + v.rnk), 0)
+             + COALESCE(%(keyword_weight)s::float / (%(rrf_k)s + k.rnk), 0) AS score
+        FROM vector_leg v
+        FULL OUTER JOIN keyword_leg k ON k.id = v.id
+        ORDER BY score DESC
+        LIMIT %(top_k)s
+    )
+    SELECT c.content, c.metadata,
+           COALESCE(f.distance, c.embedding <=> %(embedding)s::vector) AS distance,
+           f.score
+    FROM fused f
+    JOIN document_chunks c ON c.id = f.id
+    ORDER BY f.score DESC
+"""
+
+# Conditions on the parent document (uploader / upload date)
+DOCUMENT_FILTERS = {
+    "uploaded_by": "uploaded_by_id = %(uploaded_by)s",
+    "uploaded_after": "uploaded_at >= %(uploaded_after)s",
+    "uploaded_before": "uploaded_at < %(uploaded_before)s",
+}
 
-def similarity_search(query, top_k=3):
+def filters_sql(filters, params):
+    """
+    Turns a retrieval filter dict into a SQL condition on document_chunks and
+    adds its values to params. Supported keys:
+      document_ids    list of Document ids
+      source          metadata->>'source' (matches per-source partial indexes)
+      metadata        dict matched with @> (uses the GIN index on metadata)
+      uploaded_by     uploader user id
+      uploaded_after / uploaded_before   datetimes on Document.uploaded_at
+    """
+    if not filters:
+        return "TRUE"
+
+    conditions = []
+    if filters.get("document_ids"):
+        params["document_ids"] = [int(doc_id) for doc_id in filters["document_ids"]]
+        conditions.append("document_id = ANY(%(document_ids)s)")
+    if filters.get("source"):
+        params["source"] = filters["source"]
+        conditions.append("metadata->>'source' = %(source)s")
+    if filters.get("metadata"):
+        params["metadata_filter"] = json.dumps(filters["metadata"])
+        conditions.append("metadata @> %(metadata_filter)s::jsonb")
+
+    document_conditions = []
+    for key, condition in DOCUMENT_FILTERS.items():
+        if filters.get(key):
+            params[key] = filters[key]
+            document_conditions.append(condition)
+    if document_conditions:
+        conditions.append(f"document_id IN (SELECT id FROM documents WHERE {' AND '.join(document_conditions)})")
+
+    return " AND ".join(conditions) or "TRUE"
+
+def postgres_vector_leg_sql(params, quantization=None, filters="TRUE"):
+    """Vector leg for the index representation in use; adds rerank_pool to params if needed."""
+    quantization = quantization or settings.RAG_VECTOR_QUANTIZATION
+    if quantization == "none":
+        return POSTGRES_VECTOR_LEG_SQL.format(filters=filters)
+    params["rerank_pool"] = params["pool"] * settings.RAG_QUANTIZED_RERANK_FACTOR
+    return QUANTIZED_VECTOR_LEG_SQL.format(order_by=order_by_sql(quantization), filters=filters)
+
+def similarity_search(query, top_k=3, ef_search=None, probes=None, vector_weight=None, keyword_weight=None, filters=None):
     """
     Hybrid Search: Combines Vector Search (Semantic) + Keyword Search (Exact Match)
+
+    Both legs run in a single SQL statement and are fused with Reciprocal Rank
+    Fusion: score = sum(weight / (RRF_K + rank)). Only the final top_k rows
+    fetch content/metadata. ef_search / probes override the connection's
+    ANN index defaults for this query only.
+
+    With RAG_RETRIEVAL_BACKEND = "mmap" the vector leg is ranked in-process by
+    api/mmap_index.py and Postgres only runs the keyword leg and the fetch.
+
+    filters (see filters_sql) are applied inside both legs, before ranking, so
+    scoped questions don't lose recall to post-filtering. Filtered searches
+    always use pgvector, with iterative index scans enabled.
     """
-    query_embedding = generate_embedding(query)
-    
-    # 1. Vector Search (Semantic)
-    with connection.cursor() as cursor:
-        cursor.execute("""
-            SELECT content, metadata, (embedding <=> %s::vector) as distance
-            FROM document_chunks
-            ORDER BY distance
-            LIMIT %s
-        """, [query_embedding, top_k])
-        vector_results = cursor.fetchall()
-
-    # 2. Keyword Search (Exact Match using PostgreSQL Full-Text Search)
-    with connection.cursor() as cursor:
-        cursor.execute("""
-            SELECT content, metadata, 0.0 as distance
-            FROM document_chunks
-            WHERE to_tsvector('english', content) @@ plainto_tsquery('english', %s)
-            LIMIT %s
-        """, [query, top_k])
-        keyword_results = cursor.fetchall()
-    
-    # 3. Combine & Deduplicate
-    # We use a dictionary to merge results, preferring vector results (preserving distance)
-    combined_results = {}
-    
-    for row in vector_results:
-        combined_results[row[0]] = {"content": row[0], "metadata": row[1], "distance": row[2]}
-        
-    for row in keyword_results:
-        if row[0] not in combined_results:
-            # Assign 0.0 distance for exact keyword matches (high priority)
-            combined_results[row[0]] = {"content": row[0], "metadata": row[1], "distance": 0.0}
-            
-    # Convert back to list and sort by distance
-    final_results = list(combined_results.values())
-    final_results.sort(key=lambda x: x['distance'])
-    
-    return final_results[:top_k]
+    query_embedding = to_db_vector(generate_embedding(query))
+    sql, params = hybrid_search_sql(query, query_embedding, top_k, vector_weight, keyword_weight, filters)
+    return fetch_search_results(sql, params, ef_search, probes)
+
+async def asimilarity_search(query, top_k=3, ef_search=None, probes=None, vector_weight=None, keyword_weight=None, filters=None):
+    """Async version of similarity_search: awaits the embedding, runs the SQL in a worker thread."""
+    query_embedding = to_db_vector(await agenerate_embedding(query))
+    sql, params = hybrid_search_sql(query, query_embedding, top_k, vector_weight, keyword_weight, filters)
+    return await sync_to_async(fetch_search_results)(sql, params, ef_search, probes)
+
+def hybrid_search_sql(query, query_embedding, top_k, vector_weight=None, keyword_weight=None, filters=None):
+    """Builds the hybrid search statement and its params for similarity_search."""
+    params = {
+        "embedding": query_embedding,
+        "query": query,
+        "pool": max(top_k, settings.RAG_HYBRID_CANDIDATES),
+        "top_k": top_k,
+        "rrf_k": settings.RAG_RRF_K,
+        "vector_weight": settings.RAG_RRF_VECTOR_WEIGHT if vector_weight is None else vector_weight,
+        "keyword_weight": settings.RAG_RRF_KEYWORD_WEIGHT if keyword_weight is None else keyword_weight,
+    }
+    where = filters_sql(filters, params)
+
+    if settings.RAG_RETRIEVAL_BACKEND == "mmap" and not filters:
+        candidates = mmap_index.get_index().search(query_embedding, params["pool"])
+        params["candidate_ids"] = [chunk_id for chunk_id, _ in candidates]
+        params["candidate_distances"] = [distance for _, distance in candidates]
+        sql = HYBRID_SEARCH_SQL.format(vector_leg=MMAP_VECTOR_LEG_SQL, filters=where)
+    else:
+        vector_leg = postgres_vector_leg_sql(params, filters=where)
+        sql = HYBRID_SEARCH_SQL.format(vector_leg=vector_leg, filters=where)
+    return sql, params
+
+def fetch_search_results(sql, params, ef_search=None, probes=None):
+    # Defaults are set once per connection (api/vector_db.py); only a
+    # per-request override needs its own transaction for SET LOCAL.
+    tuned = bool(ef_search or probes)
+    with transaction.atomic() if tuned else nullcontext(), vector_cursor() as cursor:
+        if tuned:
+            apply_search_params(cursor, ef_search=ef_search, probes=probes)
+        cursor.execute(sql, params)
+        rows = cursor.fetchall()
+
+    return [
+        {"content": row[0], "metadata": row[1], "distance": row[2], "score": row[3]}
+        for row in rows
+    ]
+
+def corpus_changed(added_chunk_ids=(), removed_chunk_ids=()):
+    """
+    Called after document chunks are added or deleted so in-process retrieval
+    state stays in sync with document_chunks. Without ids (bulk ingestion
+    scripts, whose COPY doesn't return them) the mmap index is reconciled
+    with the whole table.
+    """
+    if settings.RAG_RETRIEVAL_BACKEND == "mmap":
+        index = mmap_index.get_index()
+        if added_chunk_ids or removed_chunk_ids:
+            index.remove(removed_chunk_ids)
+            index.add(added_chunk_ids)
+        else:
+            index.sync()
 
-def rag_query(question, chat_history=None):
-    # -------------------------
-    # 0️⃣ Contextualize Question (Memory)
-    # -------------------------
-    search_query = question
-    
-    if chat_history and len(chat_history) > 0:
-        # Format history for the LLM
-        history_text = "\n".join([f"{msg['role']}: {msg['content']}" for msg in chat_history[-4:]])
-        
-        rewrite_prompt = f"""
+    # Cached knowledge answers were built from the old corpus
+    answer_cache.invalidate()
+
+# Question categories shared by the classification and fused rewrite prompts
+CATEGORIES = ("database", "knowledge", "conversational", "irrelevant")
+
+CATEGORY_DESCRIPTIONS = """- database: For questions about Titanic passengers, such as counts, details, ages, survival, fares, or lists (e.g., "show me details of women", "how many men").
+- knowledge: For questions about company policy, employment, leave, travel, office environment, or any specific terms defined in the documents.
+- conversational: ONLY for greetings (hello, hi) or simple pleasantries.
+- irrelevant: For questions completely unrelated to the Titanic dataset or company policy."""
+
+# -------------------------
+# Prompt layout: every prompt is a static prefix (instructions, output
+# format, schema, examples) followed by the per-request part, which is kept
+# as short as possible (history, question, a one-line answer cue). The
+# prefixes are built once and never contain request data; keep it that way,
+# since Ollama can only reuse cached prefill for a prompt whose first tokens
+# match the previous one on the same model: everything after the first
+# request-specific token is evaluated again. Consecutive calls of different
+# tasks on one model replace each other's cache: `python manage.py
+# prompt_cache benchmark` shows how much is reused grouped vs interleaved,
+# `... layout` compares this layout with the previous one, `... warm`
+# prefills.
+# -------------------------
+REWRITE_PREFIX = """
 Given the following conversation history and a follow-up question, rephrase the follow-up question to be a standalone question that can be understood without the history.
 
 Chat History:
-{history_text}
+"""
+
+def history_text(chat_history):
+    # Format history for the LLM
+    return "\n".join([f"{msg['role']}: {msg['content']}" for msg in chat_history[-4:]])
+
+def rewrite_prompt(question, chat_history):
+    return REWRITE_PREFIX + f"""{history_text(chat_history)}
 
 Follow-up Question: {question}
 
 Standalone Question:
 """
-        # Get the rewritten question
-        rewritten = generate_response(rewrite_prompt).strip()
-        # Basic cleanup if LLM is chatty
-        if "Standalone Question:" in rewritten:
-            rewritten = rewritten.split("Standalone Question:")[-1].strip()
-            
-        print(f"DEBUG: Original: '{question}' -> Rewritten: '{rewritten}'")
-        search_query = rewritten
 
-    question_lower = search_query.lower()
+def clean_rewrite(rewritten):
+    rewritten = rewritten.strip()
+    # Basic cleanup if LLM is chatty
+    if "Standalone Question:" in rewritten:
+        rewritten = rewritten.split("Standalone Question:")[-1].strip()
+    return rewritten
+
+# The JSON format comes before the history so it is part of the cached prefix
+REWRITE_AND_CLASSIFY_PREFIX = f"""
+Given the following conversation history and a follow-up question:
+1. Rephrase the follow-up question to be a standalone question that can be understood without the history.
+2. Classify the standalone question into ONE of the following categories:
+{CATEGORY_DESCRIPTIONS}
+
+Respond with a JSON object only:
+{{"standalone_question": "<the rephrased question>", "category": "<one category>"}}
+
+Chat History:
+"""
+
+def rewrite_and_classify_prompt(question, chat_history):
+    return REWRITE_AND_CLASSIFY_PREFIX + f"""{history_text(chat_history)}
+
+Follow-up Question: {question}
+"""
+
+def normalize_category(raw):
+    """
+    One of CATEGORIES for the classifier's free-text reply: the reply itself
+    when it is a category, else the first category it mentions ("database/
+    knowledge" -> "database"), "irrelevant" when it mentions none.
+    """
+    words = re.findall(r"[a-z]+", (raw or "").lower())
+    return next((word for word in words if word in CATEGORIES), "irrelevant")
+
+def parse_rewrite_and_classify(raw):
+    """Validates the fused stage's JSON. Returns (standalone_question, category) or None."""
+    try:
+        data = json.loads(raw)
+    except (json.JSONDecodeError, TypeError):
+        return None
+    if not isinstance(data, dict):
+        return None
+
+    standalone = data.get("standalone_question")
+    category = data.get("category")
+    if not isinstance(standalone, str) or not standalone.strip():
+        return None
+    if not isinstance(category, str) or category.strip().lower() not in CATEGORIES:
+        return None
+    return standalone.strip(), category.strip().lower()
+
+# -------------------------
+# Degraded mode: when the LLM is unavailable (circuit breaker open, Ollama
+# failing or overloaded) or the request deadline is nearly spent, skip the
+# rewrite and answer knowledge questions with the retrieved passages verbatim
+# instead of blocking on Ollama.
+# -------------------------
+DEGRADED = "degraded"
+
+DEGRADED_NOTICE = (
+    "I can't write a full answer right now, so here are the most relevant "
+    "passages from the documents:"
+)
+
+degraded_stats = {"rewrites_skipped": 0, "passage_answers": 0}
+
+def generation_available(task, min_budget=None):
+    """True when the task's circuit is not open and enough of the deadline is left."""
+    min_budget = settings.RAG_MIN_GENERATION_BUDGET if min_budget is None else min_budget
+    return circuit_breaker.generation_available(task) and deadline.has_budget(min_budget)
+
+def require_generation(task):
+    if not generation_available(task):
+        raise OllamaUnavailable(f"LLM {task} skipped: circuit open or request deadline nearly spent")
+
+def degraded_answer(docs):
+    """Knowledge answer without the LLM: the top passages, verbatim."""
+    degraded_stats["passage_answers"] += 1
+    passages = "\n\n".join(
+        f"{i}. {doc['content'].strip()}" for i, doc in enumerate(docs[:settings.RAG_DEGRADED_PASSAGES], 1)
+    )
+    return DEGRADED, f"{DEGRADED_NOTICE}\n\n{passages}", None, docs
+
+def skip_rewrite(question):
+    if generation_available("rewrite", settings.RAG_REWRITE_MIN_BUDGET):
+        return False
+    degraded_stats["rewrites_skipped"] += 1
+    print(f"DEBUG: Skipping rewrite (LLM unavailable or over budget), searching with '{question}'")
+    return True
+
+def contextualize_question(question, chat_history):
+    """
+    Rewrites a follow-up into a standalone question using the chat history.
+    Returns (search_query, question_type); question_type is None unless the
+    fused rewrite+classify call (RAG_FUSED_REWRITE_CLASSIFY) already
+    classified the question. The question is used as-is when it doesn't
+    refer back to the history (api/followup.py), when the rewrite can't be
+    afforded (see skip_rewrite) or when Ollama rejects it.
+    """
+    # skip_rewrite first: no point deciding on a rewrite that can't be afforded
+    if not chat_history or skip_rewrite(question) or not followup.needs_rewrite(question, chat_history):
+        return question, None
+
+    try:
+        return _contextualize_question(question, chat_history)
+    except OllamaOverloaded as e:
+        degraded_stats["rewrites_skipped"] += 1
+        print(f"DEBUG: Rewrite unavailable ({str(e)}), searching with '{question}'")
+        return question, None
+
+def _contextualize_question(question, chat_history):
+    if settings.RAG_FUSED_REWRITE_CLASSIFY:
+        # One JSON call instead of separate rewrite and classification calls
+        parsed = parse_rewrite_and_classify(
+            generate_response(rewrite_and_classify_prompt(question, chat_history), format="json", task="rewrite")
+        )
+        if parsed:
+            print(f"DEBUG: Original: '{question}' -> Rewritten: '{parsed[0]}' ({parsed[1]})")
+            return parsed
+        print("DEBUG: Fused rewrite/classify returned invalid JSON, falling back to two calls")
+
+    # Get the rewritten question
+    rewritten = clean_rewrite(generate_response(rewrite_prompt(question, chat_history), task="rewrite"))
+    print(f"DEBUG: Original: '{question}' -> Rewritten: '{rewritten}'")
+    return rewritten, None
+
+async def acontextualize_question(question, chat_history):
+    if not chat_history or skip_rewrite(question) or not followup.needs_rewrite(question, chat_history):
+        return question, None
+
+    try:
+        return await _acontextualize_question(question, chat_history)
+    except OllamaOverloaded as e:
+        degraded_stats["rewrites_skipped"] += 1
+        print(f"DEBUG: Rewrite unavailable ({str(e)}), searching with '{question}'")
+        return question, None
+
+async def _acontextualize_question(question, chat_history):
+    if settings.RAG_FUSED_REWRITE_CLASSIFY:
+        parsed = parse_rewrite_and_classify(
+            await agenerate_response(rewrite_and_classify_prompt(question, chat_history), format="json", task="rewrite")
+        )
+        if parsed:
+            print(f"DEBUG: Original: '{question}' -> Rewritten: '{parsed[0]}' ({parsed[1]})")
+            return parsed
+        print("DEBUG: Fused rewrite/classify returned invalid JSON, falling back to two calls")
+
+    rewritten = clean_rewrite(await agenerate_response(rewrite_prompt(question, chat_history), task="rewrite"))
+    print(f"DEBUG: Original: '{question}' -> Rewritten: '{rewritten}'")
+    return rewritten, None
+
+def rag_query(question, chat_history=None, search_options=None):
+    """
+    search_options: optional kwargs for similarity_search (ef_search, probes, RRF weights, filters)
+    """
+    search_options = search_options or {}
+
+    # Greetings need no rewrite, classification or generation
+    reply = intent_classifier.greeting_reply(question)
+    if reply:
+        return reply
+
+    # -------------------------
+    # 0️⃣ Contextualize Question (Memory)
+    # -------------------------
+    search_query, question_type = contextualize_question(question, chat_history)
 
     # -------------------------
-    # 1️⃣ Ask LLM to classify question
+    # 🔁 Semantic answer cache (paraphrases of recent questions)
     # -------------------------
-    classification_prompt = f"""
+    use_cache = settings.RAG_ANSWER_CACHE_ENABLED and not search_options.get("filters")
+    if use_cache:
+        question_embedding = generate_embedding(search_query)
+        generation, cached = answer_cache.lookup(question_embedding)
+        if cached:
+            print(f"DEBUG: Answer cache hit for '{search_query}' (distance {cached['distance']:.4f})")
+            return cached["answer"]
+
+    question_type, answer = answer_question(search_query, search_options, question_type)
+
+    if use_cache and answer_cache.cacheable(question_type, answer):
+        answer_cache.store(search_query, question_embedding, question_type, answer, generation)
+    return answer
+
+def rag_query_stream(question, chat_history=None, search_options=None):
+    """
+    Streaming version of rag_query: a generator of answer text chunks.
+
+    The rewrite and classification stay non-streamed (their output is only
+    an input to later stages); the final knowledge / conversational answer
+    is relayed token by token. Database answers, cache hits and fixed
+    replies arrive as a single chunk.
+    """
+    search_options = search_options or {}
+
+    reply = intent_classifier.greeting_reply(question)
+    if reply:
+        yield reply
+        return
+
+    search_query, question_type = contextualize_question(question, chat_history)
+
+    use_cache = settings.RAG_ANSWER_CACHE_ENABLED and not search_options.get("filters")
+    if use_cache:
+        question_embedding = generate_embedding(search_query)
+        generation, cached = answer_cache.lookup(question_embedding)
+        if cached:
+            print(f"DEBUG: Answer cache hit for '{search_query}' (distance {cached['distance']:.4f})")
+            yield cached["answer"]
+            return
+
+    question_type, answer, prompt, docs = prepare_answer(search_query, search_options, question_type)
+    if prompt is None:
+        yield answer
+    else:
+        parts = []
+        try:
+            for token in generate_response_stream(prompt, task=answer_task(question_type)):
+                parts.append(token)
+                yield token
+            answer = "".join(parts)
+        except OllamaOverloaded as e:
+            # Too late to degrade once part of the answer has been sent
+            if parts or not docs:
+                raise
+            print(f"DEBUG: Answer generation unavailable ({str(e)}), serving retrieved passages")
+            question_type, answer = degraded_answer(docs)[:2]
+            yield answer
+
+    if use_cache and answer_cache.cacheable(question_type, answer):
+        answer_cache.store(search_query, question_embedding, question_type, answer, generation)
+
+async def arag_query(question, chat_history=None, search_options=None):
+    """
+    Async version of rag_query for the ASGI chat view (views.chat_async).
+    LLM and embedding calls are awaited on the async Ollama client; database
+    work runs through sync_to_async because Django's cursors are synchronous.
+    """
+    search_options = search_options or {}
+
+    reply = intent_classifier.greeting_reply(question)
+    if reply:
+        return reply
+
+    search_query, question_type = await acontextualize_question(question, chat_history)
+
+    use_cache = settings.RAG_ANSWER_CACHE_ENABLED and not search_options.get("filters")
+    if use_cache:
+        question_embedding = await agenerate_embedding(search_query)
+        generation, cached = await sync_to_async(answer_cache.lookup)(question_embedding)
+        if cached:
+            print(f"DEBUG: Answer cache hit for '{search_query}' (distance {cached['distance']:.4f})")
+            return cached["answer"]
+
+    question_type, answer = await aanswer_question(search_query, search_options, question_type)
+
+    if use_cache and answer_cache.cacheable(question_type, answer):
+        await sync_to_async(answer_cache.store)(search_query, question_embedding, question_type, answer, generation)
+    return answer
+
+async def arag_query_stream(question, chat_history=None, search_options=None):
+    """
+    Async version of rag_query_stream for the ASGI streaming view
+    (views.chat_stream_async): an async generator of answer text chunks.
+    """
+    search_options = search_options or {}
+
+    reply = intent_classifier.greeting_reply(question)
+    if reply:
+        yield reply
+        return
+
+    search_query, question_type = await acontextualize_question(question, chat_history)
+
+    use_cache = settings.RAG_ANSWER_CACHE_ENABLED and not search_options.get("filters")
+    if use_cache:
+        question_embedding = await agenerate_embedding(search_query)
+        generation, cached = await sync_to_async(answer_cache.lookup)(question_embedding)
+        if cached:
+            print(f"DEBUG: Answer cache hit for '{search_query}' (distance {cached['distance']:.4f})")
+            yield cached["answer"]
+            return
+
+    question_type, answer, prompt, docs = await aprepare_answer(search_query, search_options, question_type)
+    if prompt is None:
+        yield answer
+    else:
+        parts = []
+        try:
+            async for token in agenerate_response_stream(prompt, task=answer_task(question_type)):
+                parts.append(token)
+                yield token
+            answer = "".join(parts)
+        except OllamaOverloaded as e:
+            if parts or not docs:
+                raise
+            print(f"DEBUG: Answer generation unavailable ({str(e)}), serving retrieved passages")
+            question_type, answer = degraded_answer(docs)[:2]
+            yield answer
+
+    if use_cache and answer_cache.cacheable(question_type, answer):
+        await sync_to_async(answer_cache.store)(search_query, question_embedding, question_type, answer, generation)
+
+CLASSIFICATION_PREFIX = f"""
 Classify the user's question into ONE of the following categories:
-- database: For questions about Titanic passengers, such as counts, details, ages, survival, fares, or lists (e.g., "show me details of women", "how many men").
-- knowledge: For questions about company policy, employment, leave, travel, office environment, or any specific terms defined in the documents.
-- conversational: ONLY for greetings (hello, hi) or simple pleasantries.
-- irrelevant: For questions completely unrelated to the Titanic dataset or company policy.
+{CATEGORY_DESCRIPTIONS}
  
 Return ONLY one word.
 
 Question:
-{search_query}
 """
 
-    question_type = generate_response(classification_prompt).strip().lower()
-    print(f"DEBUG: Question '{search_query}' classified as: {question_type}")
+def classification_prompt(search_query):
+    return CLASSIFICATION_PREFIX + f"{search_query}\n"
 
-    # -------------------------
-    # 2️⃣ If Database → Generate SQL
-    # -------------------------
-    if "database" in question_type:
-
-        sql_prompt = f"""
+SQL_PREFIX = """
 You are a PostgreSQL expert tasked with converting natural language questions into PostgreSQL queries for the 'titanic' table.
 
 Table Schema:
@@ -142,78 +610,249 @@ Examples:
   SQL Query: SELECT * FROM titanic WHERE sex = 'female' AND age BETWEEN 20 AND 50;
 
 User Question:
-{search_query}
+"""
+
+def sql_prompt(search_query):
+    return SQL_PREFIX + f"""{search_query}
 
 SQL Query:
 """
 
-        sql_query = generate_response(sql_prompt).strip()
+KNOWLEDGE_PREFIX = """You are a helpful assistant. Your task is to answer the user's question based *only* on the provided context.
+Do not mention the context in your answer. Just provide the answer directly.
+If the information is not in the context, state that the answer is not available in the provided data.
 
-        # ✅ Remove markdown formatting if LLM adds it
-        match = re.search(r"```(?:sql)?\s*(.*?)```", sql_query, re.DOTALL | re.IGNORECASE)
-        if match:
-            sql_query = match.group(1).strip()
-        else:
-            sql_query = sql_query.replace("```sql", "").replace("```", "").strip()
+### Context:
+"""
 
-        # ✅ Safety check (block dangerous queries)
-        forbidden_keywords = ["drop", "delete", "update", "insert", "alter", "truncate"]
-        if any(keyword in sql_query.lower() for keyword in forbidden_keywords):
-            return "Unsafe query detected."
+def knowledge_prompt(search_query, docs):
+    context = "\n\n".join([doc["content"] for doc in docs])
 
-        try:
-            with connection.cursor() as cursor:
-                cursor.execute(sql_query)
-                result = cursor.fetchall()
+    return KNOWLEDGE_PREFIX + f"""{context}
 
-            # ✅ Better formatting
-            if not result:
-                return "No records found."
+### User's Question:
+{search_query}
 
-            if len(result) == 1 and len(result[0]) == 1:
-                return f"The answer is {result[0][0]}."
+### Answer:
+"""
 
-            return f"Query Result: {result}"
+CONVERSATIONAL_PREFIX = "Respond politely to this conversational input: "
 
-        except Exception as e:
-            return f"Error executing generated SQL: {str(e)}"
+def conversational_prompt(search_query):
+    return CONVERSATIONAL_PREFIX + search_query
 
-    # -------------------------
-    # 3️⃣ If Knowledge → Use RAG
-    # -------------------------
-    if "knowledge" in question_type:
+# Static prefix per model registry task (warm-up and benchmarks)
+PROMPT_PREFIXES = {
+    "rewrite": REWRITE_PREFIX,
+    "classify": CLASSIFICATION_PREFIX,
+    "sql": SQL_PREFIX,
+    "answer": KNOWLEDGE_PREFIX,
+    "chitchat": CONVERSATIONAL_PREFIX,
+}
 
-        docs = similarity_search(search_query, top_k=5)
+def extract_sql(sql_query):
+    sql_query = sql_query.strip()
 
-        if not docs:
-            return "No relevant information found."
+    # ✅ Remove markdown formatting if LLM adds it
+    match = re.search(r"```(?:sql)?\s*(.*?)```", sql_query, re.DOTALL | re.IGNORECASE)
+    if match:
+        return match.group(1).strip()
+    return sql_query.replace("```sql", "").replace("```", "").strip()
 
-        context = "\n\n".join([doc["content"] for doc in docs])
+def run_generated_sql(sql_query):
+    """Runs LLM-generated SQL against the titanic table. Returns (question_type, answer)."""
+    # ✅ Safety check (block dangerous queries)
+    forbidden_keywords = ["drop", "delete", "update", "insert", "alter", "truncate"]
+    if any(keyword in sql_query.lower() for keyword in forbidden_keywords):
+        return "error", "Unsafe query detected."
 
-        prompt = f"""You are a helpful assistant. Your task is to answer the user's question based *only* on the provided context.
-Do not mention the context in your answer. Just provide the answer directly.
-If the information is not in the context, state that the answer is not available in the provided data.
+    try:
+        with connection.cursor() as cursor:
+            cursor.execute(sql_query)
+            result = cursor.fetchall()
 
-### Context:
-{context}
+        # ✅ Better formatting
+        if not result:
+            return "database", "No records found."
 
-### User's Question:
-{search_query}
+        if len(result) == 1 and len(result[0]) == 1:
+            return "database", f"The answer is {result[0][0]}."
 
-### Answer:
-"""
+        return "database", f"Query Result: {result}"
+
+    except Exception as e:
+        return "error", f"Error executing generated SQL: {str(e)}"
+
+def prepare_answer(search_query, search_options=None, question_type=None):
+    """
+    Classifies a standalone question and does everything up to the final
+    LLM call. Returns (question_type, answer, prompt, docs): either a
+    finished answer (prompt None) or the prompt whose completion is the
+    answer, plus the retrieved passages for knowledge questions (the
+    fallback if that completion fails). question_type is "error" for failed
+    SQL and "degraded" for answers built without the LLM.
+
+    Pass question_type when an earlier stage already classified the question.
+    Otherwise the centroid classifier (api/intent_classifier.py) decides from
+    the query embedding, which retrieval reuses from the embedding cache, and
+    the LLM is only asked when it is unsure. While the LLM classifies,
+    retrieval runs speculatively on the stage executor (RAG_SPECULATIVE_RETRIEVAL).
+
+    When the LLM is unavailable (circuit open, overloaded, or too little of
+    the request deadline left) the question is answered from retrieval alone:
+    the top passages are returned verbatim.
+    """
+    search_options = search_options or {}
+    retrieval = None
+
+    # -------------------------
+    # 1️⃣ Classify question (embedding centroids, then LLM)
+    # -------------------------
+    if question_type is None and settings.RAG_INTENT_CLASSIFIER:
+        question_type = intent_classifier.classify(generate_embedding(search_query))
+
+    if question_type is None:
+        if settings.RAG_SPECULATIVE_RETRIEVAL:
+            retrieval = stage_executor.submit(similarity_search, search_query, top_k=5, **search_options)
+        try:
+            require_generation("classify")
+            reply = generate_response(classification_prompt(search_query), task="classify")
+            question_type = normalize_category(reply)
+            print(f"DEBUG: Question '{search_query}' classified as: {question_type} ('{reply.strip()}')")
+        except OllamaOverloaded as e:
+            print(f"DEBUG: LLM classification unavailable ({str(e)}), answering from retrieved passages")
+            question_type = DEGRADED
+        except Exception:
+            stage_executor.discard(retrieval)
+            raise
+
+    if question_type not in (DEGRADED, "knowledge"):
+        stage_executor.discard(retrieval)
 
-        return generate_response(prompt)
+    # -------------------------
+    # 2️⃣ If Database → Generate SQL
+    # -------------------------
+    if question_type == "database":
+        sql_query = extract_sql(generate_response(sql_prompt(search_query), task="sql"))
+        return (*run_generated_sql(sql_query), None, None)
 
-    if "conversational" in question_type:
+    # -------------------------
+    # 3️⃣ If Knowledge → Use RAG
+    # -------------------------
+    if question_type in (DEGRADED, "knowledge"):
+
+        if retrieval:
+            docs = stage_executor.collect(retrieval)
+        else:
+            docs = similarity_search(search_query, top_k=5, **search_options)
+
+        return knowledge_answer(search_query, question_type, docs, extract_answer(search_query, docs))
+
+    if question_type == "conversational":
+        if not generation_available("chitchat"):
+            return DEGRADED, intent_classifier.GREETING_REPLY, None, None
         # Simple conversational response
-        return generate_response(f"Respond politely to this conversational input: {search_query}")
+        return "conversational", None, conversational_prompt(search_query), None
 
     # -------------------------
     # 4️⃣ Irrelevant
     # -------------------------
-    return "Please ask a question related to the dataset."
+    return "irrelevant", "Please ask a question related to the dataset.", None, None
 
+def knowledge_answer(search_query, question_type, docs, extracted=None):
+    """
+    Final step of prepare_answer for knowledge (or degraded) questions.
+    extracted is a confident answer sentence from api/extractive.py, served
+    without generation.
+    """
+    if not docs:
+        return question_type, answer_cache.NO_RESULTS_ANSWER, None, docs
+    if extracted:
+        return "knowledge", extracted, None, docs
+    if question_type == DEGRADED or not generation_available("answer"):
+        return degraded_answer(docs)
+    return "knowledge", None, knowledge_prompt(search_query, docs), docs
+
+def answer_task(question_type):
+    """Model registry task for the final generation of prepare_answer's prompt."""
+    return "chitchat" if question_type == "conversational" else "answer"
+
+def answer_question(search_query, search_options=None, question_type=None):
+    """
+    Classifies a standalone question and answers it.
+    Returns (question_type, answer); question_type is "error" for failed SQL.
+    """
+    question_type, answer, prompt, docs = prepare_answer(search_query, search_options, question_type)
+    if prompt is not None:
+        try:
+            answer = generate_response(prompt, task=answer_task(question_type))
+        except OllamaOverloaded as e:
+            if not docs:
+                raise
+            print(f"DEBUG: Answer generation unavailable ({str(e)}), serving retrieved passages")
+            question_type, answer = degraded_answer(docs)[:2]
+    return question_type, answer
+
+async def aprepare_answer(search_query, search_options=None, question_type=None):
+    """
+    Async version of prepare_answer (same prompts, branches and degraded
+    mode); speculative retrieval is an asyncio task instead of a stage
+    executor thread.
+    """
+    search_options = search_options or {}
+    retrieval = None
+
+    if question_type is None and settings.RAG_INTENT_CLASSIFIER:
+        question_type = intent_classifier.classify(await agenerate_embedding(search_query))
+
+    if question_type is None:
+        if settings.RAG_SPECULATIVE_RETRIEVAL:
+            retrieval = asyncio.create_task(asimilarity_search(search_query, top_k=5, **search_options))
+        try:
+            require_generation("classify")
+            reply = await agenerate_response(classification_prompt(search_query), task="classify")
+            question_type = normalize_category(reply)
+            print(f"DEBUG: Question '{search_query}' classified as: {question_type} ('{reply.strip()}')")
+        except OllamaOverloaded as e:
+            print(f"DEBUG: LLM classification unavailable ({str(e)}), answering from retrieved passages")
+            question_type = DEGRADED
+        except BaseException:
+            stage_executor.discard(retrieval)
+            raise
+
+    if question_type not in (DEGRADED, "knowledge"):
+        stage_executor.discard(retrieval)
+
+    if question_type == "database":
+        sql_query = extract_sql(await agenerate_response(sql_prompt(search_query), task="sql"))
+        return (*await sync_to_async(run_generated_sql)(sql_query), None, None)
+
+    if question_type in (DEGRADED, "knowledge"):
+        if retrieval:
+            docs = await stage_executor.acollect(retrieval)
+        else:
+            docs = await asimilarity_search(search_query, top_k=5, **search_options)
+        extracted = await sync_to_async(extract_answer)(search_query, docs)
+        return knowledge_answer(search_query, question_type, docs, extracted)
+
+    if question_type == "conversational":
+        if not generation_available("chitchat"):
+            return DEGRADED, intent_classifier.GREETING_REPLY, None, None
+        return "conversational", None, conversational_prompt(search_query), None
+
+    return "irrelevant", "Please ask a question related to the dataset.", None, None
+
+async def aanswer_question(search_query, search_options=None, question_type=None):
+    question_type, answer, prompt, docs = await aprepare_answer(search_query, search_options, question_type)
+    if prompt is not None:
+        try:
+            answer = await agenerate_response(prompt, task=answer_task(question_type))
+        except OllamaOverloaded as e:
+            if not docs:
+                raise
+            print(f"DEBUG: Answer generation unavailable ({str(e)}), serving retrieved passages")
+            question_type, answer = degraded_answer(docs)[:2]
+    return question_type, answer
 
 # def rag_query(question):
 #     """Complete RAG pipeline with Ollama"""
@@ -0,0 +1,325 @@
+"""
+Singleflight: coalescing of identical in-flight Ollama requests
+
+WHAT: When several callers ask for the same thing at the same time (same
+      prompt / same text to embed), only the first one (the leader) sends
+      the request; the others wait for it and share its result.
+WHY:  A popular question arriving from many users at once otherwise costs
+      one identical generation or embedding per user.
+
+Within a process, threads wait on the leader's in-memory call. With
+settings.RAG_SINGLEFLIGHT_SHARED_PATH set, a small SQLite lock table lets
+gunicorn workers coalesce too: the leading worker writes the result to the
+table and waiting workers poll it. A leader that dies is taken over once its
+row is older than the read timeout.
+
+Only in-flight calls are shared: a caller joins a flight that is still
+running, never a finished one. A finished result is kept only for the
+followers that were already waiting and deleted once the last of them has
+read it (rows a crashed follower never read expire after RESULT_TTL).
+
+A follower waits at most its own request deadline (api/deadline.py). The
+leader's OllamaOverloaded errors (queue rejections, its deadline running
+out) say nothing about the request, so followers don't inherit them: they
+try again and one of them leads the next flight.
+"""
+
+import asyncio
+import concurrent.futures
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+
+from django.conf import settings
+
+from api import deadline
+from api.ollama_scheduler import OllamaOverloaded
+
+RESULT_TTL = 5.0
+POLL_INTERVAL = 0.05
+
+stats = {"calls": 0, "upstream": 0, "coalesced": 0, "coalesced_shared": 0}
+_stats_lock = threading.Lock()
+
+
+def _record(key):
+    with _stats_lock:
+        stats[key] += 1
+
+
+def coalescing_ratio():
+    """Share of calls that were served by another caller's request."""
+    with _stats_lock:
+        calls = stats["calls"]
+        shared = stats["coalesced"] + stats["coalesced_shared"]
+    return round(shared / calls, 3) if calls else 0.0
+
+
+def _shareable(error):
+    # Rejections and deadlines belong to the caller that hit them, not to the request
+    return not isinstance(error, (OllamaOverloaded, _Abandoned))
+
+
+def _wait_timeout():
+    left = deadline.remaining()
+    return None if left is None else max(left, 0.0)
+
+
+def _waited_too_long():
+    return deadline.DeadlineExceeded("Request deadline exceeded waiting for a shared Ollama call")
+
+
+def request_key(kind, payload):
+    data = json.dumps(payload, sort_keys=True, separators=(",", ":"))
+    return f"{kind}:{hashlib.sha256(data.encode('utf-8')).hexdigest()}"
+
+
+class _Call:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class _Abandoned(Exception):
+    """An async leader was cancelled before its request finished."""
+
+
+class _SharedTable:
+    """Cross-worker lock/result table in a SQLite file (WAL mode)."""
+
+    def __init__(self, path, timeout):
+        self.path = path
+        self.timeout = timeout
+        self._local = threading.local()
+
+    def _db(self):
+        db = getattr(self._local, "db", None)
+        if db is None:
+            db = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute(
+                "CREATE TABLE IF NOT EXISTS flights ("
+                "key TEXT PRIMARY KEY, state TEXT NOT NULL, result TEXT, updated_at REAL NOT NULL, "
+                "waiters INTEGER NOT NULL DEFAULT 0)"
+            )
+            try:
+                # Tables created before waiters were counted
+                db.execute("ALTER TABLE flights ADD COLUMN waiters INTEGER NOT NULL DEFAULT 0")
+            except sqlite3.OperationalError:
+                pass
+            self._local.db = db
+        return db
+
+    def _try_lead(self, db, key):
+        now = time.time()
+        db.execute("DELETE FROM flights WHERE state = 'done' AND updated_at < ?", (now - RESULT_TTL,))
+        # Claim the key unless a live flight holds it: a finished flight is
+        # not joined, and a leader silent for too long is taken over
+        claimed = db.execute(
+            "INSERT INTO flights (key, state, updated_at) VALUES (?, 'running', ?) "
+            "ON CONFLICT(key) DO UPDATE SET state = 'running', result = NULL, updated_at = excluded.updated_at "
+            "WHERE flights.state = 'done' OR flights.updated_at < ?",
+            (key, now, now - self.timeout),
+        ).rowcount
+        return claimed == 1
+
+    def _finish(self, db, key, result):
+        # Keep the result only for followers that are waiting for it
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            kept = db.execute(
+                "UPDATE flights SET state = 'done', result = ?, updated_at = ? WHERE key = ? AND waiters > 0",
+                (json.dumps(result), time.time(), key),
+            ).rowcount
+            if not kept:
+                db.execute("DELETE FROM flights WHERE key = ?", (key,))
+            db.execute("COMMIT")
+        except BaseException:
+            db.execute("ROLLBACK")
+            raise
+
+    def _read_result(self, db, key):
+        """The finished result for a registered follower (None if gone); deletes it after the last reader."""
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            row = db.execute("SELECT state, result FROM flights WHERE key = ?", (key,)).fetchone()
+            if row is None or row[0] != "done":
+                db.execute("COMMIT")
+                return None
+            db.execute("UPDATE flights SET waiters = waiters - 1 WHERE key = ?", (key,))
+            db.execute("DELETE FROM flights WHERE key = ? AND waiters <= 0", (key,))
+            db.execute("COMMIT")
+            return row[1]
+        except BaseException:
+            db.execute("ROLLBACK")
+            raise
+
+    def do(self, key, fn):
+        """Runs fn once across workers; fn's result must be JSON-serializable."""
+        db = self._db()
+        while True:
+            if self._try_lead(db, key):
+                try:
+                    result = fn()
+                except BaseException:
+                    db.execute("DELETE FROM flights WHERE key = ?", (key,))
+                    raise
+                self._finish(db, key, result)
+                return result, False
+
+            # Another worker leads: register as a waiter while its flight is running
+            registered = db.execute(
+                "UPDATE flights SET waiters = waiters + 1 WHERE key = ? AND state = 'running'", (key,)
+            ).rowcount
+            if not registered:
+                continue  # finished or gone meanwhile; lead a new flight
+
+            while True:
+                row = db.execute("SELECT state, updated_at FROM flights WHERE key = ?", (key,)).fetchone()
+                if row is None:
+                    break  # leader failed; try to lead ourselves
+                state, updated_at = row
+                if state == "done":
+                    result = self._read_result(db, key)
+                    if result is not None:
+                        return json.loads(result), True
+                    break
+                left = deadline.remaining()
+                if updated_at < time.time() - self.timeout or (left is not None and left <= 0):
+                    # Leader presumed dead, or our own time is up; stop counting as its waiter
+                    db.execute("UPDATE flights SET waiters = MAX(waiters - 1, 0) WHERE key = ?", (key,))
+                    if left is not None and left <= 0:
+                        raise _waited_too_long()
+                    break
+                time.sleep(POLL_INTERVAL)
+
+
+class SingleFlight:
+    def __init__(self):
+        self._calls = {}
+        self._lock = threading.Lock()
+        self._async_calls = {}
+        self._shared = None
+        self._shared_checked = False
+
+    def _shared_table(self):
+        if not self._shared_checked:
+            path = settings.RAG_SINGLEFLIGHT_SHARED_PATH
+            self._shared = _SharedTable(path, settings.OLLAMA_READ_TIMEOUT) if path else None
+            self._shared_checked = True
+        return self._shared
+
+    def do(self, key, fn):
+        """
+        Returns fn() for the first caller with this key; concurrent callers
+        with the same key block and get the same result (or exception).
+        """
+        if not settings.RAG_SINGLEFLIGHT_ENABLED:
+            return fn()
+
+        _record("calls")
+        while True:
+            with self._lock:
+                call = self._calls.get(key)
+                leader = call is None
+                if leader:
+                    call = self._calls[key] = _Call()
+            if leader:
+                return self._lead(key, call, fn)
+
+            if not call.done.wait(_wait_timeout()):
+                raise _waited_too_long()
+            if call.error is None or _shareable(call.error):
+                _record("coalesced")
+                if call.error is not None:
+                    raise call.error
+                return call.result
+            # The leader was rejected on its own account: try again
+
+    def _lead(self, key, call, fn):
+        try:
+            shared = self._shared_table()
+            if shared:
+                try:
+                    call.result, coalesced = shared.do(key, fn)
+                except sqlite3.Error as e:
+                    print(f"Singleflight lock table unavailable: {str(e)}")
+                    call.result, coalesced = fn(), False
+            else:
+                call.result, coalesced = fn(), False
+            _record("coalesced_shared" if coalesced else "upstream")
+            return call.result
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+
+    async def ado(self, key, fn):
+        """
+        Async version of do() for coroutine functions. Callers on any event
+        loop share the leader's call (async_to_sync runs each in a new loop);
+        the result is handed over through a thread-safe future. (Process-local only.)
+        """
+        if not settings.RAG_SINGLEFLIGHT_ENABLED:
+            return await fn()
+
+        _record("calls")
+        while True:
+            with self._lock:
+                future = self._async_calls.get(key)
+                leader = future is None
+                if leader:
+                    future = self._async_calls[key] = concurrent.futures.Future()
+            if leader:
+                task = asyncio.ensure_future(fn())
+                task.add_done_callback(lambda done: self._settle(key, future, done))
+                _record("upstream")
+                # shield: the leader being cancelled must not cancel the followers' request
+                return await asyncio.shield(task)
+
+            try:
+                # shield: a follower giving up must not cancel the shared future
+                result = await asyncio.wait_for(asyncio.shield(asyncio.wrap_future(future)), _wait_timeout())
+            except asyncio.TimeoutError:
+                raise _waited_too_long()
+            except Exception as e:
+                if not _shareable(e):
+                    continue
+                _record("coalesced")
+                raise
+            _record("coalesced")
+            return result
+
+    def _settle(self, key, future, task):
+        with self._lock:
+            self._async_calls.pop(key, None)
+        if task.cancelled():
+            future.set_exception(_Abandoned(f"Leader of {key} was cancelled"))
+        elif task.exception() is not None:
+            future.set_exception(task.exception())
+        else:
+            future.set_result(task.result())
+
+
+_flight = SingleFlight()
+
+
+def do(kind, payload, fn):
+    return _flight.do(request_key(kind, payload), fn)
+
+
+async def ado(kind, payload, fn):
+    return await _flight.ado(request_key(kind, payload), fn)
+
+
+def snapshot():
+    with _stats_lock:
+        data = dict(stats)
+    data["coalescing_ratio"] = coalescing_ratio()
+    return data
@@ -0,0 +1,138 @@
+"""
+Background executor for speculative rag_query stages
+
+WHAT: A small per-process thread pool that runs a pipeline stage (currently
+      retrieval) while the request thread waits on the LLM for something
+      else, plus helpers to collect or discard the result.
+WHY:  Retrieval does not depend on the classification result. Starting it
+      while the LLM classifies a question hides its latency on knowledge
+      questions; for database / conversational questions the result is
+      simply thrown away.
+
+Speculation must never make a request slower than running the stage
+itself, so a stage never queues for a worker: submit() returns None when
+every stage worker is taken and the request runs the stage inline. Work
+nobody waits for (follow-up audits) goes to a separate background pool via
+submit_background(), which drops work when its queue is full.
+
+Worker threads hold their own database connections (Django connections are
+per thread), recycled by close_old_connections() like a request thread's.
+"""
+
+import contextvars
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.db import close_old_connections
+
+STAGE = "stage"
+BACKGROUND = "background"
+
+stats = {
+    "speculative_used": 0,
+    "speculative_discarded": 0,
+    "saturated_inline": 0,
+    "background_submitted": 0,
+    "background_dropped": 0,
+}
+
+_executors = {}
+_pending = {STAGE: 0, BACKGROUND: 0}
+_lock = threading.Lock()
+
+
+def _workers(pool):
+    return settings.RAG_STAGE_WORKERS if pool == STAGE else settings.RAG_BACKGROUND_WORKERS
+
+
+def _executor_instance(pool):
+    executor = _executors.get(pool)
+    if executor is None:
+        with _lock:
+            executor = _executors.get(pool)
+            if executor is None:
+                executor = _executors[pool] = ThreadPoolExecutor(
+                    max_workers=_workers(pool), thread_name_prefix=f"rag-{pool}"
+                )
+    return executor
+
+
+def _run(fn, args, kwargs):
+    close_old_connections()
+    try:
+        return fn(*args, **kwargs)
+    finally:
+        close_old_connections()
+
+
+def _submit(pool, limit, fn, args, kwargs):
+    # Submitted and not finished (running or queued), per pool
+    with _lock:
+        if _pending[pool] >= limit:
+            return None
+        _pending[pool] += 1
+    context = contextvars.copy_context()
+    future = _executor_instance(pool).submit(context.run, _run, fn, args, kwargs)
+    future.add_done_callback(lambda _: _finished(pool))
+    return future
+
+
+def _finished(pool):
+    with _lock:
+        _pending[pool] -= 1
+
+
+def submit(fn, *args, **kwargs):
+    """
+    Starts fn(*args, **kwargs) on the stage pool and returns its Future. fn
+    runs in a copy of the caller's context (request deadline, api/deadline.py).
+    Returns None when every stage worker is busy: the caller runs the stage
+    itself once it knows it needs it.
+    """
+    future = _submit(STAGE, settings.RAG_STAGE_WORKERS, fn, args, kwargs)
+    if future is None:
+        stats["saturated_inline"] += 1
+    return future
+
+
+def submit_background(fn, *args, **kwargs):
+    """
+    Runs fn(*args, **kwargs) on the background pool, away from the stage
+    workers requests wait on. Dropped (returns None) when
+    RAG_BACKGROUND_QUEUE calls are already waiting.
+    """
+    future = _submit(BACKGROUND, settings.RAG_BACKGROUND_WORKERS + settings.RAG_BACKGROUND_QUEUE, fn, args, kwargs)
+    if future is None:
+        stats["background_dropped"] += 1
+        return None
+    stats["background_submitted"] += 1
+    future.add_done_callback(_log_failure)
+    return future
+
+
+def collect(future):
+    """Result of a speculative stage that turned out to be needed (re-raises its error)."""
+    stats["speculative_used"] += 1
+    return future.result()
+
+
+async def acollect(task):
+    """collect() for an asyncio task (speculation on the async path)."""
+    stats["speculative_used"] += 1
+    return await task
+
+
+def discard(future):
+    """Drops a speculative stage (Future or asyncio task) that turned out not to be needed."""
+    if future is None:
+        return
+    stats["speculative_discarded"] += 1
+    if not future.cancel():
+        # Already running: let it finish, but don't leave its error unobserved
+        future.add_done_callback(_log_failure)
+
+
+def _log_failure(future):
+    if not future.cancelled() and future.exception() is not None:
+        print(f"Stage nobody waited for failed: {str(future.exception())}")
@@ -1,3 +1,1463 @@
-from django.test import TestCase
+import asyncio
+import concurrent.futures
+import importlib
+import json
+import os
+import socket
+import sqlite3
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from unittest import mock
 
-# Create your tests here.
+import httpx
+import numpy as np
+import requests
+from asgiref.sync import async_to_sync
+from django.db import DatabaseError
+from django.test import RequestFactory, SimpleTestCase, TestCase, override_settings
+from rest_framework.test import APIRequestFactory, force_authenticate
+
+from api import (
+    answer_cache, circuit_breaker, deadline, embedding_cache, extractive, followup, intent_classifier, mmap_index,
+    model_registry, ollama_service, singleflight, stage_executor, vector_db, vector_index, views,
+)
+from api.models import User
+from api.ollama_client import AsyncOllamaClient, OllamaClient
+from api.ollama_router import OllamaRouter
+from api.ollama_scheduler import BACKGROUND, GENERATE, SHORT, OllamaOverloaded, Scheduler
+from api import rag
+from api.rag import corpus_changed
+
+
+def unit_vector(index, dimensions=768):
+    vector = [0.0] * dimensions
+    vector[index] = 1.0
+    return vector
+
+
+class AnswerCacheTests(TestCase):
+    def test_upload_invalidates_knowledge_answers(self):
+        question = unit_vector(0)
+        generation, hit = answer_cache.lookup(question)
+        self.assertIsNone(hit)
+        answer_cache.store("How many leave days?", question, "knowledge", "25 days.", generation)
+
+        generation, hit = answer_cache.lookup(question)
+        self.assertEqual(hit["answer"], "25 days.")
+
+        # First upload on a fresh sequence must still start a new generation
+        self.assertGreater(answer_cache.invalidate(), generation)
+        _, hit = answer_cache.lookup(question)
+        self.assertIsNone(hit)
+
+    def test_conversational_answers_survive_uploads(self):
+        question = unit_vector(1)
+        generation, _ = answer_cache.lookup(question)
+        answer_cache.store("hello", question, "conversational", "Hi!", generation)
+        answer_cache.invalidate()
+        _, hit = answer_cache.lookup(question)
+        self.assertEqual(hit["answer"], "Hi!")
+
+    def test_database_answers_are_not_served(self):
+        question = unit_vector(2)
+        generation, _ = answer_cache.lookup(question)
+        answer_cache.store("survivors in 1st class", question, "database", "136", generation)
+        _, hit = answer_cache.lookup(question)
+        self.assertIsNone(hit)
+
+    def test_purge_expired(self):
+        question = unit_vector(3)
+        generation, _ = answer_cache.lookup(question)
+        answer_cache.store("hello", question, "conversational", "Hi!", generation)
+        with self.settings(RAG_ANSWER_CACHE_TTL=0):
+            self.assertEqual(answer_cache.purge_expired(), 1)
+
+
+@override_settings(RAG_ANSWER_CACHE_ENABLED=True)
+class AnswerCachePolicyTests(SimpleTestCase):
+    def setUp(self):
+        for patcher in (
+            mock.patch("api.rag.contextualize_question", return_value=("How many leave days?", None)),
+            mock.patch("api.rag.generate_embedding", return_value=unit_vector(0)),
+            mock.patch("api.rag.answer_cache.lookup", return_value=(4, None)),
+        ):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        patcher = mock.patch("api.rag.answer_cache.store")
+        self.store = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def ask(self, question_type, answer):
+        with mock.patch("api.rag.answer_question", return_value=(question_type, answer)):
+            return rag.rag_query("How many leave days?")
+
+    def test_knowledge_answer_is_stored(self):
+        self.ask("knowledge", "25 days.")
+        self.store.assert_called_once_with("How many leave days?", unit_vector(0), "knowledge", "25 days.", 4)
+
+    def test_empty_retrieval_is_not_stored(self):
+        self.assertEqual(self.ask("knowledge", answer_cache.NO_RESULTS_ANSWER), answer_cache.NO_RESULTS_ANSWER)
+        self.store.assert_not_called()
+
+    def test_database_answer_is_not_stored(self):
+        self.ask("database", "136")
+        self.store.assert_not_called()
+
+
+class StubOllama:
+    """
+    Minimal Ollama on a local port. `responses` maps a path to a
+    (status, body) pair, or a list of pairs served in order (the last one
+    repeats); unknown paths answer 404.
+    """
+
+    def __init__(self, responses=None):
+        self.responses = dict(responses or {})
+        self.requests = []
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"  # keep-alive, like Ollama
+
+            def _reply(self):
+                length = int(self.headers.get("Content-Length") or 0)
+                stub.requests.append((self.path, json.loads(self.rfile.read(length)) if length else None))
+                reply = stub.responses.get(self.path, (404, {"error": "not found"}))
+                if isinstance(reply, list):
+                    reply = reply.pop(0) if len(reply) > 1 else reply[0]
+                status, body = reply
+                # A str body is sent as-is (NDJSON streams)
+                data = body.encode() if isinstance(body, str) else json.dumps(body).encode()
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            do_GET = do_POST = _reply
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.url = f"http://127.0.0.1:{self.server.server_address[1]}"
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+def dead_url():
+    # A port nothing listens on
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return f"http://127.0.0.1:{sock.getsockname()[1]}"
+
+
+CLIENT_OPTIONS = {"pool_size": 2, "connect_timeout": 1, "read_timeout": 2, "max_retries": 0, "backoff": 0}
+EMBED_OK = (200, {"embeddings": [[0.1, 0.2]]})
+
+
+class OllamaClientRetryTests(SimpleTestCase):
+    """Retry policy: connection errors and 5xx are retried, 4xx is not, attempts are bounded."""
+
+    options = {**CLIENT_OPTIONS, "max_retries": 2}
+
+    def stub(self, replies):
+        stub = StubOllama({"/api/embed": replies})
+        self.addCleanup(stub.close)
+        return stub
+
+    def post(self, url):
+        client = OllamaClient(url, **self.options)
+        try:
+            return client.post("/api/embed", {"input": "a"}), client.stats()
+        except Exception as e:
+            return e, client.stats()
+
+    def apost(self, url):
+        async def post():
+            client = AsyncOllamaClient(url, **self.options)
+            try:
+                return await client.post("/api/embed", {"input": "a"}), client.stats()
+            except Exception as e:
+                return e, client.stats()
+            finally:
+                await client.client.aclose()
+
+        return async_to_sync(post)()
+
+    def test_5xx_is_retried(self):
+        for post in (self.post, self.apost):
+            stub = self.stub([(503, {"error": "loading model"}), EMBED_OK])
+            body, stats = post(stub.url)
+            self.assertEqual(body, EMBED_OK[1])
+            self.assertEqual((len(stub.requests), stats["retries"], stats["failures"]), (2, 1, 0))
+
+    def test_4xx_is_not_retried(self):
+        for post, error in ((self.post, requests.HTTPError), (self.apost, httpx.HTTPStatusError)):
+            stub = self.stub([(400, {"error": "bad request"}), EMBED_OK])
+            result, stats = post(stub.url)
+            self.assertIsInstance(result, error)
+            self.assertEqual((len(stub.requests), stats["retries"], stats["failures"]), (1, 0, 1))
+
+    def test_5xx_attempts_are_bounded(self):
+        for post, error in ((self.post, requests.HTTPError), (self.apost, httpx.HTTPStatusError)):
+            stub = self.stub((500, {"error": "boom"}))
+            result, stats = post(stub.url)
+            self.assertIsInstance(result, error)
+            self.assertEqual((len(stub.requests), stats["retries"], stats["failures"]), (3, 2, 1))
+
+    def test_connection_errors_are_retried_then_raised(self):
+        for post, error in ((self.post, requests.ConnectionError), (self.apost, httpx.ConnectError)):
+            result, stats = post(dead_url())
+            self.assertIsInstance(result, error)
+            self.assertEqual((stats["retries"], stats["failures"]), (2, 1))
+
+
+class OllamaRouterTests(SimpleTestCase):
+    def make_router(self, urls, **kwargs):
+        return OllamaRouter(urls, probe_interval=0, options=CLIENT_OPTIONS, **kwargs)
+
+    def test_pick_prefers_warm_host_within_slack(self):
+        router = self.make_router(["http://a", "http://b"], warm_slack=2)
+        warm, cold = router.hosts
+        warm.models = {"gemma3:1b"}
+        warm.outstanding = 2
+        self.assertIs(router.pick("gemma3:1b"), warm)
+
+    def test_pick_spills_to_cold_host_when_warm_is_busy(self):
+        router = self.make_router(["http://a", "http://b"], warm_slack=2)
+        warm, cold = router.hosts
+        warm.models = {"gemma3:1b"}
+        warm.outstanding = 3
+        self.assertIs(router.pick("gemma3:1b"), cold)
+        self.assertEqual(cold.outstanding, 1)
+
+    def test_pick_least_outstanding_without_warm_hosts(self):
+        router = self.make_router(["http://a", "http://b"])
+        router.hosts[0].outstanding = 1
+        self.assertIs(router.pick("gemma3:1b"), router.hosts[1])
+
+    def test_pick_skips_ejected_hosts(self):
+        router = self.make_router(["http://a", "http://b"])
+        router.hosts[1].ejected = True
+        for _ in range(3):
+            self.assertIs(router.pick(), router.hosts[0])
+
+    def test_embeddings_fail_over_to_another_host(self):
+        broken, healthy = StubOllama({"/api/embed": (500, {"error": "boom"})}), StubOllama({"/api/embed": EMBED_OK})
+        self.addCleanup(broken.close)
+        self.addCleanup(healthy.close)
+        router = self.make_router([broken.url, healthy.url])
+        router.hosts[1].outstanding = 1  # first pick goes to the broken host
+        body = router.post("/api/embed", {"model": "nomic-embed-text", "input": ["x"]})
+        self.assertEqual(body, EMBED_OK[1])
+        self.assertEqual(router.failovers, 1)
+        self.assertEqual(router.hosts[0].consecutive_failures, 1)
+
+    def test_generate_is_not_retried_on_another_host(self):
+        broken, healthy = StubOllama({"/api/generate": (500, {"error": "boom"})}), StubOllama()
+        self.addCleanup(broken.close)
+        self.addCleanup(healthy.close)
+        router = self.make_router([broken.url, healthy.url])
+        router.hosts[1].outstanding = 1
+        with self.assertRaises(requests.HTTPError):
+            router.post("/api/generate", {"model": "gemma3:1b", "prompt": "hi"})
+        self.assertEqual(healthy.requests, [])
+
+    def test_async_requests_reuse_one_client_across_event_loops(self):
+        stub = StubOllama({"/api/embed": EMBED_OK})
+        self.addCleanup(stub.close)
+        router = self.make_router([stub.url])
+        for _ in range(3):
+            # Each async_to_sync call runs in a new event loop, closed afterwards
+            body = async_to_sync(router.apost)("/api/embed", {"model": "nomic-embed-text", "input": ["x"]})
+            self.assertEqual(body, EMBED_OK[1])
+        self.assertEqual(router.hosts[0].async_client.stats()["connections_opened"], 1)
+
+    def test_async_stream_relays_chunks_from_the_io_loop(self):
+        lines = [{"response": "Hel"}, {"response": "lo"}, {"response": "", "done": True}]
+        stub = StubOllama({"/api/generate": (200, "".join(json.dumps(line) + "\n" for line in lines))})
+        self.addCleanup(stub.close)
+        router = self.make_router([stub.url])
+
+        async def collect():
+            return [chunk async for chunk in router.astream("/api/generate", {"model": "gemma3:1b", "prompt": "hi"})]
+
+        self.assertEqual(async_to_sync(collect)(), lines)
+        self.assertEqual(router.hosts[0].outstanding, 0)
+        self.assertTrue(stub.requests[0][1]["stream"])
+
+    def test_host_ejected_after_consecutive_failures(self):
+        router = self.make_router([dead_url()], eject_after=2)
+        for _ in range(2):
+            with self.assertRaises(requests.ConnectionError):
+                router.post("/api/generate", {"model": "gemma3:1b", "prompt": "hi"})
+        self.assertTrue(router.hosts[0].ejected)
+        self.assertEqual(router.hosts[0].outstanding, 0)
+
+    def test_probe_ejects_and_restores_hosts(self):
+        stub = StubOllama({"/api/ps": (200, {"models": [{"name": "gemma3:1b"}]})})
+        self.addCleanup(stub.close)
+        router = self.make_router([stub.url, dead_url()])
+        live, dead = router.hosts
+        live.ejected = True
+        router.probe()
+        self.assertFalse(live.ejected)
+        self.assertEqual(live.models, {"gemma3:1b"})
+        self.assertTrue(dead.ejected)
+
+
+class CorpusChangedTests(SimpleTestCase):
+    def setUp(self):
+        self.index = mock.Mock()
+        for patcher in (
+            mock.patch("api.rag.mmap_index.get_index", return_value=self.index),
+            mock.patch("api.rag.answer_cache.invalidate"),
+        ):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    @override_settings(RAG_RETRIEVAL_BACKEND="mmap")
+    def test_ids_update_the_index_incrementally(self):
+        corpus_changed(added_chunk_ids=[3], removed_chunk_ids=[1])
+        self.index.add.assert_called_once_with([3])
+        self.index.remove.assert_called_once_with([1])
+        self.index.sync.assert_not_called()
+
+    @override_settings(RAG_RETRIEVAL_BACKEND="mmap")
+    def test_bulk_ingestion_without_ids_syncs_the_index(self):
+        corpus_changed()
+        self.index.sync.assert_called_once_with()
+
+
+class ChunkTableIndex(mmap_index.MmapVectorIndex):
+    """Reads embeddings from a dict instead of document_chunks."""
+
+    def __init__(self, path, chunks):
+        super().__init__(path)
+        self.chunks = chunks
+
+    def _db_batches(self, condition):
+        wanted = dict(condition.children).get("id__in", self.chunks)
+        ids = sorted(chunk_id for chunk_id in wanted if chunk_id in self.chunks)
+        if ids:
+            yield ids, np.vstack([self.chunks[chunk_id] for chunk_id in ids])
+
+
+class MmapIndexTests(SimpleTestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = directory.name
+        self.chunks = {chunk_id: unit_vector(chunk_id) for chunk_id in range(1, 11)}
+        self.index = ChunkTableIndex(self.path, self.chunks)
+
+    def reader(self):
+        return ChunkTableIndex(self.path, self.chunks)
+
+    def nearest(self, index, chunk_id, top_k=1):
+        return [found for found, _ in index.search(unit_vector(chunk_id), top_k)]
+
+    def test_search_before_build(self):
+        with self.assertRaises(RuntimeError):
+            self.index.search(unit_vector(1), 5)
+
+    def test_build_and_search(self):
+        self.assertEqual(self.index.build(), 10)
+        results = self.reader().search(unit_vector(3), 2)
+        self.assertEqual(results[0], (3, 0.0))
+        self.assertAlmostEqual(results[1][1], 1.0)
+
+    def test_add_appends_new_chunks_only(self):
+        self.index.build()
+        reader = self.reader()
+        self.assertEqual(self.nearest(reader, 3), [3])
+        self.chunks[11] = unit_vector(11)
+        self.assertEqual(self.index.add([3, 11]), 1)
+        self.assertEqual(self.index.info()["count"], 11)
+        self.assertEqual(self.nearest(reader, 11), [11])
+
+    def test_remove_tombstones_in_place(self):
+        self.index.build()
+        self.assertEqual(self.index.remove([4, 99]), 1)
+        info = self.index.info()
+        self.assertEqual((info["generation"], info["count"], info["deleted"]), (1, 10, 1))
+        self.assertNotIn(4, self.nearest(self.reader(), 4, top_k=10))
+
+    def test_compaction_past_the_dead_row_ratio(self):
+        self.index.build()
+        self.index.remove([1, 2])
+        self.assertEqual(self.index.info()["generation"], 1)
+        self.index.remove([3])
+        info = self.index.info()
+        self.assertEqual((info["generation"], info["count"], info["deleted"]), (2, 7, 0))
+        self.assertFalse(os.path.exists(os.path.join(self.path, "vectors-1.f32")))
+        self.assertEqual(sorted(self.nearest(self.reader(), 5, top_k=10)), list(range(4, 11)))
+
+    def test_search_during_compaction_rereads_meta(self):
+        self.index.build()
+        stale = self.index._read_meta()
+        self.index.remove([1, 2, 3])
+        # meta.json was read just before the compaction removed generation 1
+        reader = self.reader()
+        with mock.patch.object(reader, "_read_meta", side_effect=[stale, self.index._read_meta()]):
+            self.assertEqual(self.nearest(reader, 5), [5])
+        self.assertEqual(reader.info()["generation"], 2)
+
+    def test_search_keeps_the_mapped_generation_while_files_move(self):
+        self.index.build()
+        reader = self.reader()
+        self.assertEqual(self.nearest(reader, 2), [2])
+        stale = self.index._read_meta()
+        stale["generation"] = 7  # never written
+        self.index.remove([1, 2, 3])
+        with mock.patch.object(reader, "_read_meta", return_value=stale):
+            self.assertEqual(self.nearest(reader, 5), [5])
+        self.assertEqual(reader._meta["generation"], 1)
+
+
+class RecordingCursor:
+    def __init__(self):
+        self.executed = []
+
+    def execute(self, sql, params=None):
+        self.executed.append((sql, params))
+
+
+class FakeConnection:
+    vendor = "postgresql"
+
+    def __init__(self, fail_on=None):
+        self.connection = object()
+        self.executed = []
+        self.fail_on = fail_on
+
+    def cursor(self):
+        connection = self
+
+        class Cursor(RecordingCursor):
+            def execute(self, sql, params=None):
+                connection.executed.append(sql)
+                if connection.fail_on and connection.fail_on in sql:
+                    raise DatabaseError(f'unrecognized configuration parameter "{connection.fail_on}"')
+
+            def __enter__(self):
+                return self
+
+            def __exit__(self, *exc):
+                return False
+
+        return Cursor()
+
+
+@mock.patch.object(vector_db, "_register_vector", lambda connection: None)
+class ConfigureConnectionTests(SimpleTestCase):
+    def setUp(self):
+        patcher = mock.patch.object(vector_db, "_iterative_scan_supported", True)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    @override_settings(RAG_ITERATIVE_SCAN="relaxed_order")
+    def test_iterative_scan_is_set_when_supported(self):
+        connection = FakeConnection()
+        vector_db.configure_connection(None, connection)
+        self.assertEqual(len(connection.executed), 2)
+        self.assertIn("hnsw.iterative_scan", connection.executed[1])
+
+    @override_settings(RAG_ITERATIVE_SCAN="relaxed_order")
+    def test_old_pgvector_skips_iterative_scan_instead_of_failing(self):
+        connection = FakeConnection(fail_on="hnsw.iterative_scan")
+        vector_db.configure_connection(None, connection)
+        self.assertFalse(vector_db._iterative_scan_supported)
+        # Later connections don't try again
+        connection = FakeConnection(fail_on="hnsw.iterative_scan")
+        vector_db.configure_connection(None, connection)
+        self.assertEqual(len(connection.executed), 1)
+
+    @override_settings(RAG_ITERATIVE_SCAN="")
+    def test_iterative_scan_can_be_disabled(self):
+        connection = FakeConnection()
+        vector_db.configure_connection(None, connection)
+        self.assertEqual(len(connection.executed), 1)
+
+
+class AnnIndexMigrationTests(SimpleTestCase):
+    def run_migration(self, existing):
+        migration = importlib.import_module("api.migrations.0006_documentchunk_embedding_ann_index")
+        cursor = mock.MagicMock()
+        cursor.fetchone.return_value = existing
+        connection = mock.MagicMock()
+        connection.cursor.return_value.__enter__.return_value = cursor
+        connection.ops.compose_sql.side_effect = lambda sql, params: sql.replace("%s", repr(params[0]))
+        migration.create_index(None, mock.Mock(connection=connection))
+        return migration, [call.args[0] for call in cursor.execute.call_args_list]
+
+    def test_builds_concurrently_outside_a_transaction_and_comments(self):
+        migration, executed = self.run_migration(None)
+        self.assertFalse(migration.Migration.atomic)
+        self.assertTrue(executed[1].startswith("CREATE INDEX CONCURRENTLY document_chunks_embedding_ann"))
+        comment = json.loads(executed[2].split(" IS ", 1)[1].strip("'"))
+        self.assertEqual(comment["params"], {"m": 16, "ef_construction": 64, "quantization": "none"})
+        self.assertIn("build_seconds", comment)
+
+    def test_keeps_a_valid_index_and_rebuilds_an_invalid_one(self):
+        self.assertEqual(len(self.run_migration((True,))[1]), 1)
+        executed = self.run_migration((False,))[1]
+        self.assertTrue(executed[1].startswith("DROP INDEX CONCURRENTLY"))
+        self.assertIn("CREATE INDEX CONCURRENTLY", executed[2])
+
+
+class VectorIndexTests(SimpleTestCase):
+    @override_settings(RAG_HNSW_EF_SEARCH_MAX=400, RAG_IVFFLAT_PROBES_MAX=100)
+    def test_search_overrides_are_clamped(self):
+        cursor = RecordingCursor()
+        vector_index.apply_search_params(cursor, ef_search=1000000, probes=-5)
+        self.assertEqual(cursor.executed[0][1], ["400", "1"])
+
+    @override_settings(RAG_HNSW_EF_SEARCH=40, RAG_IVFFLAT_PROBES=10)
+    def test_search_params_default_to_settings(self):
+        cursor = RecordingCursor()
+        vector_index.apply_search_params(cursor)
+        self.assertEqual(cursor.executed[0][1], ["40", "10"])
+
+    def test_partial_index_names_are_distinct_and_fit_postgres(self):
+        a = vector_index.partial_index_name("quarterly_financial_report_2023.pdf")
+        b = vector_index.partial_index_name("quarterly_financial_report_2024.pdf")
+        self.assertNotEqual(a, b)
+        self.assertLessEqual(max(len(a), len(b)), 63)
+        self.assertEqual(a, vector_index.partial_index_name("quarterly_financial_report_2023.pdf"))
+
+
+class BatchEmbeddingTests(SimpleTestCase):
+    def setUp(self):
+        self.stub = StubOllama({"/api/embed": (500, {"error": "boom"})})
+        self.addCleanup(self.stub.close)
+        router = OllamaRouter([self.stub.url], probe_interval=0, eject_after=100, options=CLIENT_OPTIONS)
+        cache = mock.Mock()
+        cache.get.return_value = None
+        for patcher in (
+            mock.patch("api.ollama_service.get_router", return_value=router),
+            mock.patch("api.ollama_service.get_cache", return_value=cache),
+            mock.patch.dict(circuit_breaker._breakers, clear=True),
+        ):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def test_batches_respect_the_request_deadline(self):
+        with deadline.budget(0.001):
+            time.sleep(0.01)
+            with self.assertRaises(deadline.DeadlineExceeded):
+                ollama_service.generate_embeddings(["a sentence"], lane=SHORT)
+        self.assertEqual(self.stub.requests, [])
+
+    @override_settings(OLLAMA_BREAKER_MIN_CALLS=2, OLLAMA_BREAKER_ERROR_RATE=0.5)
+    def test_batch_failures_open_the_breaker(self):
+        for i in range(2):
+            with self.assertRaises(circuit_breaker.OllamaUnavailable):
+                ollama_service.generate_embeddings([f"sentence {i}"], lane=SHORT)
+        sent = len(self.stub.requests)
+        with self.assertRaises(circuit_breaker.CircuitOpen):
+            ollama_service.generate_embeddings(["one more"], lane=SHORT)
+        self.assertEqual(len(self.stub.requests), sent)
+
+
+class EmbeddingCacheTests(SimpleTestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = os.path.join(directory.name, "embeddings.sqlite3")
+
+    def test_memory_tier_evicts_least_recently_used(self):
+        cache = embedding_cache.EmbeddingCache(2)
+        cache.put("m", "a", unit_vector(0))
+        cache.put("m", "b", unit_vector(1))
+        cache.get("m", "a")
+        cache.put("m", "c", unit_vector(2))
+        self.assertIsNone(cache.get("m", "b"))
+        self.assertEqual(cache.get("m", "a"), unit_vector(0))
+        self.assertEqual(cache.stats()["entries"], 2)
+
+    def test_entries_are_normalized_whatever_the_endpoint(self):
+        cache = embedding_cache.EmbeddingCache(10)
+        np.testing.assert_allclose(cache.put("m", "leave policy", [3.0, 4.0]), [0.6, 0.8], rtol=1e-6)
+        self.assertAlmostEqual(float(np.linalg.norm(cache.get("m", " leave  policy"))), 1.0, places=6)
+
+    def test_disk_tier_is_shared_and_survives_restarts(self):
+        embedding_cache.EmbeddingCache(10, self.path).put("m", "a", unit_vector(5))
+        restarted = embedding_cache.EmbeddingCache(10, self.path)
+        self.assertEqual(restarted.get("m", "a"), unit_vector(5))
+        self.assertEqual((restarted.stats()["disk_hits"], restarted.disk_entries()), (1, 1))
+
+    def test_disk_tier_evicts_past_its_cap(self):
+        cache = embedding_cache.EmbeddingCache(10, self.path, max_disk_entries=2)
+        with mock.patch.object(embedding_cache, "PRUNE_EVERY", 1), \
+                mock.patch.object(embedding_cache.time, "time", side_effect=[1.0, 2.0, 3.0, 4.0]):
+            cache.put("m", "a", unit_vector(0))
+            cache.put("m", "b", unit_vector(1))
+            # Reading a from disk makes b the least recently used
+            cache._entries.clear()
+            cache.get("m", "a")
+            cache.put("m", "c", unit_vector(2))
+        self.assertEqual(cache.disk_entries(), 2)
+        cache._entries.clear()
+        self.assertIsNone(cache.get("m", "b"))
+        self.assertIsNotNone(cache.get("m", "a"))
+
+
+class StageExecutorTests(SimpleTestCase):
+    def setUp(self):
+        for patcher in (
+            mock.patch.dict(stage_executor._executors, clear=True),
+            mock.patch.dict(stage_executor._pending, {stage_executor.STAGE: 0, stage_executor.BACKGROUND: 0}),
+        ):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.release = threading.Event()
+        self.addCleanup(self.release.set)
+
+    @override_settings(RAG_STAGE_WORKERS=1)
+    def test_saturated_pool_runs_stages_inline(self):
+        busy = stage_executor.submit(self.release.wait, 5)
+        self.assertIsNotNone(busy)
+        self.assertIsNone(stage_executor.submit(len, "abc"))
+        self.release.set()
+        busy.result()
+
+    @override_settings(RAG_STAGE_WORKERS=2)
+    def test_stage_runs_in_the_callers_context(self):
+        with deadline.budget(30):
+            future = stage_executor.submit(deadline.remaining)
+        self.assertGreater(stage_executor.collect(future), 29)
+
+    @override_settings(RAG_STAGE_WORKERS=1, RAG_BACKGROUND_WORKERS=1, RAG_BACKGROUND_QUEUE=1)
+    def test_background_work_has_its_own_bounded_pool(self):
+        self.assertIsNotNone(stage_executor.submit_background(self.release.wait, 5))
+        self.assertIsNotNone(stage_executor.submit_background(len, "queued"))
+        self.assertIsNone(stage_executor.submit_background(len, "dropped"))
+        # Stage workers are untouched by the background backlog
+        self.assertEqual(stage_executor.collect(stage_executor.submit(len, "abc")), 3)
+
+
+HISTORY = [
+    {"role": "user", "content": "How many passengers survived?"},
+    {"role": "assistant", "content": "342 passengers survived."},
+]
+
+
+@override_settings(RAG_FOLLOWUP_DETECTION=True, RAG_FOLLOWUP_AUDIT_RATE=0,
+                   RAG_FOLLOWUP_LOG_PATH="")
+class FollowupTests(SimpleTestCase):
+    def test_cues(self):
+        self.assertIn("pronoun", followup.cues("How many of them were women?"))
+        self.assertIn("ellipsis", followup.cues("and in first class?"))
+        self.assertEqual(followup.cues("How many passengers embarked at Southampton?"), [])
+
+    def test_near_repeat_of_previous_question_is_standalone(self):
+        with mock.patch("api.ollama_service.generate_embedding", side_effect=AssertionError("embedding requested")):
+            self.assertFalse(followup.needs_rewrite("How many passengers survived the sinking?", HISTORY))
+
+    def test_rewrite_budget_is_checked_before_detection(self):
+        with mock.patch.object(rag, "skip_rewrite", return_value=True), \
+                mock.patch.object(followup, "needs_rewrite", side_effect=AssertionError("detector ran")):
+            self.assertEqual(rag.contextualize_question("and them?", HISTORY), ("and them?", None))
+            self.assertEqual(async_to_sync(rag.acontextualize_question)("and them?", HISTORY), ("and them?", None))
+
+    def test_decision_log_rotates(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        path = os.path.join(directory.name, "decisions.jsonl")
+        with self.settings(RAG_FOLLOWUP_LOG_PATH=path, RAG_FOLLOWUP_LOG_MAX_BYTES=10):
+            followup.needs_rewrite("and them?", HISTORY)
+            followup.needs_rewrite("and them?", HISTORY)
+        self.assertTrue(os.path.exists(path + ".1"))
+        with open(path) as log:
+            self.assertEqual(len(log.readlines()), 1)
+
+
+class SchedulerTests(SimpleTestCase):
+    def make_scheduler(self, **kwargs):
+        options = {"limit": 1, "generate_limit": 1, "queue_timeout": 2, "max_queue": 4}
+        options.update(kwargs)
+        return Scheduler(**options)
+
+    def wait_in_thread(self, scheduler, lane, admitted=None, timeout=None):
+        """Starts a thread that queues for a slot, records its admission and releases it."""
+        waiting = scheduler.stats()["waiting"][lane]
+
+        def run():
+            with scheduler.slot(lane, timeout):
+                if admitted is not None:
+                    admitted.append(lane)
+
+        thread = threading.Thread(target=run, daemon=True)
+        thread.start()
+        while scheduler.stats()["waiting"][lane] == waiting:
+            time.sleep(0.005)
+        return thread
+
+    def test_full_queue_is_rejected_with_429(self):
+        scheduler = self.make_scheduler(max_queue=1)
+        scheduler.acquire(SHORT)
+        waiter = self.wait_in_thread(scheduler, SHORT)
+        with self.assertRaises(OllamaOverloaded) as raised:
+            scheduler.acquire(SHORT)
+        self.assertEqual(raised.exception.status, 429)
+        self.assertEqual(scheduler.stats()["rejected_queue_full"], 1)
+        scheduler.release(SHORT, 0.1)
+        waiter.join(5)
+
+    def test_short_requests_are_admitted_before_generate(self):
+        scheduler = self.make_scheduler()
+        admitted = []
+        scheduler.acquire(GENERATE)
+        generate = self.wait_in_thread(scheduler, GENERATE, admitted)
+        short = self.wait_in_thread(scheduler, SHORT, admitted)
+        scheduler.release(GENERATE, 0.1)
+        generate.join(5)
+        short.join(5)
+        # The generate call queued first but the short one went ahead of it
+        self.assertEqual(admitted, [SHORT, GENERATE])
+
+    def test_generate_limit_keeps_slots_for_short_requests(self):
+        scheduler = self.make_scheduler(limit=3, generate_limit=2)
+        self.assertTrue(scheduler.try_acquire(GENERATE))
+        self.assertTrue(scheduler.try_acquire(GENERATE))
+        self.assertFalse(scheduler.try_acquire(GENERATE))
+        self.assertTrue(scheduler.try_acquire(SHORT))
+
+    def test_rejected_when_estimated_wait_exceeds_queue_timeout(self):
+        scheduler = self.make_scheduler(queue_timeout=1)
+        scheduler.acquire(SHORT)
+        waiter = self.wait_in_thread(scheduler, SHORT)
+        scheduler._ewma_seconds[GENERATE] = 10.0
+        started = time.perf_counter()
+        with self.assertRaises(OllamaOverloaded) as raised:
+            scheduler.acquire(GENERATE)
+        # Rejected up front, without waiting out the timeout
+        self.assertLess(time.perf_counter() - started, 0.5)
+        self.assertEqual(raised.exception.status, 503)
+        self.assertGreaterEqual(raised.exception.retry_after, 10)
+        self.assertEqual(scheduler.stats()["rejected_deadline"], 1)
+        scheduler.release(SHORT, 0.1)
+        waiter.join(5)
+
+    def test_rejected_after_waiting_queue_timeout(self):
+        scheduler = self.make_scheduler()
+        scheduler.acquire(SHORT)
+        self.addCleanup(scheduler.release, SHORT, 0.1)
+        with self.assertRaises(OllamaOverloaded) as raised:
+            scheduler.acquire(SHORT, timeout=0.05)
+        self.assertEqual(raised.exception.status, 503)
+        self.assertEqual(scheduler.stats()["waiting"][SHORT], 0)
+
+    def test_async_slot_waits_for_a_sync_release(self):
+        scheduler = self.make_scheduler()
+        scheduler.acquire(GENERATE)
+        threading.Timer(0.1, scheduler.release, (GENERATE, 0.1)).start()
+
+        async def run():
+            async with scheduler.aslot(SHORT, timeout=2):
+                return scheduler.stats()["running"][SHORT]
+
+        self.assertEqual(async_to_sync(run)(), 1)
+        stats = scheduler.stats()
+        self.assertEqual(stats["running"], {SHORT: 0, GENERATE: 0, BACKGROUND: 0})
+        self.assertEqual(stats["admitted"], 2)
+        self.assertGreater(stats["avg_wait_seconds"], 0)
+
+    def test_async_slot_times_out(self):
+        scheduler = self.make_scheduler()
+        scheduler.acquire(SHORT)
+        self.addCleanup(scheduler.release, SHORT, 0.1)
+
+        async def run():
+            async with scheduler.aslot(SHORT, timeout=0.05):
+                pass
+
+        with self.assertRaises(OllamaOverloaded):
+            async_to_sync(run)()
+        self.assertEqual(scheduler.stats()["waiting"][SHORT], 0)
+        self.assertEqual(scheduler.stats()["rejected_deadline"], 1)
+
+    def test_background_runs_only_when_nothing_else_waits(self):
+        scheduler = Scheduler(limit=3, generate_limit=2, queue_timeout=1, max_queue=4)
+        self.assertTrue(scheduler.try_acquire(BACKGROUND))
+        # One at a time
+        self.assertFalse(scheduler.try_acquire(BACKGROUND))
+        scheduler.release(BACKGROUND, 0.1)
+
+        scheduler._waiting[GENERATE] = 1
+        self.assertFalse(scheduler.try_acquire(BACKGROUND))
+        scheduler._waiting[GENERATE] = 0
+
+    def test_background_leaves_a_slot_for_requests(self):
+        scheduler = Scheduler(limit=2, generate_limit=2, queue_timeout=1, max_queue=4)
+        self.assertTrue(scheduler.try_acquire(SHORT))
+        self.assertFalse(scheduler.try_acquire(BACKGROUND))
+
+
+class CircuitBreakerTests(SimpleTestCase):
+    def make_breaker(self, **kwargs):
+        options = {"window": 30, "min_calls": 3, "error_rate": 0.5, "slow_seconds": 1.0, "slow_rate": 0.8,
+                   "open_seconds": 0.05}
+        options.update(kwargs)
+        return circuit_breaker.CircuitBreaker("answer", **options)
+
+    def fail(self, breaker, error=None):
+        with self.assertRaises(Exception):
+            with breaker.call():
+                raise error or requests.ConnectionError("refused")
+
+    def succeed(self, breaker, body=None):
+        with breaker.call() as call:
+            if body:
+                call.exclude_decoding(body)
+
+    def test_opens_after_too_many_failures(self):
+        breaker = self.make_breaker()
+        self.succeed(breaker)
+        self.fail(breaker)
+        self.assertEqual(breaker.state, circuit_breaker.CLOSED)
+        self.fail(breaker)
+        self.assertEqual(breaker.state, circuit_breaker.OPEN)
+        with self.assertRaises(circuit_breaker.CircuitOpen):
+            breaker.check()
+
+    def test_half_open_trial_closes_or_reopens(self):
+        breaker = self.make_breaker(min_calls=1)
+        self.fail(breaker)
+        time.sleep(0.06)
+        self.assertTrue(breaker.available())
+
+        # Only one trial at a time
+        with breaker.call():
+            self.assertEqual(breaker.state, circuit_breaker.HALF_OPEN)
+            with self.assertRaises(circuit_breaker.CircuitOpen):
+                with breaker.call():
+                    pass
+        self.assertEqual(breaker.state, circuit_breaker.CLOSED)
+
+        self.fail(breaker)
+        time.sleep(0.06)
+        self.fail(breaker)  # failed trial
+        self.assertEqual(breaker.state, circuit_breaker.OPEN)
+        self.assertEqual(breaker.stats()["trips"], 3)
+
+    def test_local_rejections_are_not_failures(self):
+        breaker = self.make_breaker(min_calls=1)
+        self.fail(breaker, OllamaOverloaded("queue full"))
+        self.assertEqual(breaker.state, circuit_breaker.CLOSED)
+        self.assertEqual(breaker.stats()["window_calls"], 0)
+
+    def test_decoding_time_is_not_slowness(self):
+        breaker = self.make_breaker(slow_seconds=0.05, min_calls=1, slow_rate=1.0)
+        with breaker.call() as call:
+            time.sleep(0.08)
+            call.exclude_decoding({"eval_duration": 70_000_000})
+        self.assertEqual(breaker.state, circuit_breaker.CLOSED)
+        with breaker.call():
+            time.sleep(0.06)
+        self.assertEqual(breaker.state, circuit_breaker.OPEN)
+
+    def test_deadline_capped_timeouts_are_not_failures(self):
+        breaker = self.make_breaker(min_calls=1)
+        with self.assertRaises(requests.exceptions.ReadTimeout):
+            with breaker.call(deadline_capped=True):
+                raise requests.exceptions.ReadTimeout("deadline")
+        self.assertEqual(breaker.state, circuit_breaker.CLOSED)
+        self.fail(breaker, requests.exceptions.ReadTimeout("stuck"))
+        self.assertEqual(breaker.state, circuit_breaker.OPEN)
+
+    def test_deadline_capped_timeout_after_slow_seconds_counts_as_slow(self):
+        breaker = self.make_breaker(slow_seconds=0.02, min_calls=1, slow_rate=1.0)
+        with self.assertRaises(requests.exceptions.ReadTimeout):
+            with breaker.call(deadline_capped=True):
+                time.sleep(0.03)
+                raise requests.exceptions.ReadTimeout("deadline")
+        self.assertEqual(breaker.state, circuit_breaker.OPEN)
+
+    def test_breakers_are_per_task(self):
+        with mock.patch.dict(circuit_breaker._breakers, clear=True), \
+                self.settings(OLLAMA_BREAKER_MIN_CALLS=1, OLLAMA_BREAKER_OPEN_SECONDS=60):
+            self.fail(circuit_breaker.get_breaker("answer"))
+            self.assertFalse(circuit_breaker.generation_available("answer"))
+            self.assertTrue(circuit_breaker.generation_available("classify"))
+            self.assertIsNone(circuit_breaker.get_breaker(circuit_breaker.EMBEDDINGS).slow_seconds)
+
+
+@override_settings(RAG_INTENT_CLASSIFIER=True)
+class IntentClassifierTests(SimpleTestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = os.path.join(directory.name, "centroids.npz")
+        patcher = self.settings(RAG_INTENT_CENTROIDS_PATH=self.path, RAG_INTENT_BUILD_BACKOFF=60)
+        patcher.enable()
+        self.addCleanup(patcher.disable)
+        intent_classifier.reset()
+        self.addCleanup(intent_classifier.reset)
+        building = mock.patch.object(intent_classifier, "_building", False)
+        building.start()
+        self.addCleanup(building.stop)
+
+    def run_inline(self, fn, *args):
+        fn(*args)
+        return mock.Mock()
+
+    def test_replies_per_pleasantry(self):
+        self.assertEqual(intent_classifier.greeting_reply("Hi there!"), intent_classifier.GREETING_REPLY)
+        self.assertIn("welcome", intent_classifier.greeting_reply("thanks a lot"))
+        self.assertIn("Goodbye", intent_classifier.greeting_reply("bye"))
+        self.assertIsNone(intent_classifier.greeting_reply("history of the titanic"))
+
+    def test_missing_centroids_are_built_in_the_background(self):
+        submit = mock.patch("api.intent_classifier.stage_executor.submit_background", return_value=mock.Mock())
+        with submit as submitted:
+            self.assertIsNone(intent_classifier.get_classifier())
+            self.assertIsNone(intent_classifier.get_classifier())
+        submitted.assert_called_once()
+
+    def test_failed_build_backs_off(self):
+        build = mock.patch.object(intent_classifier.CentroidClassifier, "build", side_effect=RuntimeError("down"))
+        submit = mock.patch("api.intent_classifier.stage_executor.submit_background", side_effect=self.run_inline)
+        with build as built, submit:
+            self.assertIsNone(intent_classifier.classify([1.0, 0.0]))
+            self.assertIsNone(intent_classifier.classify([1.0, 0.0]))
+        built.assert_called_once()
+
+    def test_saved_centroids_classify(self):
+        classifier = intent_classifier.CentroidClassifier(
+            ["database", "knowledge"], [[1.0, 0.0], [0.0, 1.0]], ollama_service.EMBEDDING_MODEL
+        )
+        classifier.save(self.path)
+        with mock.patch("api.intent_classifier.stage_executor.submit_background") as submitted:
+            self.assertEqual(intent_classifier.classify([0.9, 0.1]), "database")
+        submitted.assert_not_called()
+
+
+class SharedSingleFlightTests(SimpleTestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = os.path.join(directory.name, "flights.sqlite3")
+        singleflight._SharedTable(self.path, timeout=10)._db()  # creates the table
+
+    def rows(self):
+        with sqlite3.connect(self.path) as db:
+            return db.execute("SELECT key, state, waiters FROM flights").fetchall()
+
+    def test_sequential_callers_do_not_share_results(self):
+        table = singleflight._SharedTable(self.path, timeout=10)
+        calls = []
+        self.assertEqual(table.do("k", lambda: calls.append(1) or len(calls)), (1, False))
+        self.assertEqual(table.do("k", lambda: calls.append(1) or len(calls)), (2, False))
+        self.assertEqual(self.rows(), [])
+
+    def test_concurrent_worker_joins_running_flight(self):
+        # Separate instances stand in for separate gunicorn workers
+        leader, follower = singleflight._SharedTable(self.path, 10), singleflight._SharedTable(self.path, 10)
+        release = threading.Event()
+        calls = []
+
+        def slow():
+            calls.append("leader")
+            release.wait(5)
+            return {"answer": 42}
+
+        results = {}
+        leading = threading.Thread(target=lambda: results.update(leader=leader.do("k", slow)))
+        leading.start()
+        while not self.rows():
+            time.sleep(0.01)
+        following = threading.Thread(target=lambda: results.update(follower=follower.do("k", lambda: calls.append("follower"))))
+        following.start()
+        while self.rows() != [("k", "running", 1)]:
+            time.sleep(0.01)
+        release.set()
+        leading.join(5)
+        following.join(5)
+
+        self.assertEqual(calls, ["leader"])
+        self.assertEqual(results, {"leader": ({"answer": 42}, False), "follower": ({"answer": 42}, True)})
+        # Deleted once the only waiter has read it
+        self.assertEqual(self.rows(), [])
+
+
+@override_settings(RAG_SINGLEFLIGHT_ENABLED=True, RAG_SINGLEFLIGHT_SHARED_PATH="")
+class SingleFlightTests(SimpleTestCase):
+    def run_concurrently(self, flight, fn, callers=5):
+        results, errors = [], []
+        barrier = threading.Barrier(callers)
+
+        def call():
+            barrier.wait()
+            try:
+                results.append(flight.do("k", fn))
+            except Exception as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=call) for _ in range(callers)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join(5)
+        return results, errors
+
+    def test_concurrent_callers_share_one_call(self):
+        calls = []
+
+        def slow():
+            calls.append(1)
+            time.sleep(0.1)
+            return "result"
+
+        results, errors = self.run_concurrently(singleflight.SingleFlight(), slow)
+        self.assertEqual((len(calls), results, errors), (1, ["result"] * 5, []))
+
+    def test_leader_error_reaches_every_waiter(self):
+        def failing():
+            time.sleep(0.1)
+            raise RuntimeError("Ollama down")
+
+        results, errors = self.run_concurrently(singleflight.SingleFlight(), failing)
+        self.assertEqual(results, [])
+        self.assertEqual(len(errors), 5)
+
+    def test_follower_with_budget_retries_after_leader_deadline(self):
+        flight, calls, outcome = singleflight.SingleFlight(), [], {}
+        leading = threading.Event()
+
+        def fn():
+            calls.append(1)
+            if len(calls) == 1:
+                leading.set()
+                time.sleep(0.1)
+                raise deadline.DeadlineExceeded("leader out of time")
+            return "result"
+
+        def leader():
+            with deadline.budget(0.1):
+                try:
+                    flight.do("k", fn)
+                except deadline.DeadlineExceeded as e:
+                    outcome["leader"] = e
+
+        def follower():
+            leading.wait(5)
+            with deadline.budget(5):
+                outcome["follower"] = flight.do("k", fn)
+
+        threads = [threading.Thread(target=leader), threading.Thread(target=follower)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join(5)
+        self.assertIsInstance(outcome["leader"], deadline.DeadlineExceeded)
+        self.assertEqual(outcome["follower"], "result")
+        self.assertEqual(len(calls), 2)
+
+    def test_follower_wait_is_capped_by_its_own_deadline(self):
+        flight = singleflight.SingleFlight()
+        leading = threading.Event()
+
+        def slow():
+            leading.set()
+            time.sleep(0.5)
+            return "result"
+
+        leader = threading.Thread(target=flight.do, args=("k", slow))
+        leader.start()
+        self.addCleanup(leader.join, 5)
+        leading.wait(5)
+        started = time.perf_counter()
+        with deadline.budget(0.05), self.assertRaises(deadline.DeadlineExceeded):
+            flight.do("k", slow)
+        self.assertLess(time.perf_counter() - started, 0.3)
+
+    def test_async_callers_on_different_loops_share_one_call(self):
+        flight, calls, results = singleflight.SingleFlight(), [], []
+
+        async def slow():
+            calls.append(1)
+            await asyncio.sleep(0.1)
+            return "result"
+
+        def call():
+            # async_to_sync: each caller runs in its own event loop
+            results.append(async_to_sync(flight.ado)("k", slow))
+
+        threads = [threading.Thread(target=call) for _ in range(3)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join(5)
+        self.assertEqual((len(calls), results), (1, ["result"] * 3))
+
+    def test_finished_calls_are_not_reused(self):
+        flight, calls = singleflight.SingleFlight(), []
+        flight.do("k", lambda: calls.append(1))
+        flight.do("k", lambda: calls.append(1))
+        self.assertEqual(len(calls), 2)
+
+
+class ChatStreamTests(SimpleTestCase):
+    def stream_sync(self, tokens):
+        request = APIRequestFactory().post("/api/chat/stream/", {"question": "Who survived?"}, format="json")
+        force_authenticate(request, user=User(username="reader"))
+        with mock.patch.object(views, "rag_query_stream", return_value=tokens):
+            response = views.ChatStreamAPI.as_view()(request)
+            body = b"".join(response.streaming_content).decode() if response.streaming else None
+        return response, body
+
+    def stream_async(self, tokens):
+        request = RequestFactory().post(
+            "/api/chat/stream/async/", json.dumps({"question": "Who survived?"}), content_type="application/json"
+        )
+
+        async def run():
+            response = await views.chat_stream_async(request)
+            if not response.streaming:
+                return response, None
+            return response, b"".join([chunk async for chunk in response.streaming_content]).decode()
+
+        with mock.patch.object(views.TokenAuthentication, "authenticate", return_value=(User(), None)), \
+                mock.patch.object(views, "arag_query_stream", return_value=tokens):
+            return async_to_sync(run)()
+
+    def events(self, body):
+        return [event for event in body.split("\n\n") if event]
+
+    def test_tokens_then_done(self):
+        response, body = self.stream_sync(iter(["Hel", "lo"]))
+        self.assertEqual(response["Content-Type"], "text/event-stream")
+        self.assertEqual(self.events(body), [
+            'data: {"token": "Hel"}', 'data: {"token": "lo"}', "event: done\ndata: {}",
+        ])
+
+    def test_failure_after_first_token_ends_with_error_event(self):
+        def tokens():
+            yield "Hel"
+            raise RuntimeError("Ollama went away")
+
+        response, body = self.stream_sync(tokens())
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.events(body), [
+            'data: {"token": "Hel"}',
+            f"event: error\ndata: {json.dumps({'error': views.CHAT_ERROR_ANSWER})}",
+            "event: done\ndata: {}",
+        ])
+
+    def test_overload_before_first_token_is_an_http_error(self):
+        def tokens():
+            raise OllamaOverloaded("queue full", status=429, retry_after=3)
+            yield
+
+        response, body = self.stream_sync(tokens())
+        self.assertEqual((response.status_code, response["Retry-After"], body), (429, "3", None))
+
+    def test_async_view_streams_tokens(self):
+        async def tokens():
+            yield "Hel"
+            yield "lo"
+
+        response, body = self.stream_async(tokens())
+        self.assertEqual(self.events(body), [
+            'data: {"token": "Hel"}', 'data: {"token": "lo"}', "event: done\ndata: {}",
+        ])
+
+    def test_async_view_overload_before_first_token(self):
+        async def tokens():
+            raise OllamaOverloaded("deadline", status=503, retry_after=2)
+            yield
+
+        response, body = self.stream_async(tokens())
+        self.assertEqual((response.status_code, response["Retry-After"], body), (503, "2", None))
+
+    def test_async_view_failure_after_first_token(self):
+        async def tokens():
+            yield "Hel"
+            raise RuntimeError("Ollama went away")
+
+        response, body = self.stream_async(tokens())
+        self.assertEqual(self.events(body)[1:], [
+            f"event: error\ndata: {json.dumps({'error': views.CHAT_ERROR_ANSWER})}", "event: done\ndata: {}",
+        ])
+
+
+class ChatErrorResponseTests(SimpleTestCase):
+    def chat_async(self, error):
+        request = RequestFactory().post(
+            "/api/chat/async/", json.dumps({"question": "Who survived?"}), content_type="application/json"
+        )
+        with mock.patch.object(views.TokenAuthentication, "authenticate", return_value=(User(), None)), \
+                mock.patch.object(views, "arag_query", side_effect=error):
+            return async_to_sync(views.chat_async)(request)
+
+    def test_scheduler_rejection_is_busy_with_retry_after(self):
+        response = self.chat_async(OllamaOverloaded("queue full", status=429, retry_after=3))
+        self.assertEqual((response.status_code, response["Retry-After"]), (429, "3"))
+        self.assertIn("busy", json.loads(response.content)["answer"])
+
+    def test_open_breaker_sends_retry_after(self):
+        response = self.chat_async(circuit_breaker.CircuitOpen("answer circuit open", retry_after=20))
+        self.assertEqual((response.status_code, response["Retry-After"]), (503, "20"))
+
+    def test_unreachable_ollama_is_an_outage(self):
+        response = self.chat_async(circuit_breaker.OllamaUnavailable("LLM generation failed: connection refused"))
+        self.assertEqual(response.status_code, 503)
+        self.assertFalse(response.has_header("Retry-After"))
+        self.assertNotIn("busy", json.loads(response.content)["answer"])
+
+    def test_spent_deadline_has_no_retry_after(self):
+        response = self.chat_async(deadline.DeadlineExceeded("Request deadline exceeded before answer"))
+        self.assertEqual(response.status_code, 503)
+        self.assertFalse(response.has_header("Retry-After"))
+
+
+class RewriteAndClassifyTests(SimpleTestCase):
+    def test_valid_reply(self):
+        raw = '{"standalone_question": " How many first class passengers survived? ", "category": "Database"}'
+        self.assertEqual(
+            rag.parse_rewrite_and_classify(raw), ("How many first class passengers survived?", "database")
+        )
+
+    def test_non_json_reply(self):
+        for raw in ("How many first class passengers survived?", "", None, '["database"]'):
+            self.assertIsNone(rag.parse_rewrite_and_classify(raw))
+
+    def test_missing_or_empty_question(self):
+        for raw in ('{"category": "database"}', '{"standalone_question": "  ", "category": "database"}',
+                    '{"standalone_question": 42, "category": "database"}'):
+            self.assertIsNone(rag.parse_rewrite_and_classify(raw))
+
+    def test_unknown_category(self):
+        for category in ('"sql"', '"database/knowledge"', "null"):
+            raw = f'{{"standalone_question": "How many survived?", "category": {category}}}'
+            self.assertIsNone(rag.parse_rewrite_and_classify(raw))
+
+    @override_settings(RAG_FUSED_REWRITE_CLASSIFY=True)
+    def test_invalid_reply_falls_back_to_two_calls(self):
+        replies = ['{"standalone_question": "How many survived in first class?"}', "How many survived in first class?"]
+        with mock.patch("api.rag.generate_response", side_effect=replies) as generate:
+            result = rag._contextualize_question("And in first class?", HISTORY)
+        # Rewritten only; prepare_answer classifies it
+        self.assertEqual(result, ("How many survived in first class?", None))
+        self.assertEqual(generate.call_args_list[0].kwargs, {"format": "json", "task": "rewrite"})
+        self.assertEqual(generate.call_args_list[1].args[0], rag.rewrite_prompt("And in first class?", HISTORY))
+
+    @override_settings(RAG_FUSED_REWRITE_CLASSIFY=True)
+    def test_async_invalid_reply_falls_back_to_two_calls(self):
+        replies = ["not json", "How many survived in first class?"]
+        with mock.patch("api.rag.agenerate_response", side_effect=replies) as generate:
+            result = async_to_sync(rag._acontextualize_question)("And in first class?", HISTORY)
+        self.assertEqual(result, ("How many survived in first class?", None))
+        self.assertEqual(generate.call_count, 2)
+
+
+class ModelRegistryTests(SimpleTestCase):
+    @override_settings(RAG_LLM_MODEL="gemma3:4b", RAG_TASK_MODELS={"rewrite": "gemma3:270m", "answer": ""})
+    def test_model_for_uses_the_task_override(self):
+        self.assertEqual(model_registry.model_for("rewrite"), "gemma3:270m")
+        # Unset or empty RAG_MODEL_<TASK> falls back to RAG_LLM_MODEL
+        self.assertEqual(model_registry.model_for("answer"), "gemma3:4b")
+        self.assertEqual(model_registry.model_for("sql"), "gemma3:4b")
+
+    def test_unknown_task(self):
+        with self.assertRaises(ValueError):
+            model_registry.model_for("summarize")
+
+    @override_settings(RAG_TASK_MODELS={"classify": "gemma3:270m"})
+    def test_payload_uses_the_task_model(self):
+        self.assertEqual(ollama_service._generate_payload("Q", "classify")["model"], "gemma3:270m")
+
+    def test_latency_report(self):
+        with mock.patch.dict(model_registry._latency, clear=True):
+            model_registry.record("classify", "gemma3:270m", 0.2, {"eval_duration": 1e8, "eval_count": 3})
+            model_registry.record("classify", "gemma3:270m", 0.4, failed=True)
+            report = model_registry.latency_report()["classify"]
+        self.assertEqual((report["calls"], report["errors"], report["avg_seconds"]), (2, 1, 0.2))
+        self.assertEqual((report["avg_eval_seconds"], report["avg_output_tokens"]), (0.1, 3.0))
+
+    @override_settings(OLLAMA_NUM_CTX=8192, OLLAMA_KEEP_ALIVE="5m",
+                       RAG_TASK_OPTIONS={"answer": {"num_predict": 512, "num_ctx": 16384}})
+    def test_profile_applies_task_options(self):
+        self.assertEqual(model_registry.profile("answer"), {
+            "num_ctx": 16384, "keep_alive": "5m", "num_predict": 512, "stop": ["\n### "], "temperature": 0.3,
+        })
+        # Other tasks keep the shared context size
+        self.assertEqual(model_registry.profile("sql")["num_ctx"], 8192)
+
+    def test_payloads_dont_change_the_profiles(self):
+        ollama_service._generate_payload("Q", "rewrite", format="json")
+        self.assertEqual(model_registry.profile("rewrite")["stop"], ["\n\n"])
+
+    @override_settings(OLLAMA_KEEP_ALIVE="5m")
+    def test_payload_options(self):
+        payload = ollama_service._generate_payload("Q", "rewrite")
+        self.assertEqual(payload["keep_alive"], "5m")
+        self.assertNotIn("keep_alive", payload["options"])
+        self.assertEqual(payload["options"]["stop"], ["\n\n"])
+
+    def test_json_format_payload_drops_stop(self):
+        payload = ollama_service._generate_payload("Q", "rewrite", format="json")
+        self.assertEqual(payload["format"], "json")
+        self.assertNotIn("stop", payload["options"])
+        self.assertEqual(payload["options"]["num_predict"], 128)
+
+    def test_gemini_generation_config(self):
+        self.assertEqual(model_registry.gemini_generation_config("sql"), {
+            "temperature": 0.0, "max_output_tokens": 256, "stop_sequences": ["\nUser Question:"],
+        })
+        self.assertNotIn("stop_sequences", model_registry.gemini_generation_config("classify"))
+
+
+@override_settings(RAG_EXTRACTIVE_ANSWERS=True, RAG_EXTRACTIVE_CHUNKS=2, RAG_EXTRACTIVE_MAX_DISTANCE=0.35,
+                   RAG_EXTRACTIVE_MIN_SIMILARITY=0.75, RAG_EXTRACTIVE_MIN_MARGIN=0.05)
+class ExtractiveAnswerTests(SimpleTestCase):
+    QUESTION = "How many days of annual leave do employees get?"
+
+    def setUp(self):
+        self.similarity = {}
+        for patcher in (
+            mock.patch("api.extractive.generate_embedding", return_value=[1.0, 0.0]),
+            mock.patch("api.extractive.generate_embeddings", side_effect=self.embed),
+            mock.patch.dict(extractive.stats, {key: 0 for key in extractive.stats}),
+        ):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def embed(self, sentences, lane):
+        # Cosine similarity to the question is self.similarity[sentence] (default 0)
+        return [[self.similarity.get(s, 0.0), (1 - self.similarity.get(s, 0.0) ** 2) ** 0.5] for s in sentences]
+
+    def doc(self, scored_sentences, distance=0.2):
+        self.similarity.update(scored_sentences)
+        return {"content": " ".join(scored_sentences), "distance": distance}
+
+    def extract(self, *docs):
+        return extractive.extract_answer(self.QUESTION, list(docs))
+
+    def test_split_sentences(self):
+        text = "Employees get 25 days of leave. Too short.\n- Leave requests go to your manager\nOK"
+        self.assertEqual(extractive.split_sentences(text), [
+            "Employees get 25 days of leave.", "Leave requests go to your manager",
+        ])
+
+    def test_best_sentence_is_the_answer(self):
+        answer = self.extract(self.doc({
+            "The office opens at nine every day.": 0.3,
+            "Parking is free for all staff members.": 0.2,
+            "Employees get 25 days of annual leave.": 0.92,
+        }))
+        self.assertEqual(answer, "Employees get 25 days of annual leave.")
+        self.assertEqual(extractive.stats["answered"], 1)
+
+    def test_distant_chunks_are_not_used(self):
+        self.assertIsNone(self.extract(self.doc({"Employees get 25 days of annual leave.": 0.95}, distance=0.5)))
+        self.assertEqual(extractive.stats["far_chunks"], 1)
+
+    def test_similarity_gate(self):
+        self.assertIsNone(self.extract(self.doc({
+            "Employees may carry leave over to March.": 0.7,
+            "Parking is free for all staff members.": 0.1,
+        })))
+        self.assertEqual(extractive.stats["low_confidence"], 1)
+
+    def test_margin_gate_against_distant_sentences(self):
+        self.assertIsNone(self.extract(self.doc({
+            "Employees get 25 days of annual leave.": 0.9,
+            "Parking is free for all staff members.": 0.1,
+            "Contractors get 20 days of annual leave.": 0.87,
+        })))
+        self.assertEqual(extractive.stats["low_confidence"], 1)
+
+    def test_adjacent_sentence_extends_the_span(self):
+        answer = self.extract(self.doc({
+            "The office opens at nine every day.": 0.1,
+            "Employees get 25 days of annual leave.": 0.9,
+            "Unused days carry over to the next year.": 0.87,
+            "Parking is free for all staff members.": 0.2,
+        }))
+        # A close neighbour doesn't count against the margin; it continues the answer
+        self.assertEqual(answer, "Employees get 25 days of annual leave. Unused days carry over to the next year.")
+
+    def test_span_stays_inside_its_chunk(self):
+        answer = self.extract(
+            self.doc({"Parking is free for all staff members.": 0.1, "Employees get 25 days of annual leave.": 0.9}),
+            self.doc({"Unused days carry over to the next year.": 0.88, "The office opens at nine every day.": 0.1}),
+        )
+        self.assertEqual(answer, "Employees get 25 days of annual leave.")
+
+    def test_embedding_failure_falls_back_to_generation(self):
+        with mock.patch("api.extractive.generate_embeddings", side_effect=OllamaOverloaded("queue full")):
+            self.assertIsNone(self.extract(self.doc({"Employees get 25 days of annual leave.": 0.9})))
+        self.assertEqual(extractive.stats["errors"], 1)
+
+
+class PromptTests(SimpleTestCase):
+    def test_prompts_start_with_their_static_prefix(self):
+        question = "And in first class?"
+        prompts = {
+            rag.REWRITE_PREFIX: rag.rewrite_prompt(question, HISTORY),
+            rag.REWRITE_AND_CLASSIFY_PREFIX: rag.rewrite_and_classify_prompt(question, HISTORY),
+            rag.CLASSIFICATION_PREFIX: rag.classification_prompt(question),
+            rag.SQL_PREFIX: rag.sql_prompt(question),
+        }
+        for prefix, prompt in prompts.items():
+            self.assertTrue(prompt.startswith(prefix))
+
+    def test_fused_prompt_ends_with_the_question(self):
+        # The output format is in the cached prefix, not after the history
+        prompt = rag.rewrite_and_classify_prompt("And in first class?", HISTORY)
+        self.assertIn('"standalone_question"', rag.REWRITE_AND_CLASSIFY_PREFIX)
+        self.assertTrue(prompt.rstrip().endswith("Follow-up Question: And in first class?"))
+
+
+@override_settings(RAG_INTENT_CLASSIFIER=False, RAG_SPECULATIVE_RETRIEVAL=True)
+class PrepareAnswerTests(SimpleTestCase):
+    def setUp(self):
+        for patcher in (
+            mock.patch.dict(stage_executor.stats, speculative_used=0, speculative_discarded=0),
+            mock.patch("api.rag.require_generation"),
+            mock.patch("api.rag.run_generated_sql", return_value=("database", "42 rows")),
+        ):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def speculative(self):
+        return stage_executor.stats["speculative_used"], stage_executor.stats["speculative_discarded"]
+
+    def test_normalize_category(self):
+        self.assertEqual(rag.normalize_category(" Knowledge.\n"), "knowledge")
+        self.assertEqual(rag.normalize_category("database/knowledge"), "database")
+        self.assertEqual(rag.normalize_category("This is a knowledge question"), "knowledge")
+        self.assertEqual(rag.normalize_category("no idea"), "irrelevant")
+
+    def test_mixed_reply_discards_speculative_retrieval(self):
+        retrieval = concurrent.futures.Future()
+        with mock.patch("api.rag.stage_executor.submit", return_value=retrieval), \
+                mock.patch("api.rag.generate_response", side_effect=["database/knowledge", "SELECT 1"]):
+            question_type, answer, _, _ = rag.prepare_answer("How many survived?")
+        self.assertEqual((question_type, answer), ("database", "42 rows"))
+        self.assertTrue(retrieval.cancelled())
+        self.assertEqual(self.speculative(), (0, 1))
+
+    def test_async_path_goes_through_the_executor_accounting(self):
+        async def search(query, top_k, **options):
+            return []
+
+        async def prepare(reply):
+            with mock.patch("api.rag.asimilarity_search", side_effect=search), \
+                    mock.patch("api.rag.agenerate_response", side_effect=[reply, "SELECT 1"]), \
+                    mock.patch("api.rag.knowledge_answer", return_value=("knowledge", "answer", None, [])):
+                return await rag.aprepare_answer("How many survived?")
+
+        self.assertEqual(async_to_sync(prepare)("database/knowledge")[0], "database")
+        self.assertEqual(self.speculative(), (0, 1))
+        self.assertEqual(async_to_sync(prepare)("knowledge")[0], "knowledge")
+        self.assertEqual(self.speculative(), (1, 1))
@@ -4,6 +4,9 @@ from . import views
 
 urlpatterns = [
     path('chat/', ChatBotAPI.as_view()),
+    path('chat/async/', views.chat_async, name='chat_async'),
+    path('chat/stream/', views.ChatStreamAPI.as_view(), name='chat_stream'),
+    path('chat/stream/async/', views.chat_stream_async, name='chat_stream_async'),
     path('signup/', SignupAPI.as_view()),
     path('login/', LoginAPI.as_view()),
     path('google-auth/', GoogleAuthAPI.as_view()),
@@ -0,0 +1,123 @@
+"""
+pgvector connection setup and binary vector transfer
+
+WHAT: Registers the pgvector types on every new database connection, sets the
+      ANN search defaults for the session and bulk-inserts chunks.
+WHY:  A Python list passed as `%s::vector` is serialized to ~768 decimal
+      strings that Postgres parses again on every query. With psycopg 3,
+      server-side binding and the pgvector dumpers, a float32 NumPy array is
+      sent in pgvector's binary format instead (4 bytes per dimension), and
+      ingestion uses binary COPY.
+
+Only the vector queries bind server-side (vector_cursor); the ORM, admin,
+auth and the generated SQL of rag.run_generated_sql keep Django's default
+client-side binding. With psycopg2 the same code works, but vectors still
+travel as text because psycopg2 only supports client-side interpolation.
+"""
+
+from contextlib import contextmanager
+
+import numpy as np
+from django.conf import settings
+from django.db import DatabaseError
+from django.db.backends.postgresql.psycopg_any import is_psycopg3
+
+CHUNK_COLUMNS = ("document_id", "content", "embedding", "metadata")
+
+# False once the server rejected the iterative scan settings (pgvector < 0.8)
+_iterative_scan_supported = True
+
+
+def to_db_vector(embedding):
+    """Query/insert parameter for a vector column: float32 array (binary under psycopg 3)."""
+    return np.asarray(embedding, dtype=np.float32)
+
+
+@contextmanager
+def vector_cursor(connection=None):
+    """
+    Cursor for queries with to_db_vector parameters. Under psycopg 3 it binds
+    server-side, so the vectors are sent in pgvector's binary format; errors
+    are still raised as django.db exceptions.
+    """
+    if connection is None:
+        from django.db import connection
+
+    if not is_psycopg3:
+        with connection.cursor() as cursor:
+            yield cursor
+        return
+
+    import psycopg
+
+    connection.ensure_connection()
+    with connection.wrap_database_errors, psycopg.Cursor(connection.connection) as cursor:
+        yield cursor
+
+
+def _register_vector(dbapi_connection):
+    if is_psycopg3:
+        from pgvector.psycopg import register_vector
+    else:
+        from pgvector.psycopg2 import register_vector
+    register_vector(dbapi_connection)
+
+
+def configure_connection(sender, connection, **kwargs):
+    """connection_created handler (see ApiConfig.ready)."""
+    global _iterative_scan_supported
+    if connection.vendor != "postgresql":
+        return
+
+    from api.vector_index import iterative_scan_sql, session_params_sql
+
+    try:
+        _register_vector(connection.connection)
+    except Exception as e:
+        # Fresh database before the pgvector extension exists (e.g. first migrate)
+        print(f"pgvector types not registered: {str(e)}")
+        return
+
+    with connection.cursor() as cursor:
+        cursor.execute(*session_params_sql())
+        if settings.RAG_ITERATIVE_SCAN and _iterative_scan_supported:
+            try:
+                cursor.execute(*iterative_scan_sql())
+            except DatabaseError as e:
+                # pgvector < 0.8: the connection (autocommit) stays usable without them
+                _iterative_scan_supported = False
+                print(f"pgvector iterative scans unavailable, searching without them: {str(e)}")
+
+
+def bulk_insert_chunks(rows):
+    """
+    Inserts (document_id, content, embedding, metadata) rows into document_chunks.
+
+    psycopg 3: one binary COPY, vectors written in pgvector's binary format.
+    psycopg2: a single multi-row INSERT through bulk_create.
+    The search_vector trigger fires in both cases.
+    """
+    rows = list(rows)
+    if not rows:
+        return 0
+
+    from django.db import connection
+
+    if is_psycopg3:
+        from psycopg.types.json import Jsonb
+
+        with connection.cursor() as cursor:
+            copy_sql = f"COPY document_chunks ({', '.join(CHUNK_COLUMNS)}) FROM STDIN WITH (FORMAT BINARY)"
+            with cursor.copy(copy_sql) as copy:
+                copy.set_types(["int8", "text", "vector", "jsonb"])
+                for document_id, content, embedding, metadata in rows:
+                    copy.write_row([document_id, content, to_db_vector(embedding), Jsonb(metadata)])
+        return len(rows)
+
+    from api.models import DocumentChunk
+
+    DocumentChunk.objects.bulk_create([
+        DocumentChunk(document_id=document_id, content=content, embedding=embedding, metadata=metadata)
+        for document_id, content, embedding, metadata in rows
+    ])
+    return len(rows)
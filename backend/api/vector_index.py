@@ -0,0 +1,297 @@
+"""
+ANN index management for document_chunks.embedding
+
+WHAT: Builds, rebuilds and drops the HNSW / IVFFlat index that pgvector uses
+      for `ORDER BY embedding <=> query` and reports its size and build time.
+WHY:  Without an ANN index every similarity search is a sequential scan over
+      every 768-dim vector in the table.
+
+The index always lives under one canonical name so that a rebuild can swap
+methods (hnsw <-> ivfflat) without touching the search queries. Build
+parameters and build time are stored as a JSON comment on the index itself.
+"""
+
+import hashlib
+import json
+import math
+import re
+import time
+
+from django.conf import settings
+from django.db import connection
+
+TABLE_NAME = "document_chunks"
+INDEX_NAME = "document_chunks_embedding_ann"
+
+METHODS = ("hnsw", "ivfflat")
+
+# Representation the ANN index is built on (settings.RAG_VECTOR_QUANTIZATION):
+#   mode: (indexed expression, opclass, distance operator, query expression)
+# The table always keeps the full-precision vector; "halfvec" (2 bytes/dim)
+# and "binary" (1 bit/dim) only shrink the index, and searches re-rank the
+# candidates they return with the exact cosine distance.
+QUANTIZATIONS = {
+    "none": ("embedding", "vector_cosine_ops", "<=>", "%(embedding)s::vector"),
+    "halfvec": ("(embedding::halfvec(768))", "halfvec_cosine_ops", "<=>", "%(embedding)s::halfvec(768)"),
+    "binary": ("(binary_quantize(embedding)::bit(768))", "bit_hamming_ops", "<~>", "binary_quantize(%(embedding)s::vector)::bit(768)"),
+}
+
+
+def order_by_sql(quantization):
+    """ORDER BY expression that can use an index built with `quantization`."""
+    expression, _, operator, query_expression = QUANTIZATIONS[quantization]
+    return f"{expression} {operator} {query_expression}"
+
+
+def default_ivfflat_lists(row_count):
+    """pgvector guidance: rows / 1000 up to 1M rows, sqrt(rows) beyond that."""
+    if row_count <= 1_000_000:
+        return max(1, row_count // 1000)
+    return max(1, int(math.sqrt(row_count)))
+
+
+def _index_sql(name, method, m=None, ef_construction=None, lists=None, quantization=None, concurrently=False):
+    quantization = quantization or settings.RAG_VECTOR_QUANTIZATION
+    if quantization not in QUANTIZATIONS:
+        raise ValueError(f"Unknown quantization '{quantization}'. Use one of: {', '.join(QUANTIZATIONS)}")
+    expression, opclass, _, _ = QUANTIZATIONS[quantization]
+
+    if method == "hnsw":
+        m = m or settings.RAG_HNSW_M
+        ef_construction = ef_construction or settings.RAG_HNSW_EF_CONSTRUCTION
+        options = f"m = {int(m)}, ef_construction = {int(ef_construction)}"
+        params = {"m": int(m), "ef_construction": int(ef_construction)}
+    elif method == "ivfflat":
+        if not lists:
+            with connection.cursor() as cursor:
+                cursor.execute(f"SELECT COUNT(*) FROM {TABLE_NAME}")
+                lists = default_ivfflat_lists(cursor.fetchone()[0])
+        options = f"lists = {int(lists)}"
+        params = {"lists": int(lists)}
+    else:
+        raise ValueError(f"Unknown index method '{method}'. Use one of: {', '.join(METHODS)}")
+
+    sql = (
+        f"CREATE INDEX {'CONCURRENTLY ' if concurrently else ''}{name} "
+        f"ON {TABLE_NAME} USING {method} ({expression} {opclass}) WITH ({options})"
+    )
+    params["quantization"] = quantization
+    return sql, params
+
+
+def _comment(cursor, name, method, params, build_seconds):
+    comment = json.dumps({"method": method, "params": params, "build_seconds": round(build_seconds, 3)})
+    # Utility statements can't take bound parameters, so inline the literal
+    cursor.execute(connection.ops.compose_sql(f"COMMENT ON INDEX {name} IS %s", [comment]))
+
+
+def build_index(method=None, m=None, ef_construction=None, lists=None, quantization=None):
+    """
+    Creates the ANN index if it does not exist yet.
+    Returns the build time in seconds (0.0 if the index was already there).
+    """
+    method = method or settings.RAG_VECTOR_INDEX_METHOD
+    if index_exists():
+        return 0.0
+
+    sql, params = _index_sql(INDEX_NAME, method, m, ef_construction, lists, quantization)
+    with connection.cursor() as cursor:
+        started = time.perf_counter()
+        cursor.execute(sql)
+        build_seconds = time.perf_counter() - started
+        _comment(cursor, INDEX_NAME, method, params, build_seconds)
+    return build_seconds
+
+
+def rebuild_index(method=None, m=None, ef_construction=None, lists=None, quantization=None):
+    """
+    Builds a fresh index with CREATE INDEX CONCURRENTLY next to the old one and
+    swaps it in, so searches keep using the old index while the new one builds.
+
+    Must run outside a transaction (Django's default autocommit mode).
+    """
+    method = method or settings.RAG_VECTOR_INDEX_METHOD
+    tmp_name = f"{INDEX_NAME}_new"
+    sql, params = _index_sql(tmp_name, method, m, ef_construction, lists, quantization, concurrently=True)
+
+    with connection.cursor() as cursor:
+        # Leftover from an interrupted rebuild would be INVALID, so start clean
+        cursor.execute(f"DROP INDEX CONCURRENTLY IF EXISTS {tmp_name}")
+        started = time.perf_counter()
+        cursor.execute(sql)
+        build_seconds = time.perf_counter() - started
+        cursor.execute(f"DROP INDEX CONCURRENTLY IF EXISTS {INDEX_NAME}")
+        cursor.execute(f"ALTER INDEX {tmp_name} RENAME TO {INDEX_NAME}")
+        _comment(cursor, INDEX_NAME, method, params, build_seconds)
+    return build_seconds
+
+
+def build_named_index(name, method=None, m=None, ef_construction=None, lists=None, quantization=None):
+    """
+    Builds an ANN index under `name` next to the canonical one (the per-mode
+    indexes of `manage.py benchmark_quantization`). Returns the build time.
+    """
+    method = method or settings.RAG_VECTOR_INDEX_METHOD
+    sql, params = _index_sql(name, method, m, ef_construction, lists, quantization)
+    with connection.cursor() as cursor:
+        cursor.execute(f"DROP INDEX IF EXISTS {name}")
+        started = time.perf_counter()
+        cursor.execute(sql)
+        build_seconds = time.perf_counter() - started
+        _comment(cursor, name, method, params, build_seconds)
+    return build_seconds
+
+
+def drop_named_index(name):
+    with connection.cursor() as cursor:
+        cursor.execute(f"DROP INDEX IF EXISTS {name}")
+
+
+def index_size(name):
+    """On-disk size of an index in bytes (pg_relation_size), None if it doesn't exist."""
+    with connection.cursor() as cursor:
+        cursor.execute("SELECT pg_relation_size(to_regclass(%s))", [name])
+        return cursor.fetchone()[0]
+
+
+def partial_index_name(source):
+    # The hash keeps sources that share a 20-character slug apart (63-character limit)
+    return f"{_unhashed_partial_index_name(source)}_{hashlib.sha1(source.encode('utf-8')).hexdigest()[:8]}"
+
+
+def _unhashed_partial_index_name(source):
+    # Name used before the hash suffix; still dropped by drop_partial_index
+    return f"{INDEX_NAME}_src_{re.sub(r'[^a-z0-9]+', '_', source.lower()).strip('_')[:20]}"
+
+
+def build_partial_index(source, method=None, m=None, ef_construction=None, lists=None, quantization=None):
+    """
+    Builds (concurrently) an ANN index covering only chunks whose
+    metadata->>'source' equals `source`. Searches filtered by that source
+    then walk a small index holding only matching rows instead of filtering
+    the global one.
+    """
+    method = method or settings.RAG_VECTOR_INDEX_METHOD
+    name = partial_index_name(source)
+    sql, params = _index_sql(name, method, m, ef_construction, lists, quantization, concurrently=True)
+    params["source"] = source
+
+    with connection.cursor() as cursor:
+        cursor.execute(f"DROP INDEX CONCURRENTLY IF EXISTS {name}")
+        started = time.perf_counter()
+        cursor.execute(connection.ops.compose_sql(sql + " WHERE metadata->>'source' = %s", [source]))
+        build_seconds = time.perf_counter() - started
+        _comment(cursor, name, method, params, build_seconds)
+    return name, build_seconds
+
+
+def drop_partial_index(source):
+    name = partial_index_name(source)
+    with connection.cursor() as cursor:
+        cursor.execute(f"DROP INDEX CONCURRENTLY IF EXISTS {name}")
+        cursor.execute(f"DROP INDEX CONCURRENTLY IF EXISTS {_unhashed_partial_index_name(source)}")
+    return name
+
+
+def drop_index(concurrently=True):
+    with connection.cursor() as cursor:
+        cursor.execute(f"DROP INDEX {'CONCURRENTLY ' if concurrently else ''}IF EXISTS {INDEX_NAME}")
+
+
+def index_exists():
+    with connection.cursor() as cursor:
+        cursor.execute("SELECT to_regclass(%s) IS NOT NULL", [INDEX_NAME])
+        return cursor.fetchone()[0]
+
+
+def index_report():
+    """
+    Returns a list of dicts describing every vector index on document_chunks:
+    name, access method, size, build params/time and scan count.
+    """
+    with connection.cursor() as cursor:
+        cursor.execute("""
+            SELECT c.relname,
+                   am.amname,
+                   pg_relation_size(c.oid),
+                   pg_size_pretty(pg_relation_size(c.oid)),
+                   obj_description(c.oid, 'pg_class'),
+                   COALESCE(s.idx_scan, 0),
+                   i.indisvalid
+            FROM pg_index i
+            JOIN pg_class c ON c.oid = i.indexrelid
+            JOIN pg_am am ON am.oid = c.relam
+            LEFT JOIN pg_stat_user_indexes s ON s.indexrelid = c.oid
+            WHERE i.indrelid = %s::regclass
+              AND am.amname IN ('hnsw', 'ivfflat')
+            ORDER BY c.relname
+        """, [TABLE_NAME])
+        rows = cursor.fetchall()
+
+    report = []
+    for name, method, size_bytes, size_pretty, comment, scans, valid in rows:
+        try:
+            details = json.loads(comment) if comment else {}
+        except json.JSONDecodeError:
+            details = {}
+        report.append({
+            "name": name,
+            "method": method,
+            "size_bytes": size_bytes,
+            "size": size_pretty,
+            "params": details.get("params", {}),
+            "build_seconds": details.get("build_seconds"),
+            "scans": scans,
+            "valid": valid,
+        })
+    return report
+
+
+def session_params_sql():
+    """
+    WHAT: Builds the statement that sets the search defaults for a connection
+    WHY:  Run once per new connection (api/vector_db.py) so ordinary searches
+          need no extra statement or transaction.
+
+    Sets hnsw.ef_search / ivfflat.probes from settings.
+    """
+    params = {"ef_search": str(settings.RAG_HNSW_EF_SEARCH), "probes": str(settings.RAG_IVFFLAT_PROBES)}
+    return (
+        "SELECT set_config('hnsw.ef_search', %(ef_search)s, false), "
+        "set_config('ivfflat.probes', %(probes)s, false)",
+        params,
+    )
+
+
+def iterative_scan_sql():
+    """
+    Statement enabling pgvector's iterative index scans (0.8+) with
+    RAG_ITERATIVE_SCAN: a filtered search then keeps scanning the index until
+    it has enough matching rows instead of returning fewer than LIMIT.
+    Unfiltered searches fill LIMIT on the first pass, so they are unaffected.
+    Older pgvector versions reject it; vector_db.configure_connection then
+    stops sending it.
+    """
+    return (
+        "SELECT set_config('hnsw.iterative_scan', %(iterative_scan)s, false), "
+        "set_config('ivfflat.iterative_scan', %(iterative_scan)s, false)",
+        {"iterative_scan": settings.RAG_ITERATIVE_SCAN},
+    )
+
+
+def apply_search_params(cursor, ef_search=None, probes=None):
+    """
+    Per-query override of ef_search / probes (higher = better recall, slower).
+
+    Uses set_config(..., is_local=true) so the value is dropped at the end of
+    the surrounding transaction and never leaks to other queries on a pooled
+    connection. Call it inside transaction.atomic(). Values come from the
+    request body, so they are clamped to RAG_HNSW_EF_SEARCH_MAX /
+    RAG_IVFFLAT_PROBES_MAX.
+    """
+    ef_search = min(max(int(ef_search or settings.RAG_HNSW_EF_SEARCH), 1), settings.RAG_HNSW_EF_SEARCH_MAX)
+    probes = min(max(int(probes or settings.RAG_IVFFLAT_PROBES), 1), settings.RAG_IVFFLAT_PROBES_MAX)
+    cursor.execute(
+        "SELECT set_config('hnsw.ef_search', %s, true), set_config('ivfflat.probes', %s, true)",
+        [str(ef_search), str(probes)],
+    )
@@ -1,4 +1,7 @@
 from django.shortcuts import render
+from django.http import JsonResponse, StreamingHttpResponse
+from asgiref.sync import sync_to_async
+import itertools
 import json
 import re
 from rest_framework.views import APIView
@@ -10,15 +13,24 @@ from .models import StateData, Titanic, User, UserChat
 from django.views.decorators.csrf import csrf_exempt
 from django.utils.decorators import method_decorator
 from .gemini import process_user_query, summarize_text
-from .rag import rag_query
+from .rag import arag_query, arag_query_stream, rag_query, rag_query_stream, corpus_changed, degraded_stats
 from django.db import connection
 from rest_framework.permissions import IsAuthenticated
 from rest_framework.authentication import TokenAuthentication
+from rest_framework.exceptions import AuthenticationFailed
 from .serializers import UserSerializer # Assuming you have this
 import time # For simulating processing steps if needed
 from rest_framework.decorators import api_view, permission_classes, authentication_classes
 from .models import StateData, Titanic, User, UserChat, Document, DocumentChunk
-from .ollama_service import generate_embedding
+from .ollama_service import generate_embeddings
+from .vector_db import bulk_insert_chunks
+from .embedding_cache import get_cache as get_embedding_cache
+from .ollama_router import get_router as get_ollama_router
+from .ollama_scheduler import OllamaOverloaded, get_scheduler as get_ollama_scheduler
+from . import (
+    answer_cache, circuit_breaker, deadline, extractive, followup, intent_classifier, model_registry, singleflight,
+    stage_executor,
+)
 import os
 from django.conf import settings
 
@@ -30,16 +42,204 @@ class ChatBotAPI(APIView):
     def post(self, request):
         question = request.data.get("question")
         chat_history = request.data.get("chat_history", [])
+        search_options = chat_search_options(request.data)
         
         if not question:
             return Response({"answer": "Please ask a question"})
         
         try:
-            result = rag_query(question, chat_history)
+            with deadline.budget(settings.RAG_REQUEST_DEADLINE):
+                result = rag_query(question, chat_history, search_options=search_options)
             return Response({"answer": result})
-            
+
+        except OllamaOverloaded as e:
+            return overloaded_response(e)
+        except Exception as e:
+            print(f"Chat failed: {str(e)}")
+            return Response({"answer": CHAT_ERROR_ANSWER})
+
+class ChatStreamAPI(APIView):
+    """
+    Streaming variant of ChatBotAPI (same request body) as Server-Sent Events:
+      data: {"token": "..."}      answer text, in order
+      event: error / data: {"error": "..."}
+      event: done / data: {}
+    Sync generator: it streams under WSGI only. Under ASGI Django would read
+    it to the end before sending anything; use chat_stream_async there.
+    """
+    authentication_classes = [TokenAuthentication]
+    permission_classes = [IsAuthenticated]
+
+    def post(self, request):
+        question = request.data.get("question")
+        chat_history = request.data.get("chat_history", [])
+        search_options = chat_search_options(request.data)
+
+        tokens, error = iter(["Please ask a question"]), None
+        if question:
+            tokens = rag_query_stream(question, chat_history, search_options=search_options)
+            try:
+                # Run the pipeline up to the first token before committing to a
+                # 200 stream, so an overloaded Ollama still gets a proper 429/503.
+                # The request deadline covers this part only.
+                with deadline.budget(settings.RAG_REQUEST_DEADLINE):
+                    tokens = itertools.chain([next(tokens)], tokens)
+            except OllamaOverloaded as e:
+                return overloaded_response(e)
+            except StopIteration:
+                tokens = iter([])
+            except Exception as e:
+                error = e
+
+        return sse_response(sse_events(tokens, error))
+
+# Shown instead of internal error details (logged with print)
+CHAT_ERROR_ANSWER = "Sorry, I couldn't process your question. Please try again."
+
+def overloaded_response(error):
+    """
+    Response for a chat Ollama couldn't take: 429/503 with Retry-After when
+    admission control rejects it (scheduler queue full or queue deadline) or
+    a circuit breaker is open, a plain 503 when Ollama is unreachable or the
+    request deadline ran out.
+    """
+    if isinstance(error, circuit_breaker.CircuitOpen):
+        message, retry_after = "The assistant is temporarily unavailable. Please try again in a moment.", True
+    elif isinstance(error, circuit_breaker.OllamaUnavailable):
+        message, retry_after = "The assistant can't reach its language model right now. Please try again later.", False
+    elif isinstance(error, deadline.DeadlineExceeded):
+        message, retry_after = "The assistant took too long to answer. Please try again.", False
+    else:
+        message, retry_after = "The assistant is busy right now. Please try again in a moment.", True
+    response = JsonResponse({"answer": message}, status=error.status)
+    if retry_after:
+        response["Retry-After"] = str(error.retry_after)
+    return response
+
+def sse_event(data, event=None):
+    prefix = f"event: {event}\n" if event else ""
+    return f"{prefix}data: {json.dumps(data)}\n\n"
+
+def sse_events(tokens, error=None):
+    """Token events, an error event if the answer broke off, then done."""
+    try:
+        if error:
+            raise error
+        for token in tokens:
+            yield sse_event({"token": token})
+    except Exception as e:
+        print(f"Chat stream failed: {str(e)}")
+        yield sse_event({"error": CHAT_ERROR_ANSWER}, event="error")
+    yield sse_event({}, event="done")
+
+async def asse_events(tokens, error=None):
+    """Async version of sse_events over an async iterator of tokens."""
+    try:
+        if error:
+            raise error
+        async for token in tokens:
+            yield sse_event({"token": token})
+    except Exception as e:
+        print(f"Chat stream failed: {str(e)}")
+        yield sse_event({"error": CHAT_ERROR_ANSWER}, event="error")
+    yield sse_event({}, event="done")
+
+def sse_response(events):
+    response = StreamingHttpResponse(events, content_type="text/event-stream")
+    response["Cache-Control"] = "no-cache"
+    # Stop nginx from buffering the stream
+    response["X-Accel-Buffering"] = "no"
+    return response
+
+async def _prepend(first, rest):
+    yield first
+    async for item in rest:
+        yield item
+
+async def _empty():
+    return
+    yield
+
+def chat_search_options(data):
+    """
+    Optional per-request retrieval knobs (ANN recall/latency, RRF weights)
+    and retrieval scope, e.g. {"filters": {"document_ids": [3], "source": "company_policy.pdf"}}
+    """
+    return {
+        key: data[key] for key in ("ef_search", "probes", "vector_weight", "keyword_weight", "filters") if data.get(key)
+    }
+
+async def async_chat_request(request):
+    """
+    Token auth and JSON body for the plain async chat views (DRF views are
+    sync-only). Returns (data, None) or (None, error response).
+    """
+    if request.method != "POST":
+        return None, JsonResponse({"detail": f'Method "{request.method}" not allowed.'}, status=405)
+
+    try:
+        auth = await sync_to_async(TokenAuthentication().authenticate)(request)
+    except AuthenticationFailed as e:
+        return None, JsonResponse({"detail": str(e.detail)}, status=401)
+    if auth is None:
+        return None, JsonResponse({"detail": "Authentication credentials were not provided."}, status=401)
+
+    try:
+        return json.loads(request.body or b"{}"), None
+    except json.JSONDecodeError:
+        return None, JsonResponse({"detail": "Invalid JSON body."}, status=400)
+
+@csrf_exempt
+async def chat_async(request):
+    """
+    Async twin of ChatBotAPI (same request/response body and token auth).
+    Under ASGI a request waiting on Ollama holds no thread, so one process can
+    serve many concurrent chats. DRF views are sync-only, hence a plain view.
+    """
+    data, error_response = await async_chat_request(request)
+    if error_response:
+        return error_response
+
+    question = data.get("question")
+    if not question:
+        return JsonResponse({"answer": "Please ask a question"})
+
+    try:
+        with deadline.budget(settings.RAG_REQUEST_DEADLINE):
+            result = await arag_query(question, data.get("chat_history", []), search_options=chat_search_options(data))
+        return JsonResponse({"answer": result})
+    except OllamaOverloaded as e:
+        return overloaded_response(e)
+    except Exception as e:
+        print(f"Chat failed: {str(e)}")
+        return JsonResponse({"answer": CHAT_ERROR_ANSWER})
+
+@csrf_exempt
+async def chat_stream_async(request):
+    """
+    Async twin of ChatStreamAPI (same body and events) for ASGI: tokens are
+    relayed from the async Ollama client as they arrive.
+    """
+    data, error_response = await async_chat_request(request)
+    if error_response:
+        return error_response
+
+    question = data.get("question")
+    tokens, error = _prepend("Please ask a question", _empty()), None
+    if question:
+        tokens = arag_query_stream(question, data.get("chat_history", []), search_options=chat_search_options(data))
+        try:
+            # As in ChatStreamAPI: 429/503 are only possible before the first byte
+            with deadline.budget(settings.RAG_REQUEST_DEADLINE):
+                tokens = _prepend(await tokens.__anext__(), tokens)
+        except OllamaOverloaded as e:
+            return overloaded_response(e)
+        except StopAsyncIteration:
+            tokens = _empty()
         except Exception as e:
-            return Response({"answer": f"Sorry, I couldn't process your question. Error: {str(e)}"})
+            error = e
+
+    return sse_response(asse_events(tokens, error))
 
 @method_decorator(csrf_exempt, name='dispatch')
 class SignupAPI(APIView):
@@ -238,7 +438,22 @@ def admin_dashboard_stats(request):
             'total_documents': total_docs,
             'total_chats': total_chats
         },
-        'graphs': graph_data
+        'graphs': graph_data,
+        # Counters of the worker that served this request
+        'caches': {
+            'embedding': get_embedding_cache().stats(),
+            'answer': answer_cache.stats,
+        },
+        'ollama': get_ollama_router().stats(),
+        'intent': intent_classifier.stats,
+        'speculation': stage_executor.stats,
+        'singleflight': singleflight.snapshot(),
+        'scheduler': get_ollama_scheduler().stats(),
+        'tasks': model_registry.latency_report(),
+        'breakers': circuit_breaker.stats(),
+        'degraded': degraded_stats,
+        'extractive': extractive.stats,
+        'followup': followup.snapshot(),
     })
 
 def process_and_embed_document(doc):
@@ -271,15 +486,12 @@ def process_and_embed_document(doc):
         chunk_size = 500
         chunks = [text[i:i+chunk_size] for i in range(0, len(text), chunk_size)]
 
-        # 3. Embed and Save
-        for chunk_content in chunks:
-            embedding = generate_embedding(chunk_content)
-            DocumentChunk.objects.create(
-                document=doc,
-                content=chunk_content,
-                embedding=embedding,
-                metadata={"source": doc.name}
-            )
+        # 3. Embed (batched requests) and Save (one bulk insert instead of an INSERT per chunk)
+        embeddings = generate_embeddings(chunks)
+        bulk_insert_chunks(
+            (doc.id, chunk_content, embedding, {"source": doc.name})
+            for chunk_content, embedding in zip(chunks, embeddings)
+        )
             
     except Exception as e:
         print(f"Error processing document {doc.name}: {str(e)}")
@@ -318,6 +530,7 @@ def admin_documents(request, doc_id=None):
 
         # Process the document (Chunking + Embedding)
         process_and_embed_document(doc)
+        corpus_changed(added_chunk_ids=list(doc.chunks.values_list('id', flat=True)))
 
         return Response({
             'message': 'Document uploaded successfully',
@@ -327,7 +540,9 @@ def admin_documents(request, doc_id=None):
     elif request.method == 'DELETE':
         try:
             doc = Document.objects.get(id=doc_id)
+            chunk_ids = list(doc.chunks.values_list('id', flat=True))
             doc.delete()
+            corpus_changed(removed_chunk_ids=chunk_ids)
             return Response({'message': 'Document deleted'})
         except Document.DoesNotExist:
             return Response({'error': 'Not found'}, status=404)
@@ -12,6 +12,7 @@ https://docs.djangoproject.com/en/6.0/ref/settings/
 
 from pathlib import Path
 from dotenv import load_dotenv
+import json
 import os
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
@@ -95,8 +96,12 @@ DATABASES = {
         'PASSWORD': os.getenv('DB_PASSWORD'),
         'HOST': os.getenv('DB_HOST'),
         'PORT': os.getenv('DB_PORT'),
+        # Keep connections open so the per-connection pgvector setup
+        # (api/vector_db.py) is paid once, not on every request
+        'CONN_MAX_AGE': int(os.getenv('DB_CONN_MAX_AGE', 60)),
+        'CONN_HEALTH_CHECKS': True,
         'OPTIONS': {
-            'options': '-c search_path=public'
+            'options': '-c search_path=public',
         }
     }
 }
@@ -172,3 +177,146 @@ REST_FRAMEWORK = {
     ],
 }
 
+
+# RAG / vector search settings
+# ANN index on document_chunks.embedding ('hnsw' or 'ivfflat'), see api/vector_index.py
+RAG_VECTOR_INDEX_METHOD = os.getenv('RAG_VECTOR_INDEX_METHOD', 'hnsw')
+RAG_HNSW_M = int(os.getenv('RAG_HNSW_M', 16))
+RAG_HNSW_EF_CONSTRUCTION = int(os.getenv('RAG_HNSW_EF_CONSTRUCTION', 64))
+# Per-query recall/latency knobs (can be overridden per request)
+RAG_HNSW_EF_SEARCH = int(os.getenv('RAG_HNSW_EF_SEARCH', 40))
+RAG_IVFFLAT_PROBES = int(os.getenv('RAG_IVFFLAT_PROBES', 10))
+# Upper bounds for the per-request overrides (pgvector accepts ef_search up to 1000)
+RAG_HNSW_EF_SEARCH_MAX = int(os.getenv('RAG_HNSW_EF_SEARCH_MAX', 400))
+RAG_IVFFLAT_PROBES_MAX = int(os.getenv('RAG_IVFFLAT_PROBES_MAX', 100))
+# Hybrid search: candidates per leg and Reciprocal Rank Fusion weights
+RAG_HYBRID_CANDIDATES = int(os.getenv('RAG_HYBRID_CANDIDATES', 20))
+RAG_RRF_K = int(os.getenv('RAG_RRF_K', 60))
+RAG_RRF_VECTOR_WEIGHT = float(os.getenv('RAG_RRF_VECTOR_WEIGHT', 1.0))
+RAG_RRF_KEYWORD_WEIGHT = float(os.getenv('RAG_RRF_KEYWORD_WEIGHT', 1.0))
+# Retrieval backend for the vector leg: 'postgres' (pgvector) or 'mmap' (api/mmap_index.py)
+RAG_RETRIEVAL_BACKEND = os.getenv('RAG_RETRIEVAL_BACKEND', 'postgres')
+RAG_MMAP_INDEX_DIR = os.getenv('RAG_MMAP_INDEX_DIR', str(BASE_DIR / 'vector_index'))
+# Representation the ANN index is built on: 'none', 'halfvec' or 'binary'.
+# Quantized searches fetch RERANK_FACTOR x candidates and re-rank them exactly.
+RAG_VECTOR_QUANTIZATION = os.getenv('RAG_VECTOR_QUANTIZATION', 'none')
+RAG_QUANTIZED_RERANK_FACTOR = int(os.getenv('RAG_QUANTIZED_RERANK_FACTOR', 4))
+# pgvector >= 0.8 iterative index scans for filtered searches ('relaxed_order',
+# 'strict_order'); skipped automatically on older pgvector versions, '' disables
+RAG_ITERATIVE_SCAN = os.getenv('RAG_ITERATIVE_SCAN', 'relaxed_order')
+# Embedding cache (api/embedding_cache.py): in-memory LRU entries per worker and
+# optional SQLite file shared by all workers ('' disables the persistent tier)
+RAG_EMBEDDING_CACHE_SIZE = int(os.getenv('RAG_EMBEDDING_CACHE_SIZE', 10000))
+RAG_EMBEDDING_CACHE_PATH = os.getenv('RAG_EMBEDDING_CACHE_PATH', str(BASE_DIR / 'embedding_cache.sqlite3'))
+# Rows kept in the SQLite tier (least recently used evicted past it, 0 = unbounded)
+RAG_EMBEDDING_CACHE_DISK_SIZE = int(os.getenv('RAG_EMBEDDING_CACHE_DISK_SIZE', 200000))
+# Semantic answer cache (api/answer_cache.py): serve a stored answer when the
+# standalone question's cosine similarity to a cached one reaches THRESHOLD
+RAG_ANSWER_CACHE_ENABLED = os.getenv('RAG_ANSWER_CACHE_ENABLED', 'True') == 'True'
+RAG_ANSWER_CACHE_THRESHOLD = float(os.getenv('RAG_ANSWER_CACHE_THRESHOLD', 0.96))
+RAG_ANSWER_CACHE_TTL = int(os.getenv('RAG_ANSWER_CACHE_TTL', 24 * 3600))
+# Batched embedding requests (ollama_service.generate_embeddings): max texts and
+# estimated tokens per /api/embed call
+RAG_EMBED_BATCH_SIZE = int(os.getenv('RAG_EMBED_BATCH_SIZE', 64))
+RAG_EMBED_BATCH_TOKENS = int(os.getenv('RAG_EMBED_BATCH_TOKENS', 8192))
+# Rewrite follow-up questions and classify them in one JSON-mode LLM call
+# (falls back to separate rewrite + classification calls on invalid output)
+RAG_FUSED_REWRITE_CLASSIFY = os.getenv('RAG_FUSED_REWRITE_CLASSIFY', 'True') == 'True'
+# Embedding-centroid intent classifier (api/intent_classifier.py): the LLM
+# classifies only when the best centroid is below MIN_SIMILARITY or less than
+# MIN_MARGIN ahead of the runner-up
+RAG_INTENT_CLASSIFIER = os.getenv('RAG_INTENT_CLASSIFIER', 'True') == 'True'
+RAG_INTENT_CENTROIDS_PATH = os.getenv('RAG_INTENT_CENTROIDS_PATH', str(BASE_DIR / 'intent_centroids.npz'))
+RAG_INTENT_MIN_SIMILARITY = float(os.getenv('RAG_INTENT_MIN_SIMILARITY', 0.5))
+RAG_INTENT_MIN_MARGIN = float(os.getenv('RAG_INTENT_MIN_MARGIN', 0.05))
+# Seconds before a worker retries building missing centroids after a failure
+RAG_INTENT_BUILD_BACKOFF = float(os.getenv('RAG_INTENT_BUILD_BACKOFF', 60))
+# Run retrieval speculatively while the LLM classifies a question
+# (api/stage_executor.py); RAG_STAGE_WORKERS threads per process
+RAG_SPECULATIVE_RETRIEVAL = os.getenv('RAG_SPECULATIVE_RETRIEVAL', 'True') == 'True'
+RAG_STAGE_WORKERS = int(os.getenv('RAG_STAGE_WORKERS', 4))
+# Work no request waits for (follow-up audits): its own threads, and at most
+# RAG_BACKGROUND_QUEUE calls queued before new ones are dropped
+RAG_BACKGROUND_WORKERS = int(os.getenv('RAG_BACKGROUND_WORKERS', 1))
+RAG_BACKGROUND_QUEUE = int(os.getenv('RAG_BACKGROUND_QUEUE', 8))
+# LLM per task (api/model_registry.py): RAG_MODEL_<TASK> overrides RAG_LLM_MODEL,
+# e.g. a tiny model for rewrite/classify and a larger one for answers;
+# RAG_TASK_OPTIONS is JSON overriding a task's generation profile (num_predict,
+# stop, temperature, num_ctx, keep_alive), e.g. {"answer": {"num_predict": 512}}
+RAG_LLM_MODEL = os.getenv('RAG_LLM_MODEL', 'gemma3:1b')
+RAG_TASK_MODELS = {
+    task: os.getenv(f'RAG_MODEL_{task.upper()}', RAG_LLM_MODEL)
+    for task in ('rewrite', 'classify', 'sql', 'answer', 'chitchat')
+}
+RAG_TASK_OPTIONS = json.loads(os.getenv('RAG_TASK_OPTIONS', '{}'))
+# Context size for every task (a different num_ctx makes Ollama reload the
+# model) and how long Ollama keeps a model loaded after a request
+OLLAMA_NUM_CTX = int(os.getenv('OLLAMA_NUM_CTX', 4096))
+OLLAMA_KEEP_ALIVE = os.getenv('OLLAMA_KEEP_ALIVE', '30m')
+
+# Ollama HTTP client (api/ollama_client.py): keep-alive pool per worker,
+# timeouts in seconds and bounded retries (5xx / connection resets) with jitter
+OLLAMA_BASE_URL = os.getenv('OLLAMA_BASE_URL', 'http://localhost:11434')
+# Several Ollama hosts (api/ollama_router.py): comma-separated URLs, picked by
+# 'least_outstanding' or 'ewma'; a host is ejected after EJECT_FAILURES
+# consecutive failures until its /api/ps probe (every PROBE_INTERVAL s) succeeds
+OLLAMA_HOSTS = [url.strip() for url in os.getenv('OLLAMA_HOSTS', OLLAMA_BASE_URL).split(',') if url.strip()]
+OLLAMA_ROUTING = os.getenv('OLLAMA_ROUTING', 'least_outstanding')
+OLLAMA_EJECT_FAILURES = int(os.getenv('OLLAMA_EJECT_FAILURES', 3))
+OLLAMA_PROBE_INTERVAL = float(os.getenv('OLLAMA_PROBE_INTERVAL', 10))
+# A host with the model loaded wins while it has at most this many more
+# outstanding requests than the least busy host without it
+OLLAMA_WARM_SLACK = int(os.getenv('OLLAMA_WARM_SLACK', 2))
+OLLAMA_POOL_SIZE = int(os.getenv('OLLAMA_POOL_SIZE', 10))
+OLLAMA_CONNECT_TIMEOUT = float(os.getenv('OLLAMA_CONNECT_TIMEOUT', 3))
+OLLAMA_READ_TIMEOUT = float(os.getenv('OLLAMA_READ_TIMEOUT', 120))
+OLLAMA_MAX_RETRIES = int(os.getenv('OLLAMA_MAX_RETRIES', 2))
+OLLAMA_RETRY_BACKOFF = float(os.getenv('OLLAMA_RETRY_BACKOFF', 0.5))
+# Admission control (api/ollama_scheduler.py), per process: concurrent Ollama
+# calls, how many of them may be answer generations, max queued requests per
+# lane and max seconds a request may wait before the chat returns 429/503
+OLLAMA_MAX_CONCURRENCY = int(os.getenv('OLLAMA_MAX_CONCURRENCY', 4))
+OLLAMA_GENERATE_CONCURRENCY = int(os.getenv('OLLAMA_GENERATE_CONCURRENCY', 3))
+OLLAMA_MAX_QUEUE = int(os.getenv('OLLAMA_MAX_QUEUE', 32))
+OLLAMA_QUEUE_TIMEOUT = float(os.getenv('OLLAMA_QUEUE_TIMEOUT', 10))
+# Coalesce identical in-flight generate/embedding requests (api/singleflight.py);
+# SHARED_PATH is a SQLite lock table that extends this across workers ('' = per process)
+RAG_SINGLEFLIGHT_ENABLED = os.getenv('RAG_SINGLEFLIGHT_ENABLED', 'True') == 'True'
+RAG_SINGLEFLIGHT_SHARED_PATH = os.getenv('RAG_SINGLEFLIGHT_SHARED_PATH', '')
+# Circuit breakers around Ollama (api/circuit_breaker.py), one per generation
+# task plus one for embeddings: over a rolling WINDOW of seconds (at least
+# MIN_CALLS calls), open when ERROR_RATE of the calls failed or SLOW_RATE took
+# SLOW_SECONDS or more to the first token (generation only); stay open
+# OPEN_SECONDS, then let one trial call through
+OLLAMA_BREAKER_WINDOW = float(os.getenv('OLLAMA_BREAKER_WINDOW', 30))
+OLLAMA_BREAKER_MIN_CALLS = int(os.getenv('OLLAMA_BREAKER_MIN_CALLS', 5))
+OLLAMA_BREAKER_ERROR_RATE = float(os.getenv('OLLAMA_BREAKER_ERROR_RATE', 0.5))
+OLLAMA_BREAKER_SLOW_SECONDS = float(os.getenv('OLLAMA_BREAKER_SLOW_SECONDS', 10))
+OLLAMA_BREAKER_SLOW_RATE = float(os.getenv('OLLAMA_BREAKER_SLOW_RATE', 0.8))
+OLLAMA_BREAKER_OPEN_SECONDS = float(os.getenv('OLLAMA_BREAKER_OPEN_SECONDS', 15))
+# Time budget of one chat request in seconds (api/deadline.py, 0 = none). The
+# rewrite is skipped with less than REWRITE_MIN_BUDGET left, and knowledge
+# questions are answered with the top DEGRADED_PASSAGES retrieved passages
+# verbatim when the LLM is unavailable or less than MIN_GENERATION_BUDGET is left
+RAG_REQUEST_DEADLINE = float(os.getenv('RAG_REQUEST_DEADLINE', 30))
+RAG_REWRITE_MIN_BUDGET = float(os.getenv('RAG_REWRITE_MIN_BUDGET', 10))
+RAG_MIN_GENERATION_BUDGET = float(os.getenv('RAG_MIN_GENERATION_BUDGET', 5))
+RAG_DEGRADED_PASSAGES = int(os.getenv('RAG_DEGRADED_PASSAGES', 3))
+# Extractive answers (api/extractive.py): answer a knowledge question with the
+# best-matching sentence of the top CHUNKS retrieved chunks, without generation,
+# when a chunk is within MAX_DISTANCE and the sentence's similarity to the
+# question is >= MIN_SIMILARITY and beats other sentences by MIN_MARGIN
+RAG_EXTRACTIVE_ANSWERS = os.getenv('RAG_EXTRACTIVE_ANSWERS', 'False') == 'True'
+RAG_EXTRACTIVE_CHUNKS = int(os.getenv('RAG_EXTRACTIVE_CHUNKS', 2))
+RAG_EXTRACTIVE_MAX_DISTANCE = float(os.getenv('RAG_EXTRACTIVE_MAX_DISTANCE', 0.35))
+RAG_EXTRACTIVE_MIN_SIMILARITY = float(os.getenv('RAG_EXTRACTIVE_MIN_SIMILARITY', 0.75))
+RAG_EXTRACTIVE_MIN_MARGIN = float(os.getenv('RAG_EXTRACTIVE_MIN_MARGIN', 0.05))
+# Follow-up detection (api/followup.py): rewrite a question with chat history
+# only if it has pronoun / ellipsis / brevity cues. Decisions go to LOG_PATH (JSON lines,
+# '' = off, rotated to LOG_PATH.1 at LOG_MAX_BYTES); AUDIT_RATE of the skipped
+# rewrites are rewritten in the background to estimate the false-negative
+# rate (manage.py followup_report)
+RAG_FOLLOWUP_DETECTION = os.getenv('RAG_FOLLOWUP_DETECTION', 'True') == 'True'
+RAG_FOLLOWUP_LOG_PATH = os.getenv('RAG_FOLLOWUP_LOG_PATH', '')
+RAG_FOLLOWUP_LOG_MAX_BYTES = int(os.getenv('RAG_FOLLOWUP_LOG_MAX_BYTES', 10 * 1024 * 1024))
+RAG_FOLLOWUP_AUDIT_RATE = float(os.getenv('RAG_FOLLOWUP_AUDIT_RATE', 0.05))
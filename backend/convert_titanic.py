@@ -8,8 +8,12 @@ import django
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'backend.settings')
 django.setup()
 
-from api.models import Titanic, Document
-from api.embeddings import generate_embedding
+from api.models import Titanic, DocumentChunk
+from api.ollama_service import generate_embeddings
+from api.rag import corpus_changed
+from api.vector_db import bulk_insert_chunks
+
+BATCH_SIZE = 256
 
 def convert_titanic_to_text(passenger):
     """Convert Titanic passenger record to descriptive text"""
@@ -32,35 +36,34 @@ def ingest_titanic_data():
     print(f"Total passengers: {Titanic.objects.count()}")
     
     # Clear existing Titanic documents
-    Document.objects.filter(metadata__source='titanic').delete()
+    DocumentChunk.objects.filter(metadata__source='titanic').delete()
     
-    passengers = Titanic.objects.all()
-    total = passengers.count()
+    passengers = list(Titanic.objects.all())
+    total = len(passengers)
     
-    for idx, passenger in enumerate(passengers, 1):
-        # Convert to text
-        text = convert_titanic_to_text(passenger)
+    for start in range(0, total, BATCH_SIZE):
+        batch = passengers[start:start + BATCH_SIZE]
         
-        # Generate embedding
-        embedding = generate_embedding(text)
+        # Convert to text and embed the whole batch in a few requests
+        texts = [convert_titanic_to_text(passenger) for passenger in batch]
+        embeddings = generate_embeddings(texts)
         
-        # Store in documents table
-        Document.objects.create(
-            content=text,
-            embedding=embedding,
-            metadata={
+        # Store in document_chunks table
+        bulk_insert_chunks(
+            (None, text, embedding, {
                 'source': 'titanic',
                 'passenger_id': passenger.passenger_id,
                 'survived': passenger.survived,
                 'pclass': passenger.pclass
-            }
+            })
+            for passenger, text, embedding in zip(batch, texts, embeddings)
         )
         
-        if idx % 10 == 0:
-            print(f"Processed {idx}/{total} passengers...")
+        print(f"Processed {start + len(batch)}/{total} passengers...")
     
+    corpus_changed()
     print(f"\nCompleted! {total} Titanic records converted to vectors.")
-    print("Data stored in 'documents' table in pgAdmin.")
+    print("Data stored in 'document_chunks' table in pgAdmin.")
 
 if __name__ == "__main__":
     ingest_titanic_data()
@@ -18,8 +18,10 @@ import django
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'backend.settings')
 django.setup()
 
-from api.models import Document
-from api.ollama_service import generate_embedding
+from api.models import DocumentChunk
+from api.ollama_service import generate_embeddings
+from api.rag import corpus_changed
+from api.vector_db import bulk_insert_chunks
 
 # YOUR KNOWLEDGE BASE - Replace with your actual data
 KNOWLEDGE_BASE = [
@@ -42,26 +44,24 @@ def ingest_documents():
     """Load documents into vector database"""
     print("Starting data ingestion...")
     
-    for idx, doc_data in enumerate(KNOWLEDGE_BASE):
-        print(f"Processing document {idx + 1}/{len(KNOWLEDGE_BASE)}...")
-        
-        # Generate embedding
-        embedding = generate_embedding(doc_data["content"])
-        
-        # Store in database
-        Document.objects.create(
-            content=doc_data["content"],
-            embedding=embedding,
-            metadata=doc_data.get("metadata", {})
-        )
-        
+    # Generate all embeddings in batched requests
+    embeddings = generate_embeddings([doc_data["content"] for doc_data in KNOWLEDGE_BASE])
+    
+    # Store in database
+    bulk_insert_chunks(
+        (None, doc_data["content"], embedding, doc_data.get("metadata", {}))
+        for doc_data, embedding in zip(KNOWLEDGE_BASE, embeddings)
+    )
+    corpus_changed()
+    
+    for doc_data in KNOWLEDGE_BASE:
         print(f"✓ Stored: {doc_data['content'][:50]}...")
     
     print(f"\n✓ Successfully ingested {len(KNOWLEDGE_BASE)} documents!")
 
 if __name__ == "__main__":
     # Clear existing documents (optional)
-    Document.objects.all().delete()
+    DocumentChunk.objects.filter(metadata__source="documentation").delete()
     print("Cleared existing documents\n")
     
     ingest_documents()
@@ -1,8 +1,8 @@
 """
 PDF Ingestion Script for RAG Pipeline
 
-Extracts text from company_policy.pdf, chunks it, generates embeddings,
-and stores in PostgreSQL documents table.
+Extracts text from company_policy.pdf, chunks it, generates embeddings
+(batched), and stores in PostgreSQL document_chunks table.
 
 RUN: python ingest_pdf.py
 """
@@ -13,8 +13,10 @@ import django
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'backend.settings')
 django.setup()
 
-from api.models import Document
-from api.ollama_service import generate_embedding
+from api.models import DocumentChunk
+from api.ollama_service import generate_embeddings
+from api.rag import corpus_changed
+from api.vector_db import bulk_insert_chunks
 import PyPDF2
 
 def extract_text_from_pdf(pdf_path):
@@ -61,38 +63,27 @@ def ingest_pdf(pdf_path, source_name="company_policy"):
     # Chunk text
     chunks = chunk_text(text)
     
-    # Generate embeddings and store
+    # Generate embeddings (a few batched requests) and store
     print("\nGenerating embeddings and storing in database...")
     
-    for idx, chunk in enumerate(chunks):
-        print(f"Processing chunk {idx + 1}/{len(chunks)}...")
-        
-        try:
-            # Generate embedding
-            embedding = generate_embedding(chunk)
-            
-            # Store in database
-            Document.objects.create(
-                content=chunk,
-                embedding=embedding,
-                metadata={
-                    "source": source_name,
-                    "chunk_id": idx,
-                    "type": "pdf"
-                }
-            )
-            
-            print(f"  ✓ Stored chunk {idx + 1}")
-        
-        except Exception as e:
-            print(f"  ✗ Error on chunk {idx + 1}: {str(e)}")
+    try:
+        embeddings = generate_embeddings(chunks)
+        bulk_insert_chunks(
+            (None, chunk, embedding, {"source": source_name, "chunk_id": idx, "type": "pdf"})
+            for idx, (chunk, embedding) in enumerate(zip(chunks, embeddings))
+        )
+        corpus_changed()
+        print(f"  ✓ Stored {len(chunks)} chunks")
+    except Exception as e:
+        print(f"  ✗ Error: {str(e)}")
+        return
     
     print(f"\n=== ✓ Successfully ingested {len(chunks)} chunks from {source_name}.pdf ===\n")
 
 if __name__ == "__main__":
     # Clear existing documents (optional - comment out to keep old data)
     print("Clearing existing documents...")
-    Document.objects.all().delete()
+    DocumentChunk.objects.filter(metadata__source="company_policy").delete()
     print("✓ Cleared\n")
     
     # Ingest company_policy.pdf